@@ -0,0 +1,123 @@
+"""
+Running energy totals for today.
+
+The accumulator folds each stored sample into its controller's totals for
+today in constant time, so today's production can be shown and pushed over
+the WebSocket without scanning the day's raw readings. The totals live in
+SolarEnergyAccumulator rows, updated in the transaction that stores the
+samples while holding a lock on the controller, so every worker process and
+the collector add to the same totals. The first sample after local midnight
+rolls the controller's previous day into a SolarDailyAggregate, unless one
+already exists, and folds it into the month, year and lifetime stats (see
+solar.rollup).
+
+Sunshine is judged against the peak so far rather than the day's final peak,
+so it can differ slightly from solar.energy.
+"""
+
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import SolarEnergyAccumulator
+from .energy import SUNSHINE_MIN_POWER, SUNSHINE_PEAK_FRACTION
+from .rollup import fold_daily
+
+logger = logging.getLogger(__name__)
+
+def local_date(moment):
+    if timezone.is_aware(moment):
+        return timezone.localtime(moment).date()
+    return moment.date()
+
+def lock_device(device):
+    """Hold a lock on a controller's running totals until the transaction ends"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"solar-today:{device}"])
+
+class TodayAccumulator:
+    """Today's energy totals of each controller, kept in the database"""
+
+    def state(self, device='local'):
+        """A controller's latest totals, or None"""
+        return SolarEnergyAccumulator.objects.filter(device=device).order_by('-date').first()
+
+    def _roll_over(self, finished, day):
+        """Close a controller's day and return fresh totals for the given one"""
+        daily = finished.to_daily_aggregate()
+        try:
+            with transaction.atomic():
+                daily.save()
+        except IntegrityError:
+            # A recompute or the nightly aggregation already produced the day
+            pass
+        else:
+            fold_daily([daily])
+        SolarEnergyAccumulator.objects.filter(device=finished.device, date__lt=day).delete()
+        logger.info(f"Rolled solar energy of {finished.device} for {finished.date} into the daily aggregate")
+
+        # Energy counted over midnight goes to the new day, as in solar.energy
+        return SolarEnergyAccumulator(
+            date=day,
+            device=finished.device,
+            last_energy_generated=finished.last_energy_generated,
+            last_energy_consumed=finished.last_energy_consumed,
+        )
+
+    def add_many(self, samples):
+        """
+        Fold newly stored SolarControllerData samples into their controllers'
+        totals, in one savepoint. Call it in the transaction storing them.
+        """
+        by_device = defaultdict(list)
+        for sample in samples:
+            by_device[sample.device].append(sample)
+
+        with transaction.atomic():
+            for device in sorted(by_device):
+                # Workers storing samples of the same controller take turns
+                lock_device(device)
+                state = self.state(device)
+                for sample in sorted(by_device[device], key=lambda sample: sample.timestamp):
+                    day = local_date(sample.timestamp)
+                    if state is None:
+                        state = SolarEnergyAccumulator(date=day, device=device)
+                    if day < state.date:
+                        continue  # Late sample for a day that has been rolled over
+                    if day > state.date:
+                        state = self._roll_over(state, day)
+                    elif state.last_timestamp is not None and sample.timestamp <= state.last_timestamp:
+                        continue  # Already counted, or uploaded out of order
+                    state.add_sample(
+                        sample,
+                        max_gap=getattr(settings, 'SOLAR_MAX_SAMPLE_GAP', 900),
+                        sunshine_min_power=SUNSHINE_MIN_POWER,
+                        sunshine_peak_fraction=SUNSHINE_PEAK_FRACTION,
+                    )
+                if state is not None:
+                    state.save()
+
+    def add(self, sample):
+        """Fold a newly stored SolarControllerData sample into its controller's totals"""
+        self.add_many([sample])
+
+    def summary(self):
+        """Today's totals over all controllers for the API and the WebSocket payload"""
+        today = timezone.localdate() if settings.USE_TZ else timezone.now().date()
+        states = list(SolarEnergyAccumulator.objects.filter(date=today))
+
+        updated = max((state.last_timestamp for state in states if state.last_timestamp), default=None)
+        return {
+            "date": today.isoformat(),
+            "energy_produced": sum(state.energy_produced for state in states),
+            "energy_consumed": sum(state.energy_consumed for state in states),
+            "peak_power": max((state.peak_power for state in states), default=0.0),
+            "peak_load": max((state.peak_load for state in states), default=0.0),
+            "sunshine_hours": max((state.sunshine_hours for state in states), default=0.0),
+            "updated": updated.isoformat() if updated else None,
+        }
+
+today = TodayAccumulator()
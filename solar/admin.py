@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import SolarController
 
-# Register your models here.
+@admin.register(SolarController)
+class SolarControllerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'transport', 'serial_port', 'host', 'slave_id', 'enabled')
+    list_filter = ('transport', 'enabled')
+    search_fields = ('name', 'host')
@@ -3,7 +3,8 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.db import close_old_connections
 from asgiref.sync import async_to_sync
-from .models import SolarControllerData
+from .models import SolarControllerData, SolarControllerSettings
+from .ingest import live_payload
 
 class SolarDataConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for real-time solar data updates"""
@@ -42,35 +43,7 @@ class SolarDataConsumer(AsyncWebsocketConsumer):
             if not latest:
                 return None
                 
-            # Ensure charging_mode is consistently a string
-            charging_mode = latest.charging_mode
-            if charging_mode is not None:
-                if isinstance(charging_mode, (int, float)):
-                    charging_mode = str(charging_mode)
-            
-            return {
-                "timestamp": latest.timestamp.isoformat(),
-                "pv_array": {
-                    "voltage": latest.pv_array_voltage,
-                    "current": latest.pv_array_current,
-                    "power": latest.pv_array_power
-                },
-                "battery": {
-                    "voltage": latest.battery_voltage,
-                    "charging_current": latest.battery_charging_current,
-                    "charging_power": latest.battery_charging_power,
-                    "temperature": latest.battery_temp
-                },
-                "load": {
-                    "voltage": latest.load_voltage,
-                    "current": latest.load_current,
-                    "power": latest.load_power
-                },
-                "controller": {
-                    "temperature": latest.controller_temp,
-                    "charging_mode": charging_mode
-                }
-            }
+            return live_payload(latest, SolarControllerSettings.current(latest.device))
         except Exception as e:
             print(f"Error retrieving latest solar data: {e}")
             return None
@@ -0,0 +1,183 @@
+"""
+Daily energy aggregation of the raw solar readings.
+
+Energy comes from the controller's own generated/consumed energy counters:
+the energy of an interval between two readings is the increase of the
+counter, which is exact and includes time the collector was down. A counter
+that went down was reset and counts from zero again.
+
+Readings without counters (from before they were collected) fall back to
+integrating power over the actual sample timestamps with the trapezoidal
+rule, so irregular polling does not skew it. Those intervals are left out
+when longer than SOLAR_MAX_SAMPLE_GAP seconds rather than bridged.
+
+Peaks and battery voltage extremes use the min/max envelope of readings that
+summarize several samples (see solar.sampling).
+
+Every day in a range is computed by one query, using window functions to
+pair each reading with the previous one of the same controller. Each
+controller gets its own daily rows, site_days() adds them up per date.
+"""
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from .models import SolarControllerData, SolarDailyAggregate
+from wyandata.retention import get_policy
+
+# Sunshine is production above this many watts, or 5% of the day's peak if higher
+SUNSHINE_MIN_POWER = 50
+SUNSHINE_PEAK_FRACTION = 0.05
+
+DAILY_FIELDS = [
+    'energy_produced', 'energy_consumed', 'peak_power', 'peak_load',
+    'min_battery_voltage', 'max_battery_voltage', 'avg_battery_voltage', 'sunshine_hours',
+]
+
+# How far before a range to look for the counter reading its first interval starts from
+COUNTER_LOOKBACK = timedelta(days=1)
+
+DAILY_SQL = """
+    WITH samples AS (
+        SELECT
+            {time}::date AS day,
+            pv_array_power AS pv,
+            load_power AS load,
+            battery_voltage,
+            -- Readings summarizing several samples carry their envelope
+            COALESCE(pv_array_power_max, pv_array_power) AS pv_max,
+            COALESCE(load_power_max, load_power) AS load_max,
+            COALESCE(battery_voltage_min, battery_voltage) AS voltage_min,
+            COALESCE(battery_voltage_max, battery_voltage) AS voltage_max,
+            EXTRACT(EPOCH FROM {time} - LAG({time}) OVER day_order)::float8 / 3600 AS hours,
+            device,
+            LAG(pv_array_power) OVER day_order AS prev_pv,
+            LAG(load_power) OVER day_order AS prev_load,
+            MAX(COALESCE(pv_array_power_max, pv_array_power)) OVER (PARTITION BY device, {time}::date) AS day_peak,
+            energy_generated_total AS generated,
+            LAG(energy_generated_total) OVER device_order AS prev_generated,
+            energy_consumed_total AS consumed,
+            LAG(energy_consumed_total) OVER device_order AS prev_consumed
+        FROM {table}
+        WHERE {time} < %(end)s AND {time} >= COALESCE(
+            -- Each controller's last counter reading before the range, to count the first interval in it
+            (SELECT MIN(last) FROM (
+                SELECT MAX({time}) AS last FROM {table}
+                WHERE {time} < %(start)s AND {time} >= %(lookback)s AND energy_generated_total IS NOT NULL
+                GROUP BY device
+            ) AS previous),
+            %(start)s
+        )
+        WINDOW
+            day_order AS (PARTITION BY device, {time}::date ORDER BY {time}),
+            device_order AS (PARTITION BY device ORDER BY {time})
+    ), intervals AS (
+        SELECT
+            *,
+            hours <= %(max_gap)s AS counted,
+            CASE WHEN generated >= prev_generated THEN generated - prev_generated ELSE generated END * 1000 AS generated_wh,
+            CASE WHEN consumed >= prev_consumed THEN consumed - prev_consumed ELSE consumed END * 1000 AS consumed_wh
+        FROM samples
+        WHERE day >= %(start)s::date
+    )
+    SELECT
+        day,
+        device,
+        COALESCE(SUM(CASE
+            WHEN prev_generated IS NOT NULL AND generated IS NOT NULL THEN generated_wh
+            WHEN counted THEN (pv + prev_pv) / 2 * hours
+        END), 0),
+        COALESCE(SUM(CASE
+            WHEN prev_consumed IS NOT NULL AND consumed IS NOT NULL THEN consumed_wh
+            WHEN counted THEN (load + prev_load) / 2 * hours
+        END), 0),
+        COALESCE(MAX(pv_max), 0),
+        COALESCE(MAX(load_max), 0),
+        MIN(voltage_min),
+        MAX(voltage_max),
+        AVG(battery_voltage),
+        SUM(hours) FILTER (
+            WHERE counted AND (pv + prev_pv) / 2 > GREATEST(%(sunshine_min)s, day_peak * %(sunshine_fraction)s)
+        )
+    FROM intervals
+    GROUP BY day, device
+    ORDER BY day, device
+"""
+
+def first_complete_day():
+    """
+    The first day whose raw readings retention hasn't started removing, or
+    None without a retention policy. Earlier days can't be recomputed.
+    """
+    policy = get_policy(SolarControllerData)
+    if not policy:
+        return None
+    return (timezone.now() - policy['keep']).date() + timedelta(days=1)
+
+def max_sample_gap():
+    """Longest interval between readings, in hours, that is integrated"""
+    return getattr(settings, 'SOLAR_MAX_SAMPLE_GAP', 900) / 3600
+
+def day_bounds(start_date, end_date):
+    """Datetime range covering whole local days from start_date to end_date"""
+    start = datetime.combine(start_date, datetime.min.time())
+    end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    if settings.USE_TZ:
+        start, end = timezone.make_aware(start), timezone.make_aware(end)
+    return start, end
+
+def build_daily_aggregates(start_date, end_date):
+    """Unsaved SolarDailyAggregate rows for each day and controller in the range that has readings"""
+    start, end = day_bounds(start_date, end_date)
+    sql = DAILY_SQL.format(
+        table=connection.ops.quote_name(SolarControllerData._meta.db_table),
+        time=connection.ops.quote_name(SolarControllerData._meta.get_field('timestamp').column),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {
+            'start': start,
+            'end': end,
+            'lookback': start - COUNTER_LOOKBACK,
+            'max_gap': max_sample_gap(),
+            'sunshine_min': SUNSHINE_MIN_POWER,
+            'sunshine_fraction': SUNSHINE_PEAK_FRACTION,
+        })
+        rows = cursor.fetchall()
+
+    return [SolarDailyAggregate(date=row[0], device=row[1], **dict(zip(DAILY_FIELDS, row[2:]))) for row in rows]
+
+def recompute_daily_aggregates(start_date, end_date):
+    """
+    Rebuild the daily aggregates for a date range, returning how many rows
+    were written. Days before first_complete_day() would be overwritten with
+    what is left of their readings.
+    """
+    aggregates = build_daily_aggregates(start_date, end_date)
+    SolarDailyAggregate.objects.bulk_create(
+        aggregates,
+        update_conflicts=True,
+        unique_fields=['date', 'device'],
+        update_fields=DAILY_FIELDS + ['updated_at'],
+    )
+    return len(aggregates)
+
+def site_days(daily_aggregates):
+    """
+    Daily aggregates added up over all controllers, as dicts of date,
+    produced, consumed, peak, load_peak and sunshine, newest first. Energy
+    is summed, peaks and sunshine are those of the best controller.
+
+    The peaks are the highest single-controller peaks, not the combined
+    site power: controllers peak at different times and the daily rows
+    don't say when, so adding their peaks up would overstate it.
+    """
+    return daily_aggregates.order_by().values('date').annotate(
+        produced=Sum('energy_produced'),
+        consumed=Sum('energy_consumed'),
+        peak=Max('peak_power'),
+        load_peak=Max('peak_load'),
+        sunshine=Max('sunshine_hours'),
+    ).order_by('-date')
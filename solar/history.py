@@ -0,0 +1,152 @@
+"""
+Downsampling and statistics of the raw solar readings for charts.
+
+Readings are grouped into fixed time buckets in SQL (PostgreSQL's
+date_bin), returning the average, minimum and maximum of each charted
+value per bucket. Minimum and maximum include the envelope of readings
+that summarize several samples. The bucket size is picked from
+BUCKET_SIZES so that a window comes out at roughly the requested number
+of points.
+
+Window statistics, including percentiles, are computed by one aggregate
+query and cached for SOLAR_STATS_CACHE_SECONDS.
+"""
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Aggregate, Avg, Count, DateTimeField, DurationField, F, FloatField, Func, Max, Min, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import SolarControllerData
+from .sampling import ENVELOPE_FIELDS
+
+# Bucket sizes in seconds that charts are downsampled to
+BUCKET_SIZES = [60, 300, 600, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400]
+
+# Points per chart when the client does not ask for a number
+DEFAULT_POINTS = 300
+MAX_POINTS = 2000
+
+# Charted series and the fields they come from
+SERIES = {
+    'pv_power': 'pv_array_power',
+    'battery_voltage': 'battery_voltage',
+    'battery_power': 'battery_charging_power',
+    'load_power': 'load_power',
+}
+
+# Buckets start at local midnight
+BUCKET_ORIGIN = datetime(2000, 1, 1)
+
+class DateBin(Func):
+    """Start of the fixed-size time bucket a timestamp falls in"""
+    function = 'DATE_BIN'
+    output_field = DateTimeField()
+
+    def __init__(self, seconds, expression, **extra):
+        super().__init__(
+            Value(timedelta(seconds=seconds), output_field=DurationField()),
+            expression,
+            Value(BUCKET_ORIGIN, output_field=DateTimeField()),
+            **extra
+        )
+
+class PercentileCont(Aggregate):
+    """Interpolated percentile of a column, fraction between 0 and 1"""
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), output_field=FloatField(), **extra)
+
+# Series reported by the stats endpoint and the percentiles computed for each
+STATS_SERIES = {
+    'pv_power': 'pv_array_power',
+    'battery_voltage': 'battery_voltage',
+    'load_power': 'load_power',
+}
+PERCENTILES = {'p50': 0.5, 'p95': 0.95}
+
+def envelope_bounds(field):
+    """Expressions for the lowest and highest value of each reading, from its envelope if it has one"""
+    if field in ENVELOPE_FIELDS:
+        return Coalesce(f'{field}_min', field), Coalesce(f'{field}_max', field)
+    return F(field), F(field)
+
+def choose_bucket(window, points=DEFAULT_POINTS):
+    """Smallest bucket size in seconds that fits the window into about ``points`` buckets"""
+    target = window.total_seconds() / max(points, 1)
+    for size in BUCKET_SIZES:
+        if size >= target:
+            return size
+    return BUCKET_SIZES[-1]
+
+def downsample(since, bucket, until=None, device=None):
+    """
+    Rows of (bucket start, avg, min, max for each series in SERIES order),
+    newest first, computed with one GROUP BY query. Readings of all
+    controllers are included unless a device is given.
+    """
+    readings = SolarControllerData.objects.filter(timestamp__gte=since)
+    if until is not None:
+        readings = readings.filter(timestamp__lt=until)
+    if device:
+        readings = readings.filter(device=device)
+
+    aggregates = {}
+    for name, field in SERIES.items():
+        lowest, highest = envelope_bounds(field)
+        aggregates[f'{name}_avg'] = Avg(field)
+        aggregates[f'{name}_min'] = Min(lowest)
+        aggregates[f'{name}_max'] = Max(highest)
+
+    return readings.annotate(
+        bucket=DateBin(bucket, 'timestamp')
+    ).values('bucket').annotate(**aggregates).order_by('-bucket').values_list('bucket', *aggregates)
+
+def window_stats(hours, device=None):
+    """
+    Count and max/min/avg/percentiles of each series over the last ``hours``,
+    from one query. Readings of all controllers are included unless a device
+    is given. Returns None if there are no readings in the window.
+    """
+    aggregates = {'count': Count('id')}
+    for name, field in STATS_SERIES.items():
+        lowest, highest = envelope_bounds(field)
+        aggregates[f'{name}_max'] = Max(highest)
+        aggregates[f'{name}_min'] = Min(lowest)
+        aggregates[f'{name}_avg'] = Avg(field)
+        for label, fraction in PERCENTILES.items():
+            aggregates[f'{name}_{label}'] = PercentileCont(field, fraction)
+
+    since = timezone.now() - timedelta(hours=hours)
+    readings = SolarControllerData.objects.filter(timestamp__gte=since)
+    if device:
+        readings = readings.filter(device=device)
+    values = readings.aggregate(**aggregates)
+    if not values['count']:
+        return None
+
+    stats = {"period_hours": hours, "data_point_count": values['count']}
+    for name in STATS_SERIES:
+        stats[name] = {
+            statistic: values[f'{name}_{statistic}']
+            for statistic in ['max', 'min', 'avg', *PERCENTILES]
+        }
+    return stats
+
+def cached_window_stats(hours, device=None):
+    """window_stats() cached per window and device, so repeated dashboard polls don't query"""
+    timeout = getattr(settings, 'SOLAR_STATS_CACHE_SECONDS', 60)
+    if not timeout:
+        return window_stats(hours, device)
+
+    key = f'solar_stats:{hours}:{device or ""}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = window_stats(hours, device)
+        if stats is not None:
+            cache.set(key, stats, timeout)
+    return stats
@@ -0,0 +1,173 @@
+"""
+Storage and broadcasting of solar controller samples.
+
+Shared by the collector and the upload endpoints.
+"""
+
+import logging
+from django.conf import settings as django_settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .models import SolarControllerData, SolarControllerSettings, SolarDirtyDay
+from .accumulator import today
+
+logger = logging.getLogger(__name__)
+
+def store_sample(values):
+    """
+    Save a flat dict of controller values.
+
+    Real-time values become a SolarControllerData row, while rated info and
+    settings are only logged when they change. values may name the 'device'
+    (controller) they came from. The sample is added to today's running
+    totals and its day marked dirty. Returns the saved sample and the
+    settings in effect.
+    """
+    settings_fields = SolarControllerSettings.field_names()
+    sample_values = {name: value for name, value in values.items() if name not in settings_fields}
+
+    with transaction.atomic():
+        sample = SolarControllerData(**sample_values)
+        sample.save()
+        SolarDirtyDay.mark([sample.timestamp])
+        settings = SolarControllerSettings.record(values, timestamp=sample.timestamp, device=sample.device)
+        
+        # The sample is stored either way, the totals can be recomputed from it
+        try:
+            today.add(sample)
+        except Exception as e:
+            logger.error(f"Error updating today's solar energy: {e}")
+    return sample, settings
+
+def flatten_upload(data):
+    """Field values of an uploaded reading, given like read_all_data() output or flat"""
+    values = {}
+    for section in ('controller_info', 'real_time_data', 'settings'):
+        for key, info in data.get(section, {}).items():
+            values[key] = info['value']
+    if not values:
+        values = dict(data)
+    values.pop('timestamp', None)
+    return values
+
+def parse_timestamp(value):
+    """A device timestamp (ISO 8601) in the form the database stores"""
+    moment = parse_datetime(value) if isinstance(value, str) else None
+    if moment is None:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if django_settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    elif not django_settings.USE_TZ and timezone.is_aware(moment):
+        moment = timezone.make_naive(moment)
+    return moment
+
+def lock_devices(devices):
+    """Hold a lock on each device's uploads until the transaction ends"""
+    with connection.cursor() as cursor:
+        for device in sorted(devices):
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"solar-upload:{device}"])
+
+def store_batch(device, readings):
+    """
+    Save many uploaded readings taken on a collector, each with its own timestamp.
+    
+    Readings are stored under the given device unless they name their own
+    (a collector polling several controllers). Readings already stored for
+    the device at the same time are skipped, so a collector can safely
+    upload a batch again. Returns a dict with the counts, per-reading errors
+    and the newest stored sample and its settings.
+    """
+    settings_fields = SolarControllerSettings.field_names()
+    result = {'received': len(readings), 'inserted': 0, 'duplicates': 0, 'errors': [], 'newest': None, 'settings': None}
+    
+    parsed = {}
+    for index, reading in enumerate(readings):
+        try:
+            timestamp = parse_timestamp(reading.get('timestamp'))
+            values = flatten_upload(reading)
+            sample = SolarControllerData(
+                device=values.pop('device', None) or device,
+                timestamp=timestamp,
+                **{name: value for name, value in values.items() if name not in settings_fields}
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            result['errors'].append({'index': index, 'message': str(e)})
+            continue
+        parsed[(timestamp, sample.device)] = (sample, values)
+    
+    if not parsed:
+        return result
+    
+    keys = sorted(parsed)
+    with transaction.atomic():
+        # Uploads for the same devices wait for each other, so the duplicate
+        # check holds and every reading counted as inserted was written
+        lock_devices({device for _, device in keys})
+        existing = set(SolarControllerData.objects.filter(
+            device__in={device for _, device in keys}, timestamp__gte=keys[0][0], timestamp__lte=keys[-1][0]
+        ).values_list('timestamp', 'device'))
+        new = [parsed[key] for key in keys if key not in existing]
+        result['duplicates'] = len(readings) - len(result['errors']) - len(new)
+        if not new:
+            return result
+        
+        SolarControllerData.objects.bulk_create([sample for sample, _ in new], batch_size=1000)
+        # Late readings get their days recomputed, see solar.tasks.aggregate_dirty_days
+        SolarDirtyDay.mark(sample.timestamp for sample, _ in new)
+        for sample, values in new:
+            SolarControllerSettings.record(values, timestamp=sample.timestamp, device=sample.device)
+        
+        try:
+            today.add_many(sample for sample, _ in new)
+        except Exception as e:
+            logger.error(f"Error updating today's solar energy: {e}")
+    
+    result['inserted'] = len(new)
+    result['newest'] = new[-1][0]
+    result['settings'] = SolarControllerSettings.current(result['newest'].device)
+    return result
+
+def live_payload(sample, settings):
+    """The WebSocket message for a sample"""
+    charging_mode = settings.charging_mode if settings is not None else None
+    return {
+        "timestamp": sample.timestamp.isoformat(),
+        "device": sample.device,
+        "pv_array": {
+            "voltage": sample.pv_array_voltage,
+            "current": sample.pv_array_current,
+            "power": sample.pv_array_power
+        },
+        "battery": {
+            "voltage": sample.battery_voltage,
+            "charging_current": sample.battery_charging_current,
+            "charging_power": sample.battery_charging_power,
+            "temperature": sample.battery_temp
+        },
+        "load": {
+            "voltage": sample.load_voltage,
+            "current": sample.load_current,
+            "power": sample.load_power
+        },
+        "controller": {
+            "temperature": sample.controller_temp,
+            # Ensure charging_mode is consistently a string
+            "charging_mode": str(charging_mode) if charging_mode is not None else None
+        },
+        "today": today.summary()
+    }
+
+def broadcast_sample(sample, settings):
+    """Send a sample to all WebSocket clients"""
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        "solar_data",
+        {
+            "type": "solar_update",
+            "data": live_payload(sample, settings)
+        }
+    )
@@ -0,0 +1,186 @@
+"""
+On-disk journal of samples waiting to be uploaded by a remote collector.
+
+Each sample is appended as a JSON line to the open segment file in the
+journal directory. A segment is closed once it holds a batch worth of
+samples and is then uploaded to the batch endpoint as one request; it is
+only deleted after the server accepted it. Samples therefore survive
+network outages and collector restarts, and are uploaded oldest first once
+the server is reachable again. Uploads are idempotent on the server, so a
+segment sent twice (e.g. the response was lost) does no harm.
+
+The collector uploads from a JournalUploader thread, so a slow or
+unreachable server never holds up polling the controllers.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+class RejectedBatch(Exception):
+    """The server refused a batch, sending it again would not help"""
+
+class UploadFailed(Exception):
+    """The upload failed in a way worth retrying later"""
+
+# Client errors that don't mean the batch itself is bad
+RETRY_STATUSES = (408, 429)
+
+def check_response(response):
+    """
+    Raise RejectedBatch if the server refused a batch for good (a 4xx), or
+    UploadFailed if it failed to store it (a 5xx, e.g. its database is down).
+    """
+    if response.status_code < 400:
+        return
+    message = f"{response.status_code}: {response.content[:200].decode(errors='replace')}"
+    if response.status_code < 500 and response.status_code not in RETRY_STATUSES:
+        raise RejectedBatch(message)
+    raise UploadFailed(message)
+
+class SampleJournal:
+    """A directory of newline-delimited JSON segments, uploaded in order"""
+
+    OPEN_SEGMENT = 'current.ndjson'
+
+    def __init__(self, directory, batch_size=60, timeout=10, initial_backoff=5, max_backoff=300, send=None):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.send = send or self._post
+        self._backoff = initial_backoff
+        self._retry_at = 0.0
+        # Appending and closing the open segment may happen while another thread uploads
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._open_count = self._count_lines(self._path(self.OPEN_SEGMENT))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _count_lines(path):
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return sum(1 for line in f if line.strip())
+
+    def append(self, sample):
+        """Add a sample (a JSON-serializable dict with its timestamp) to the journal"""
+        with self._lock:
+            with open(self._path(self.OPEN_SEGMENT), 'a') as f:
+                f.write(json.dumps(sample, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._open_count += 1
+            if self._open_count >= self.batch_size:
+                self._rotate()
+
+    def rotate(self):
+        """Close the open segment so it can be uploaded"""
+        with self._lock:
+            self._rotate()
+
+    def _rotate(self):
+        if not self._open_count:
+            return
+        # Names sort in the order the segments were closed
+        name = f'{time.time_ns():020d}.ndjson'
+        os.replace(self._path(self.OPEN_SEGMENT), self._path(name))
+        self._open_count = 0
+
+    def segments(self):
+        """Closed segments, oldest first"""
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.ndjson') and name != self.OPEN_SEGMENT
+        )
+
+    def pending(self):
+        """Number of samples not yet uploaded"""
+        return sum(self._count_lines(self._path(name)) for name in self.segments()) + self._open_count
+
+    def _read(self, name):
+        readings = []
+        with open(self._path(name)) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    readings.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash mid-write
+                    logger.warning(f"Skipping unreadable line in solar journal segment {name}")
+        return readings
+
+    def _post(self, url, device, readings):
+        response = requests.post(url, json={'device': device, 'readings': readings}, timeout=self.timeout)
+        check_response(response)
+
+    def drain(self, url, device, flush=False):
+        """
+        Upload closed segments, oldest first, deleting each once accepted.
+
+        Stops at the first failure and waits with exponential backoff before
+        trying again. Segments the server rejects are renamed to .rejected.
+        With flush, the open segment is closed first so that
+        everything is sent. Returns the number of samples uploaded.
+        """
+        if time.monotonic() < self._retry_at:
+            return 0
+        if flush:
+            self.rotate()
+
+        uploaded = 0
+        for name in self.segments():
+            readings = self._read(name)
+            if readings:
+                try:
+                    self.send(url, device, readings)
+                except RejectedBatch as e:
+                    # Kept for inspection, but out of the way of the segments after it
+                    logger.error(f"Solar journal segment {name} was rejected: {e}")
+                    os.replace(self._path(name), self._path(name + '.rejected'))
+                    continue
+                except Exception as e:
+                    logger.warning(f"Solar journal upload failed, retrying in {self._backoff}s: {e}")
+                    self._retry_at = time.monotonic() + self._backoff
+                    self._backoff = min(self._backoff * 2, self.max_backoff)
+                    break
+            os.remove(self._path(name))
+            uploaded += len(readings)
+            self._backoff = self.initial_backoff
+        return uploaded
+
+class JournalUploader(threading.Thread):
+    """Drains a journal in the background every interval until stopped"""
+
+    def __init__(self, journal, url, device, interval):
+        super().__init__(name='solar-journal-uploader', daemon=True)
+        self.journal = journal
+        self.url = url
+        self.device = device
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.journal.drain(self.url, self.device)
+            except Exception as e:
+                # E.g. the journal directory went away, try again next interval
+                logger.exception(f"Solar journal upload crashed: {e}")
+
+    def stop(self):
+        """Stop after the upload in progress, if any"""
+        self._stopped.set()
+        self.join()
@@ -1,7 +1,10 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from datetime import datetime, date
-from solar.tasks import calculate_daily_aggregate, calculate_monthly_aggregate, calculate_yearly_aggregate, update_total_aggregate
+from datetime import datetime, date, timedelta
+import time
+from solar.energy import first_complete_day, recompute_daily_aggregates
+from solar.rollup import rebuild_rollups
+from solar.tasks import aggregate_dirty_days, calculate_daily_aggregate, calculate_monthly_aggregate, calculate_yearly_aggregate, update_total_aggregate
 
 class Command(BaseCommand):
     help = 'Aggregate solar data for various time periods'
@@ -45,8 +48,40 @@ class Command(BaseCommand):
             type=int,
             help='Specific year for yearly aggregation',
         )
+        parser.add_argument(
+            '--dirty',
+            action='store_true',
+            help='Recompute the days that received readings since they were aggregated',
+        )
+        parser.add_argument(
+            '--recompute',
+            action='store_true',
+            help='Recompute existing daily aggregates from --start to --end instead of skipping them',
+        )
+        parser.add_argument(
+            '--start',
+            help='First day to recompute (YYYY-MM-DD, default: the first day whose raw data is fully retained)',
+        )
+        parser.add_argument(
+            '--end',
+            help='Last day to recompute (YYYY-MM-DD, default: yesterday)',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Also recompute days whose raw data retention has partly or fully removed',
+        )
     
     def handle(self, *args, **options):
+        if options['recompute']:
+            self._recompute(options)
+            return
+        
+        if options['dirty']:
+            days = aggregate_dirty_days()
+            self.stdout.write(self.style.SUCCESS(f'Recomputed {days} days with late readings, and the days following them'))
+            return
+        
         if options['all']:
             options['daily'] = options['monthly'] = options['yearly'] = options['total'] = True
             
@@ -99,3 +134,32 @@ class Command(BaseCommand):
         if options['total']:
             update_total_aggregate()
             self.stdout.write(self.style.SUCCESS('Total lifetime stats updated'))
+    
+    def _recompute(self, options):
+        yesterday = timezone.now().date() - timedelta(days=1)
+        # Older days only have part of their raw readings left, or none
+        first_complete = first_complete_day() or yesterday - timedelta(days=364)
+        try:
+            start = datetime.strptime(options['start'], '%Y-%m-%d').date() if options['start'] else first_complete
+            end = datetime.strptime(options['end'], '%Y-%m-%d').date() if options['end'] else yesterday
+        except ValueError:
+            raise CommandError('Invalid date format. Use YYYY-MM-DD')
+        
+        if start < first_complete and not options['force']:
+            self.stdout.write(self.style.WARNING(
+                f'Skipping the days before {first_complete}, their raw data was removed (use --force to recompute them anyway)'
+            ))
+            start = first_complete
+        if start > end:
+            raise CommandError(f'Nothing to recompute, no day from {start} to {end} has all its raw data')
+        
+        began = time.monotonic()
+        days = recompute_daily_aggregates(start, end)
+        elapsed = time.monotonic() - began
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed {days} daily aggregates from {start} to {end} in {elapsed:.1f} seconds'
+        ))
+        
+        # Folding can't lower the stats, so they are rebuilt from all daily aggregates
+        months, years = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {months} months, {years} years and the lifetime stats'))
@@ -1,20 +1,29 @@
+import os
+import signal
+import socket
 import time
 import logging
+from datetime import datetime
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from solar.models import SolarControllerData
-from solar.utils import get_solar_data
+from solar.ingest import store_sample
+from solar.journal import JournalUploader, SampleJournal
+from solar.models import SolarController
+from solar.polling import ControllerPoller
+from solar.sampling import IntervalSummary
+from solar.utils import POLL_INTERVALS, SERIAL_PORT, BAUD_RATE, DEVICE_ADDRESS
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    help = 'Collect data from the solar charge controller'
+    help = 'Collect data from the solar charge controllers'
     
     def add_arguments(self, parser):
         parser.add_argument(
             '--interval',
-            type=int,
+            type=float,
             default=300,
-            help='Interval between data collections in seconds (default: 300)',
+            help='Interval between data collections in seconds, fractions allowed (default: 300)',
         )
         parser.add_argument(
             '--count',
@@ -22,37 +31,180 @@ class Command(BaseCommand):
             default=None,
             help='Number of collections to perform (default: run indefinitely)',
         )
+        parser.add_argument(
+            '--sample-interval',
+            type=float,
+            default=None,
+            help='Seconds between controller reads within an interval, the reads are stored as one '
+                 'averaged reading with min/max envelopes (default: one read per interval)',
+        )
+        parser.add_argument(
+            '--info-interval',
+            type=float,
+            default=POLL_INTERVALS['controller_info'],
+            help=f'Seconds between reads of the rated info registers (default: {POLL_INTERVALS["controller_info"]})',
+        )
+        parser.add_argument(
+            '--settings-interval',
+            type=float,
+            default=POLL_INTERVALS['settings'],
+            help=f'Seconds between reads of the settings registers (default: {POLL_INTERVALS["settings"]})',
+        )
+        parser.add_argument(
+            '--report-interval',
+            type=float,
+            default=300,
+            help='Seconds between poll latency and error reports (default: 300)',
+        )
+        parser.add_argument(
+            '--upload-url',
+            default=None,
+            help='Batch upload endpoint of a remote server, e.g. http://server/api/solar/upload/batch/ '
+                 '(default: store locally)',
+        )
+        parser.add_argument(
+            '--device',
+            default=socket.gethostname(),
+            help='Name this collector uploads its readings under (default: the hostname)',
+        )
+        parser.add_argument(
+            '--journal-dir',
+            default=os.path.join(settings.BASE_DIR, 'logs', 'solar_journal'),
+            help='Directory readings are kept in until uploaded (default: logs/solar_journal)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=60,
+            help='Readings per upload request (default: 60)',
+        )
     
     def handle(self, *args, **options):
         interval = options['interval']
         count = options['count']
+        sample_interval = min(options['sample_interval'] or interval, interval)
+        # Reads per stored reading, e.g. every 5 seconds summarized every 60
+        samples = max(1, round(interval / sample_interval))
+        
+        upload_url = options['upload_url']
         
         self.stdout.write(self.style.SUCCESS(f'Starting solar data collection every {interval} seconds'))
+        if samples > 1:
+            self.stdout.write(f'Reading the controllers every {sample_interval} seconds')
+        
+        journal = None
+        uploader = None
+        if upload_url:
+            # Readings are journaled to disk and uploaded in batches, so an outage loses nothing
+            journal = SampleJournal(options['journal_dir'], batch_size=options['batch_size'])
+            self.stdout.write(
+                f'Uploading to {upload_url} as {options["device"]}, {journal.pending()} readings pending'
+            )
+            # Uploads run on their own thread, so a slow server doesn't delay the polls
+            uploader = JournalUploader(journal, upload_url, options['device'], interval)
+            uploader.start()
+        
+        # Every registered controller is polled each cycle, without any the single
+        # controller on the default serial port is, storing its readings as before
+        controllers = list(SolarController.objects.filter(enabled=True))
+        registered = bool(controllers)
+        if not registered:
+            controllers = [SolarController(name='local', serial_port=SERIAL_PORT, baudrate=BAUD_RATE, slave_id=DEVICE_ADDRESS)]
+        else:
+            self.stdout.write(f'Polling {", ".join(controller.name for controller in controllers)}')
         
+        # Connections are kept open for the whole run, and the rated info and
+        # settings are only re-read when their interval has passed
+        poller = ControllerPoller(controllers, poll_intervals={
+            'controller_info': options['info_interval'],
+            'settings': options['settings_interval'],
+        })
+        # SIGHUP re-reads them on the next poll, e.g. after changing controller settings
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: poller.refresh())
         collections = 0
+        polls = 0
+        summaries = {}
+        # Polls are scheduled on fixed deadlines so the time spent polling doesn't add up as drift
+        deadline = time.monotonic()
+        next_report = deadline + options['report_interval']
         try:
             while count is None or collections < count:
-                data = get_solar_data()
+                for name, data in poller.poll().items():
+                    summary = summaries.setdefault(name, IntervalSummary())
+                    if data:
+                        summary.add(data)
+                polls += 1
                 
-                if data:
-                    # Create a new database record
-                    solar_data = SolarControllerData(**data)
-                    solar_data.save()
+                if polls % samples == 0:
+                    # The interval is complete, store one reading per controller
+                    for name, summary in summaries.items():
+                        self._emit(name if registered else None, summary, journal, poller)
+                    summaries = {}
                     
-                    self.stdout.write(self.style.SUCCESS(
-                        f'Collected solar data: {solar_data.pv_array_power}W, {solar_data.battery_voltage}V'
-                    ))
-                else:
-                    self.stdout.write(self.style.WARNING('Failed to collect solar data'))
+                    collections += 1
                 
-                collections += 1
+                if time.monotonic() >= next_report:
+                    self._report(poller)
+                    next_report += options['report_interval']
                 
                 if count is not None and collections >= count:
                     break
-                    
-                time.sleep(interval)
+                
+                deadline += sample_interval
+                now = time.monotonic()
+                if deadline < now:
+                    # The poll overran, skip the missed slots rather than polling back to back
+                    missed = int((now - deadline) // sample_interval) + 1
+                    deadline += missed * sample_interval
+                    logger.warning(f'Solar poll overran the interval, skipped {missed} polls')
+                time.sleep(deadline - now)
                 
         except KeyboardInterrupt:
             self.stdout.write(self.style.SUCCESS('Data collection stopped by user'))
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'Error during data collection: {e}'))
+        finally:
+            self._report(poller)
+            poller.close()
+            if uploader is not None:
+                uploader.stop()
+            if journal is not None:
+                # Send what is left now, anything that fails stays journaled for the next run
+                journal.drain(upload_url, options['device'], flush=True)
+                self.stdout.write(f'{journal.pending()} readings left to upload')
+    
+    def _emit(self, name, summary, journal, poller):
+        """Store or journal the reading summarizing a controller's interval"""
+        label = f'{name}: ' if name else ''
+        if not summary:
+            self.stdout.write(self.style.WARNING(f'Failed to collect solar data{" from " + name if name else ""}'))
+            return
+        
+        data = summary.result()
+        if name:
+            data['device'] = name
+        
+        if journal is not None:
+            # Timestamped here, when the reading was taken, rather than on arrival
+            journal.append({**data, 'timestamp': datetime.now().astimezone().isoformat()})
+        else:
+            # Create a new database record, logging the settings only if they changed
+            store_sample(data)
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Collected solar data: {label}{data.get("pv_array_power")}W, {data.get("battery_voltage")}V '
+            f'in {poller.last_cycle * 1000:.0f}ms'
+        ))
+    
+    def _report(self, poller):
+        for name, stats in poller.stats().items():
+            latency = ''
+            if stats['avg_latency'] is not None:
+                latency = f', latency avg {stats["avg_latency"] * 1000:.0f}ms max {stats["max_latency"] * 1000:.0f}ms'
+            self.stdout.write(
+                f'{name}: polls: {stats["polls"]}, errors: {stats["errors"]}, reconnects: {stats["reconnects"]}{latency}'
+            )
+        if poller.last_cycle is not None:
+            self.stdout.write(f'Last poll cycle took {poller.last_cycle * 1000:.0f}ms')
+        poller.reset_stats()
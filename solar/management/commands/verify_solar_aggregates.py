@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from solar.rollup import rebuild_rollups, verify_rollups
+
+
+class Command(BaseCommand):
+    help = 'Check the monthly, yearly and lifetime solar stats against ones recomputed from the daily aggregates'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Replace the stored stats with the recomputed ones if they differ',
+        )
+
+    def handle(self, *args, **options):
+        differences = verify_rollups()
+        if not differences:
+            self.stdout.write(self.style.SUCCESS('Monthly, yearly and lifetime solar stats match the daily aggregates'))
+            return
+
+        for record, field, stored, rebuilt in differences:
+            self.stdout.write(f'{record} {field}: stored {stored}, recomputed {rebuilt}')
+
+        if options['fix']:
+            months, years = rebuild_rollups()
+            self.stdout.write(self.style.SUCCESS(
+                f'Fixed {len(differences)} differences, rebuilt {months} months, {years} years and the lifetime stats'
+            ))
+        else:
+            raise CommandError(f'{len(differences)} differences found, run with --fix to rebuild the stats')
@@ -1,17 +1,49 @@
+from django.core.cache import cache
 from django.db import models
+from django.utils import timezone
+from django.contrib.postgres.indexes import BrinIndex
 
-class SolarControllerData(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+class SolarController(models.Model):
+    """
+    A charge controller polled by the collector, either on a serial RS-485 bus
+    or through a Modbus TCP gateway. Controllers sharing a bus are told apart
+    by their slave ID.
+    """
+    TRANSPORT_CHOICES = [
+        ('serial', 'Serial (RS-485)'),
+        ('tcp', 'Modbus TCP gateway'),
+    ]
     
-    # Controller info
-    array_rated_voltage = models.FloatField(null=True, blank=True)
-    array_rated_current = models.FloatField(null=True, blank=True)
-    array_rated_power = models.FloatField(null=True, blank=True)
-    battery_rated_voltage = models.FloatField(null=True, blank=True)
-    battery_rated_current = models.FloatField(null=True, blank=True)
-    battery_rated_power = models.FloatField(null=True, blank=True)
-    charging_mode = models.CharField(max_length=20, null=True, blank=True)
-    rated_load_current = models.FloatField(null=True, blank=True)
+    name = models.CharField(max_length=64, unique=True, help_text="Stored as the device of its readings")
+    transport = models.CharField(max_length=10, choices=TRANSPORT_CHOICES, default='serial')
+    serial_port = models.CharField(max_length=100, default='/dev/ttyACM0', blank=True)
+    baudrate = models.IntegerField(default=115200)
+    host = models.CharField(max_length=255, blank=True, help_text="Gateway address for Modbus TCP")
+    tcp_port = models.IntegerField(default=502)
+    slave_id = models.IntegerField(default=1, help_text="Modbus slave/unit ID")
+    enabled = models.BooleanField(default=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def __str__(self):
+        return self.name
+    
+    @property
+    def bus(self):
+        """Controllers on the same bus have to be polled one after another"""
+        if self.transport == 'tcp':
+            return ('tcp', self.host, self.tcp_port)
+        return ('serial', self.serial_port)
+
+class SolarControllerData(models.Model):
+    """Real-time controller readings. Rated info and settings live in SolarControllerSettings."""
+    # Readings uploaded in batches keep the time they were taken on the collector
+    timestamp = models.DateTimeField(default=timezone.now)
+    device = models.CharField(max_length=64, default='local', help_text="Name of the SolarController the reading came from")
     
     # Real-time data
     pv_array_voltage = models.FloatField(null=True, blank=True)
@@ -27,6 +59,78 @@ class SolarControllerData(models.Model):
     controller_temp = models.FloatField(null=True, blank=True)
     heat_sink_temp = models.FloatField(null=True, blank=True)
     
+    # Envelope of the samples a reading summarizes (see solar.sampling), the fields above are their averages
+    pv_array_power_min = models.FloatField(null=True, blank=True)
+    pv_array_power_max = models.FloatField(null=True, blank=True)
+    battery_voltage_min = models.FloatField(null=True, blank=True)
+    battery_voltage_max = models.FloatField(null=True, blank=True)
+    load_power_min = models.FloatField(null=True, blank=True)
+    load_power_max = models.FloatField(null=True, blank=True)
+    sample_count = models.IntegerField(null=True, blank=True, help_text="Samples averaged into this reading")
+    
+    # Status bit fields (0x3200 range)
+    battery_status = models.IntegerField(null=True, blank=True)
+    charging_status = models.IntegerField(null=True, blank=True)
+    discharging_status = models.IntegerField(null=True, blank=True)
+    
+    # The controller's own energy counters. They only go up, unless the controller is reset.
+    energy_generated_total = models.FloatField(null=True, blank=True, help_text="Lifetime energy generated in kWh")
+    energy_consumed_total = models.FloatField(null=True, blank=True, help_text="Lifetime energy consumed in kWh")
+    
+    class Meta:
+        ordering = ['-timestamp']
+        verbose_name = 'Solar Controller Data'
+        verbose_name_plural = 'Solar Controller Data'
+        indexes = [
+            # Latest reading and recent history
+            models.Index(fields=['-timestamp']),
+            # Range scans over the append-only history (aggregation, cleanup)
+            BrinIndex(fields=['timestamp'], autosummarize=True),
+        ]
+        constraints = [
+            # Replayed uploads are deduplicated on this
+            models.UniqueConstraint(fields=['device', 'timestamp'], name='solar_unique_device_timestamp'),
+        ]
+        
+    def __str__(self):
+        return f"Solar data from {self.timestamp}"
+
+def counter_increase(current, previous):
+    """Increase of a monotonic counter between two readings, in the counter's unit"""
+    if current is None or previous is None:
+        return None
+    # A counter that went down was reset, and has counted up from zero since
+    return current - previous if current >= previous else current
+
+def envelope(bound, value):
+    """A reading's min or max envelope value, or its value if it has no envelope"""
+    return bound if bound is not None else value
+
+class SolarControllerSettings(models.Model):
+    """
+    Change log of the controller's rated info and settings.
+    
+    A row is only added when a value changes, and applies to every
+    SolarControllerData reading of the same device from valid_from until the
+    next row.
+    """
+    CACHE_KEY = 'solar_controller_settings'
+    # Seconds other processes may serve the previous settings after a change
+    CACHE_SECONDS = 60
+    
+    valid_from = models.DateTimeField()
+    device = models.CharField(max_length=64, default='local')
+    
+    # Controller info
+    array_rated_voltage = models.FloatField(null=True, blank=True)
+    array_rated_current = models.FloatField(null=True, blank=True)
+    array_rated_power = models.FloatField(null=True, blank=True)
+    battery_rated_voltage = models.FloatField(null=True, blank=True)
+    battery_rated_current = models.FloatField(null=True, blank=True)
+    battery_rated_power = models.FloatField(null=True, blank=True)
+    charging_mode = models.CharField(max_length=20, null=True, blank=True)
+    rated_load_current = models.FloatField(null=True, blank=True)
+    
     # Controller settings
     battery_type = models.CharField(max_length=50, null=True, blank=True)
     battery_capacity = models.IntegerField(null=True, blank=True)
@@ -39,16 +143,70 @@ class SolarControllerData(models.Model):
     low_voltage_disconnect = models.FloatField(null=True, blank=True)
     
     class Meta:
-        ordering = ['-timestamp']
-        verbose_name = 'Solar Controller Data'
-        verbose_name_plural = 'Solar Controller Data'
-        
+        ordering = ['-valid_from']
+        verbose_name = 'Solar Controller Settings'
+        verbose_name_plural = 'Solar Controller Settings'
+        indexes = [
+            models.Index(fields=['device', '-valid_from']),
+        ]
+    
     def __str__(self):
-        return f"Solar data from {self.timestamp}"
+        return f"Solar controller settings of {self.device} from {self.valid_from}"
+    
+    @classmethod
+    def field_names(cls):
+        """Names of the rated info and settings fields"""
+        return [field.name for field in cls._meta.concrete_fields if field.name not in ('id', 'valid_from', 'device')]
+    
+    def values(self):
+        return {name: getattr(self, name) for name in self.field_names()}
+    
+    @classmethod
+    def current(cls, device='local'):
+        """The device's settings in effect now, or None if none were recorded yet"""
+        key = f'{cls.CACHE_KEY}:{device}'
+        settings = cache.get(key)
+        if settings is None:
+            settings = cls.objects.filter(device=device).first()
+            if settings is not None:
+                cache.set(key, settings, cls.CACHE_SECONDS)
+        return settings
+    
+    @classmethod
+    def at(cls, moment, device='local'):
+        """The device's settings in effect at a point in time"""
+        return cls.objects.filter(device=device, valid_from__lte=moment).first()
+    
+    @classmethod
+    def record(cls, values, timestamp=None, device='local'):
+        """
+        Log the rated info and settings in values if any of them changed
+        from those in effect at timestamp, so older readings uploaded late
+        are compared with the settings of their time. Fields missing from
+        values keep their value. Returns the settings now in effect.
+        """
+        moment = timestamp or timezone.now()
+        current = cls.current(device)
+        previous = current if current is None or current.valid_from <= moment else cls.at(moment, device)
+        changed = {
+            name: values[name] for name in cls.field_names()
+            if values.get(name) is not None and (previous is None or getattr(previous, name) != values[name])
+        }
+        if not changed:
+            return current
+        
+        merged = previous.values() if previous is not None else {}
+        merged.update(changed)
+        settings = cls.objects.create(valid_from=moment, device=device, **merged)
+        if current is not None and current.valid_from > moment:
+            return current
+        cache.set(f'{cls.CACHE_KEY}:{device}', settings, cls.CACHE_SECONDS)
+        return settings
 
 class SolarDailyAggregate(models.Model):
-    """Daily aggregated solar data"""
-    date = models.DateField(unique=True)
+    """Daily aggregated solar data of one controller"""
+    date = models.DateField()
+    device = models.CharField(max_length=64, default='local')
     
     # Energy produced
     energy_produced = models.FloatField(default=0.0, help_text="Daily energy produced in Wh")
@@ -70,12 +228,158 @@ class SolarDailyAggregate(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
-        ordering = ['-date']
+        ordering = ['-date', 'device']
         verbose_name = "Solar Daily Aggregate"
         verbose_name_plural = "Solar Daily Aggregates"
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'device'], name='solar_unique_daily_device'),
+        ]
         
     def __str__(self):
-        return f"Solar data for {self.date}"
+        return f"Solar data of {self.device} for {self.date}"
+
+class SolarEnergyAccumulator(models.Model):
+    """
+    Running energy totals for one day, updated sample by sample.
+    
+    Kept by solar.accumulator in the transactions storing the samples, which
+    rolls it into a SolarDailyAggregate once the day is over. There is one
+    per controller.
+    """
+    date = models.DateField()
+    device = models.CharField(max_length=64, default='local')
+    energy_produced = models.FloatField(default=0.0, help_text="Energy produced so far in Wh")
+    energy_consumed = models.FloatField(default=0.0, help_text="Energy consumed so far in Wh")
+    peak_power = models.FloatField(default=0.0)
+    peak_load = models.FloatField(default=0.0)
+    sunshine_seconds = models.FloatField(default=0.0)
+    min_battery_voltage = models.FloatField(null=True, blank=True)
+    max_battery_voltage = models.FloatField(null=True, blank=True)
+    battery_voltage_sum = models.FloatField(default=0.0)
+    battery_samples = models.IntegerField(default=0)
+    sample_count = models.IntegerField(default=0)
+    
+    # The previous sample, to integrate the interval up to the next one
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_pv_power = models.FloatField(null=True, blank=True)
+    last_load_power = models.FloatField(null=True, blank=True)
+    last_energy_generated = models.FloatField(null=True, blank=True)
+    last_energy_consumed = models.FloatField(null=True, blank=True)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date', 'device']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'device'], name='solar_unique_accumulator_device'),
+        ]
+    
+    def __str__(self):
+        return f"Solar energy of {self.device} so far on {self.date}"
+    
+    def add_sample(self, sample, max_gap, sunshine_min_power, sunshine_peak_fraction):
+        """
+        Fold a sample into the totals. The energy of the interval since the
+        previous sample is the increase of the controller's energy counters.
+        Without counters, power is integrated by the trapezoidal rule, unless
+        the interval is longer than max_gap seconds.
+        """
+        generated = counter_increase(sample.energy_generated_total, self.last_energy_generated)
+        consumed = counter_increase(sample.energy_consumed_total, self.last_energy_consumed)
+        if generated is not None:
+            self.energy_produced += generated * 1000
+        if consumed is not None:
+            self.energy_consumed += consumed * 1000
+        
+        if self.last_timestamp is not None:
+            seconds = (sample.timestamp - self.last_timestamp).total_seconds()
+            if 0 < seconds <= max_gap:
+                if sample.pv_array_power is not None and self.last_pv_power is not None:
+                    average = (sample.pv_array_power + self.last_pv_power) / 2
+                    if generated is None:
+                        self.energy_produced += average * seconds / 3600
+                    if average > max(sunshine_min_power, self.peak_power * sunshine_peak_fraction):
+                        self.sunshine_seconds += seconds
+                if consumed is None and sample.load_power is not None and self.last_load_power is not None:
+                    self.energy_consumed += (sample.load_power + self.last_load_power) / 2 * seconds / 3600
+        
+        # Peaks come from the envelope when the sample summarizes several
+        peak_power = envelope(sample.pv_array_power_max, sample.pv_array_power)
+        if peak_power is not None:
+            self.peak_power = max(self.peak_power, peak_power)
+        peak_load = envelope(sample.load_power_max, sample.load_power)
+        if peak_load is not None:
+            self.peak_load = max(self.peak_load, peak_load)
+        if sample.battery_voltage is not None:
+            min_voltage = envelope(sample.battery_voltage_min, sample.battery_voltage)
+            max_voltage = envelope(sample.battery_voltage_max, sample.battery_voltage)
+            self.min_battery_voltage = min(self.min_battery_voltage, min_voltage) if self.min_battery_voltage is not None else min_voltage
+            self.max_battery_voltage = max(self.max_battery_voltage, max_voltage) if self.max_battery_voltage is not None else max_voltage
+            self.battery_voltage_sum += sample.battery_voltage
+            self.battery_samples += 1
+        
+        self.sample_count += 1
+        self.last_timestamp = sample.timestamp
+        self.last_pv_power = sample.pv_array_power
+        self.last_load_power = sample.load_power
+        if sample.energy_generated_total is not None:
+            self.last_energy_generated = sample.energy_generated_total
+        if sample.energy_consumed_total is not None:
+            self.last_energy_consumed = sample.energy_consumed_total
+    
+    @property
+    def avg_battery_voltage(self):
+        if self.battery_samples:
+            return self.battery_voltage_sum / self.battery_samples
+        return None
+    
+    @property
+    def sunshine_hours(self):
+        return self.sunshine_seconds / 3600
+    
+    def to_daily_aggregate(self):
+        """An unsaved SolarDailyAggregate with the day's totals"""
+        return SolarDailyAggregate(
+            date=self.date,
+            device=self.device,
+            energy_produced=self.energy_produced,
+            energy_consumed=self.energy_consumed,
+            peak_power=self.peak_power,
+            peak_load=self.peak_load,
+            min_battery_voltage=self.min_battery_voltage,
+            max_battery_voltage=self.max_battery_voltage,
+            avg_battery_voltage=self.avg_battery_voltage,
+            sunshine_hours=self.sunshine_hours if self.sunshine_seconds else None,
+        )
+
+class SolarDirtyDay(models.Model):
+    """
+    A day that received solar readings since its daily aggregate was computed.
+    
+    Marked on every insert, and cleared by solar.tasks.aggregate_dirty_days
+    once the day, its month, year and the lifetime stats are recomputed.
+    """
+    date = models.DateField(unique=True)
+    marked_at = models.DateTimeField(default=timezone.now, help_text="Last time readings for the day were stored")
+    
+    class Meta:
+        ordering = ['date']
+    
+    def __str__(self):
+        return f"Solar data changed on {self.date}"
+    
+    @classmethod
+    def mark(cls, timestamps):
+        """Mark the local days of the given reading timestamps"""
+        days = {timezone.localtime(moment).date() if timezone.is_aware(moment) else moment.date() for moment in timestamps}
+        now = timezone.now()
+        # A newer mark keeps a day dirty even while a worker is recomputing it
+        cls.objects.bulk_create(
+            [cls(date=day, marked_at=now) for day in sorted(days)],
+            update_conflicts=True,
+            unique_fields=['date'],
+            update_fields=['marked_at'],
+        )
 
 class SolarMonthlyAggregate(models.Model):
     """Monthly aggregated solar data"""
@@ -150,6 +454,8 @@ class SolarTotalAggregate(models.Model):
     best_month_ever = models.CharField(max_length=7, null=True, blank=True, help_text="Format: YYYY-MM")
     best_month_production = models.FloatField(default=0.0, help_text="Best monthly production in kWh")
     
+    first_day = models.DateField(null=True, blank=True, help_text="First day with a daily aggregate")
+    last_day = models.DateField(null=True, blank=True, help_text="Last day with a daily aggregate")
     operational_days = models.IntegerField(default=0, help_text="Number of days the system has been operational")
     
     updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,99 @@
+"""
+Polling several charge controllers in one cycle.
+
+Controllers on the same bus (a serial RS-485 port, or a Modbus TCP gateway)
+share one connection and are polled one after another, since a Modbus bus
+carries one request at a time. Separate buses are polled concurrently, each
+from its own thread, so a cycle takes about as long as the slowest bus
+rather than the sum of all of them.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import ControllerSession, connect_to_controller, connect_to_gateway
+
+logger = logging.getLogger(__name__)
+
+class SharedConnection:
+    """
+    One connection to a bus, opened on demand and handed to every session on it.
+    Sessions only close it when the transport failed, see ControllerSession.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.client = None
+        self.users = 0
+
+    def __call__(self):
+        if self.client is None or not getattr(self.client, 'connected', True):
+            self.client = self._connect()
+        return self.client
+
+def bus_connector(controller):
+    """A function opening the bus a SolarController is on"""
+    if controller.transport == 'tcp':
+        return lambda: connect_to_gateway(controller.host, controller.tcp_port)
+    return lambda: connect_to_controller(controller.serial_port, controller.baudrate)
+
+class ControllerPoller:
+    """
+    Polls every given SolarController once per cycle, buses in parallel.
+
+    Each controller gets its own ControllerSession, so tiered section
+    intervals, backoff and statistics are kept per controller.
+    """
+
+    def __init__(self, controllers, connector=bus_connector, **session_options):
+        self.buses = {}
+        for controller in controllers:
+            entries = self.buses.setdefault(controller.bus, [])
+            connection = entries[0][1].connect if entries else SharedConnection(connector(controller))
+            connection.users += 1
+            entries.append((controller, ControllerSession(connect=connection, slave=controller.slave_id, **session_options)))
+        self._executor = ThreadPoolExecutor(max_workers=len(self.buses)) if len(self.buses) > 1 else None
+        self.last_cycle = None
+
+    @classmethod
+    def from_registry(cls, **kwargs):
+        """A poller for every enabled SolarController"""
+        from .models import SolarController
+        return cls(list(SolarController.objects.filter(enabled=True)), **kwargs)
+
+    @property
+    def sessions(self):
+        return {controller.name: session for entries in self.buses.values() for controller, session in entries}
+
+    @staticmethod
+    def _poll_bus(entries):
+        return [(controller.name, session.poll()) for controller, session in entries]
+
+    def poll(self):
+        """Poll every controller, returning {name: field values or None}"""
+        started = time.monotonic()
+        if self._executor is None:
+            results = [self._poll_bus(entries) for entries in self.buses.values()]
+        else:
+            results = list(self._executor.map(self._poll_bus, self.buses.values()))
+        self.last_cycle = time.monotonic() - started
+        return {name: data for bus_results in results for name, data in bus_results}
+
+    def refresh(self, section=None):
+        for session in self.sessions.values():
+            session.refresh(section)
+
+    def stats(self):
+        """Poll counters and latencies of each controller, see ControllerSession.stats()"""
+        return {name: session.stats() for name, session in self.sessions.items()}
+
+    def reset_stats(self):
+        for session in self.sessions.values():
+            session.reset_stats()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,295 @@
+"""
+Monthly, yearly and lifetime solar statistics, kept up to date incrementally.
+
+Each new daily aggregate is folded into its month, its year and the lifetime
+record in one transaction: its energy is added, and its peak and its day's
+production are compared against the stored maxima and best days/months.
+Nothing is summed again, so the nightly aggregation takes the same time
+however long the history grows. A month, year or lifetime record that does
+not exist yet is built from the daily aggregates instead (which by then
+include the new day).
+
+Folding can only raise maxima, so days that were recomputed (see
+solar.tasks.aggregate_dirty_days) go through refresh_rollups() instead,
+which rebuilds just their months and years and then the lifetime stats from
+the monthly and yearly records. rebuild_rollups() rebuilds everything from
+scratch, verify_rollups() does so without saving and lists where the stored
+records differ.
+"""
+
+import math
+
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+
+from .models import SolarDailyAggregate, SolarMonthlyAggregate, SolarYearlyAggregate, SolarTotalAggregate
+from .energy import site_days
+
+# The fields each record is built from the daily aggregates, other fields are left alone
+MONTH_FIELDS = [
+    'energy_produced', 'energy_consumed', 'peak_power',
+    'avg_daily_production', 'production_days', 'best_day', 'best_day_production',
+]
+YEAR_FIELDS = [
+    'energy_produced', 'energy_consumed', 'peak_power',
+    'best_month', 'best_month_production', 'avg_monthly_production',
+]
+TOTAL_FIELDS = [
+    'total_energy_produced', 'total_energy_consumed', 'peak_power_ever', 'peak_power_date',
+    'best_day_ever', 'best_day_production', 'best_month_ever', 'best_month_production',
+    'first_day', 'last_day', 'operational_days',
+]
+
+def _fold_month(month, day, produced, consumed, peak, site_before, site_after):
+    """Add a day's energy (Wh) to a month, site_before/after being the day's production over all controllers"""
+    month.energy_produced += produced / 1000  # Convert Wh to kWh
+    month.energy_consumed += consumed / 1000
+    month.peak_power = max(month.peak_power, peak)
+    if site_before <= 0 < site_after:
+        month.production_days += 1
+    if month.production_days:
+        month.avg_daily_production = month.energy_produced / month.production_days
+    if month.best_day is None or month.best_day == day or site_after / 1000 > month.best_day_production:
+        month.best_day = day
+        month.best_day_production = site_after / 1000
+
+def _fold_year(year, month, produced, consumed, peak):
+    """Add a day's energy (Wh) to a year, month being its already updated month"""
+    year.energy_produced += produced / 1000
+    year.energy_consumed += consumed / 1000
+    year.peak_power = max(year.peak_power, peak)
+    if year.best_month is None or year.best_month == month.month or month.energy_produced > year.best_month_production:
+        year.best_month = month.month
+        year.best_month_production = month.energy_produced
+
+def _fold_total(total, month, day, produced, consumed, peak, site_after):
+    """Add a day's energy (Wh) to the lifetime record, month being its already updated month"""
+    total.total_energy_produced += produced / 1000
+    total.total_energy_consumed += consumed / 1000
+    if total.peak_power_date is None or peak > total.peak_power_ever:
+        total.peak_power_ever = peak
+        total.peak_power_date = day
+    if total.best_day_ever is None or total.best_day_ever == day or site_after / 1000 > total.best_day_production:
+        total.best_day_ever = day
+        total.best_day_production = site_after / 1000
+    label = f"{month.year}-{month.month:02d}"
+    if total.best_month_ever is None or total.best_month_ever == label or month.energy_produced > total.best_month_production:
+        total.best_month_ever = label
+        total.best_month_production = month.energy_produced
+    total.first_day = min(total.first_day or day, day)
+    total.last_day = max(total.last_day or day, day)
+    total.operational_days = (total.last_day - total.first_day).days + 1
+
+def build_rollups(daily_aggregates=None):
+    """
+    Unsaved month, year and lifetime records built from scratch from daily
+    aggregates (default: all of them), as ({(year, month): month}, {year: year}, total).
+    """
+    if daily_aggregates is None:
+        daily_aggregates = SolarDailyAggregate.objects.all()
+    months, years = {}, {}
+    total = SolarTotalAggregate()
+    # Oldest first, so ties keep the earliest day or month as folding does
+    for day in reversed(list(site_days(daily_aggregates))):
+        date = day['date']
+        month = months.get((date.year, date.month))
+        if month is None:
+            month = months[date.year, date.month] = SolarMonthlyAggregate(year=date.year, month=date.month)
+        year = years.get(date.year)
+        if year is None:
+            year = years[date.year] = SolarYearlyAggregate(year=date.year)
+        produced, consumed, peak = day['produced'] or 0, day['consumed'] or 0, day['peak'] or 0
+        _fold_month(month, date, produced, consumed, peak, 0, produced)
+        _fold_year(year, month, produced, consumed, peak)
+        _fold_total(total, month, date, produced, consumed, peak, produced)
+
+    for year in years.values():
+        active_months = sum(1 for month_year, _ in months if month_year == year.year)
+        year.avg_monthly_production = year.energy_produced / active_months
+    return months, years, total
+
+def _replace(record, built, fields):
+    for name in fields:
+        setattr(record, name, getattr(built, name))
+
+def _locked(model, **lookup):
+    """The record for lookup, locked until the transaction ends, and whether it was just created"""
+    return model.objects.select_for_update().get_or_create(**lookup)
+
+def fold_daily(aggregates):
+    """
+    Fold newly saved SolarDailyAggregate rows into their months, years and
+    the lifetime record, in one transaction. Each row must be folded once.
+    """
+    by_date = {}
+    for aggregate in aggregates:
+        by_date.setdefault(aggregate.date, []).append(aggregate)
+    if not by_date:
+        return
+
+    with transaction.atomic():
+        # Locked first by every fold, so concurrent folds take turns
+        total, total_created = _locked(SolarTotalAggregate, id=1)
+        if total_created:
+            _replace(total, build_rollups()[2], TOTAL_FIELDS)
+
+        for day, rows in sorted(by_date.items()):
+            month, month_created = _locked(SolarMonthlyAggregate, year=day.year, month=day.month)
+            year, year_created = _locked(SolarYearlyAggregate, year=day.year)
+            produced = sum(row.energy_produced for row in rows)
+            consumed = sum(row.energy_consumed for row in rows)
+            peak = max(row.peak_power for row in rows)
+            # The day's production over all controllers, including the new rows
+            site_after = SolarDailyAggregate.objects.filter(date=day).aggregate(total=Sum('energy_produced'))['total'] or 0
+
+            if month_created:
+                built = build_rollups(SolarDailyAggregate.objects.filter(date__year=day.year, date__month=day.month))[0]
+                _replace(month, built[day.year, day.month], MONTH_FIELDS)
+            else:
+                _fold_month(month, day, produced, consumed, peak, site_after - produced, site_after)
+            month.save()
+
+            if year_created:
+                built = build_rollups(SolarDailyAggregate.objects.filter(date__year=day.year))[1]
+                _replace(year, built[day.year], YEAR_FIELDS)
+            else:
+                _fold_year(year, month, produced, consumed, peak)
+                year.avg_monthly_production = year.energy_produced / SolarMonthlyAggregate.objects.filter(year=day.year).count()
+            year.save()
+
+            if not total_created:
+                _fold_total(total, month, day, produced, consumed, peak, site_after)
+
+        if not total.system_install_date:
+            total.system_install_date = total.first_day
+        total.save()
+
+def add_daily_aggregates(aggregates):
+    """Save new SolarDailyAggregate rows and fold them into the rollups in one transaction"""
+    with transaction.atomic():
+        SolarDailyAggregate.objects.bulk_create(aggregates)
+        fold_daily(aggregates)
+
+def _year_from_months(year, months):
+    """Set a year's stats from its monthly records, given oldest first"""
+    year.energy_produced = sum(month.energy_produced for month in months)
+    year.energy_consumed = sum(month.energy_consumed for month in months)
+    year.peak_power = max(month.peak_power for month in months)
+    best = None
+    for month in months:
+        if best is None or month.energy_produced > best.energy_produced:
+            best = month
+    year.best_month = best.month
+    year.best_month_production = best.energy_produced
+    year.avg_monthly_production = year.energy_produced / len(months)
+
+def _total_from_rollups(total):
+    """Set the lifetime stats from the monthly and yearly records, without reading the daily history"""
+    years = list(SolarYearlyAggregate.objects.order_by('year'))
+    months = list(SolarMonthlyAggregate.objects.order_by('year', 'month'))
+    total.total_energy_produced = sum(year.energy_produced for year in years)
+    total.total_energy_consumed = sum(year.energy_consumed for year in years)
+
+    peak_year = best_day_month = best_month = None
+    for year in years:
+        if peak_year is None or year.peak_power > peak_year.peak_power:
+            peak_year = year
+    for month in months:
+        if best_day_month is None or month.best_day_production > best_day_month.best_day_production:
+            best_day_month = month
+        if best_month is None or month.energy_produced > best_month.energy_produced:
+            best_month = month
+
+    total.peak_power_ever = peak_year.peak_power if peak_year else 0.0
+    # Only the peak's year has to be searched for its date
+    total.peak_power_date = SolarDailyAggregate.objects.filter(
+        date__year=peak_year.year, peak_power=peak_year.peak_power,
+    ).order_by('date').values_list('date', flat=True).first() if peak_year else None
+    total.best_day_ever = best_day_month.best_day if best_day_month else None
+    total.best_day_production = best_day_month.best_day_production if best_day_month else 0.0
+    total.best_month_ever = f"{best_month.year}-{best_month.month:02d}" if best_month else None
+    total.best_month_production = best_month.energy_produced if best_month else 0.0
+
+    bounds = SolarDailyAggregate.objects.aggregate(first=Min('date'), last=Max('date'))
+    total.first_day, total.last_day = bounds['first'], bounds['last']
+    total.operational_days = (total.last_day - total.first_day).days + 1 if total.first_day else 0
+    if not total.system_install_date:
+        total.system_install_date = total.first_day
+
+def refresh_rollups(dates):
+    """
+    Rebuild the months and years of days whose daily aggregates were
+    recomputed, then the lifetime stats from the monthly and yearly records.
+    Only the daily aggregates of those months are read, so the cost follows
+    the changed days rather than the length of the history.
+    """
+    month_keys = sorted({(day.year, day.month) for day in dates})
+    with transaction.atomic():
+        # Locked first as in fold_daily
+        total, _ = _locked(SolarTotalAggregate, id=1)
+
+        for year, month_number in month_keys:
+            months = build_rollups(SolarDailyAggregate.objects.filter(date__year=year, date__month=month_number))[0]
+            if not months:
+                SolarMonthlyAggregate.objects.filter(year=year, month=month_number).delete()
+                continue
+            month, _ = _locked(SolarMonthlyAggregate, year=year, month=month_number)
+            _replace(month, months[year, month_number], MONTH_FIELDS)
+            month.save()
+
+        for year_number in sorted({year for year, _ in month_keys}):
+            months = list(SolarMonthlyAggregate.objects.filter(year=year_number).order_by('month'))
+            if not months:
+                SolarYearlyAggregate.objects.filter(year=year_number).delete()
+                continue
+            year, _ = _locked(SolarYearlyAggregate, year=year_number)
+            _year_from_months(year, months)
+            year.save()
+
+        _total_from_rollups(total)
+        total.save()
+
+def _differs(stored, rebuilt):
+    if isinstance(stored, float) and isinstance(rebuilt, float):
+        return not math.isclose(stored, rebuilt, rel_tol=1e-9, abs_tol=1e-6)
+    return stored != rebuilt
+
+def verify_rollups():
+    """
+    Rebuild the rollups from the daily aggregates without saving and compare
+    them with the stored ones. Returns (record, field, stored, rebuilt)
+    tuples for every difference, a missing record has None for its values.
+    """
+    months, years, total = build_rollups()
+    pairs = []
+    stored_months = {(month.year, month.month): month for month in SolarMonthlyAggregate.objects.all()}
+    for key in sorted(set(months) | set(stored_months)):
+        pairs.append((f"{key[0]}-{key[1]:02d}", stored_months.get(key), months.get(key), MONTH_FIELDS))
+    stored_years = {year.year: year for year in SolarYearlyAggregate.objects.all()}
+    for key in sorted(set(years) | set(stored_years)):
+        pairs.append((str(key), stored_years.get(key), years.get(key), YEAR_FIELDS))
+    pairs.append(('lifetime', SolarTotalAggregate.objects.filter(id=1).first(), total if months else None, TOTAL_FIELDS))
+
+    differences = []
+    for label, stored, rebuilt, fields in pairs:
+        for name in fields:
+            stored_value = getattr(stored, name) if stored else None
+            rebuilt_value = getattr(rebuilt, name) if rebuilt else None
+            if _differs(stored_value, rebuilt_value):
+                differences.append((label, name, stored_value, rebuilt_value))
+    return differences
+
+def rebuild_rollups():
+    """Rebuild every month, year and the lifetime record from the daily aggregates"""
+    months, years, total = build_rollups()
+    with transaction.atomic():
+        stored, _ = _locked(SolarTotalAggregate, id=1)
+        SolarMonthlyAggregate.objects.all().delete()
+        SolarYearlyAggregate.objects.all().delete()
+        SolarMonthlyAggregate.objects.bulk_create(months.values())
+        SolarYearlyAggregate.objects.bulk_create(years.values())
+        _replace(stored, total, TOTAL_FIELDS)
+        if not stored.system_install_date:
+            stored.system_install_date = stored.first_day
+        stored.save()
+    return len(months), len(years)
@@ -0,0 +1,59 @@
+"""
+Summarizing high-rate controller samples into one reading per interval.
+
+The collector can poll every few seconds but store one SolarControllerData
+row per interval. Analog real-time values are averaged over the interval,
+and the charted ones also keep their minimum and maximum, so short power
+spikes and load surges still show in peaks. Everything else (status
+registers, energy counters, rated info and settings) keeps its last value.
+"""
+
+# Values averaged over the interval
+AVERAGED_FIELDS = [
+    'pv_array_voltage', 'pv_array_current', 'pv_array_power',
+    'battery_voltage', 'battery_charging_current', 'battery_charging_power',
+    'load_voltage', 'load_current', 'load_power',
+    'battery_temp', 'controller_temp', 'heat_sink_temp',
+]
+
+# Values that also keep a min/max envelope, stored as <field>_min and <field>_max
+ENVELOPE_FIELDS = ['pv_array_power', 'battery_voltage', 'load_power']
+
+class IntervalSummary:
+    """The samples of one controller over one interval"""
+
+    def __init__(self):
+        self.count = 0
+        self._sums = {}
+        self._counts = {}
+        self._minimums = {}
+        self._maximums = {}
+        self._last = {}
+
+    def __bool__(self):
+        return self.count > 0
+
+    def add(self, values):
+        """Add a sample (field values as returned by ControllerSession.poll())"""
+        self.count += 1
+        for name, value in values.items():
+            self._last[name] = value
+            if name not in AVERAGED_FIELDS or value is None:
+                continue
+            self._sums[name] = self._sums.get(name, 0.0) + value
+            self._counts[name] = self._counts.get(name, 0) + 1
+            if name in ENVELOPE_FIELDS:
+                self._minimums[name] = min(self._minimums.get(name, value), value)
+                self._maximums[name] = max(self._maximums.get(name, value), value)
+
+    def result(self):
+        """Field values for one reading covering the interval"""
+        values = dict(self._last)
+        for name, total in self._sums.items():
+            values[name] = total / self._counts[name]
+        for name in ENVELOPE_FIELDS:
+            if name in self._minimums:
+                values[f'{name}_min'] = self._minimums[name]
+                values[f'{name}_max'] = self._maximums[name]
+        values['sample_count'] = self.count
+        return values
@@ -1,3 +1,1123 @@
+import asyncio
+import os
+import tempfile
+import threading
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
+from django.urls import reverse
+from unittest import mock
+from django.db.models import DurationField, ExpressionWrapper, F, Value
+from django.utils import timezone
+from datetime import date, datetime, timedelta
+from wyandata.testing import QueryPlanTestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from io import StringIO
+from .models import (
+    SolarController, SolarControllerData, SolarControllerSettings, SolarDailyAggregate, SolarEnergyAccumulator,
+    SolarDirtyDay, SolarMonthlyAggregate, SolarYearlyAggregate, SolarTotalAggregate,
+)
+from .ingest import store_sample, store_batch, live_payload
+from .journal import JournalUploader, RejectedBatch, SampleJournal, check_response
+from .energy import build_daily_aggregates, recompute_daily_aggregates, site_days
+from .tasks import aggregate_dirty_days, calculate_daily_aggregate, prepare_cleanup
+from .rollup import add_daily_aggregates, verify_rollups
+from .accumulator import TodayAccumulator
+from .history import choose_bucket, downsample, window_stats
+from .views import SolarDataViewSet
+from .utils import INPUT_REGISTERS, HOLDING_REGISTERS, READ_PLAN, read_all_data, ControllerSession
+from .polling import ControllerPoller, SharedConnection
+from .sampling import IntervalSummary
 
-# Create your tests here.
+class QueryPlanTests(QueryPlanTestCase):
+    """Hot solar queries must be served from an index"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        SolarControllerData.objects.bulk_create([SolarControllerData() for _ in range(cls.SEED_ROWS)], batch_size=5000)
+        # timestamp is auto_now_add, so spread the rows a minute apart afterwards
+        cls.now = timezone.now()
+        SolarControllerData.objects.update(
+            timestamp=Value(cls.now) - ExpressionWrapper(F('id') * Value(timedelta(minutes=1)), output_field=DurationField())
+        )
+        cls.analyze(SolarControllerData)
+        
+    def test_latest_reading(self):
+        self.assertNoSeqScan(SolarControllerData.objects.order_by('-timestamp')[:1])
+        
+    def test_recent_history(self):
+        since = timezone.now() - timedelta(hours=24)
+        self.assertNoSeqScan(SolarControllerData.objects.filter(timestamp__gte=since).order_by('-timestamp'))
+        
+    def test_cleanup_range(self):
+        # An hourly cleanup removes about an hour of the oldest rows
+        oldest = SolarControllerData.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+        self.assertNoSeqScan(SolarControllerData.objects.filter(timestamp__lt=oldest + timedelta(hours=1)))
+
+class FakeResponse:
+    def __init__(self, registers):
+        self.registers = registers
+
+class FakeController:
+    """Answers register reads with each register's address, optionally failing some reads first or some slaves always"""
+    
+    def __init__(self, failures=None, missing_slaves=()):
+        self.failures = dict(failures or {})
+        self.missing_slaves = set(missing_slaves)
+        self.reads = []
+        self.slaves = []
+        
+    def _read(self, address, count, slave):
+        self.reads.append((address, count))
+        self.slaves.append(slave)
+        if slave in self.missing_slaves:
+            raise TimeoutError('No response')
+        if self.failures.get(address):
+            self.failures[address] -= 1
+            raise TimeoutError('No response')
+        return FakeResponse([(address + offset) & 0xFF for offset in range(count)])
+        
+    read_input_registers = _read
+    read_holding_registers = _read
+    
+    def close(self):
+        self.closed = True
+
+class ReadPlanTests(TestCase):
+    def test_blocks(self):
+        """Test that contiguous registers are coalesced into five block reads"""
+        self.assertEqual(
+            [(block.section, block.start, block.count) for block in READ_PLAN],
+            [
+                ('controller_info', 0x3000, 15),
+                ('real_time_data', 0x3100, 19),
+                ('real_time_data', 0x3200, 3),
+                ('real_time_data', 0x330A, 10),
+                ('settings', 0x9000, 14),
+            ]
+        )
+        
+    def test_read_all_data(self):
+        """Test that every field is decoded from the block reads"""
+        client = FakeController()
+        data = read_all_data(client)
+        
+        self.assertEqual(len(client.reads), 5)
+        self.assertEqual(
+            len(data['controller_info']) + len(data['real_time_data']) + len(data['settings']),
+            len(INPUT_REGISTERS) + len(HOLDING_REGISTERS)
+        )
+        self.assertEqual(data['real_time_data']['battery_voltage'], {'value': 0.04, 'unit': 'V'})
+        self.assertEqual(data['controller_info']['charging_mode']['value'], 8)
+        self.assertEqual(data['settings']['battery_capacity']['value'], 1)
+        self.assertEqual(data['settings']['battery_type']['value'], 'User Defined')
+        # Low word 0x12, high word 0x13
+        self.assertEqual(data['real_time_data']['energy_generated_total'], {'value': 0x130012 / 100, 'unit': 'kWh'})
+        
+    def test_retries_failed_block(self):
+        """Test that only the block that failed is read again"""
+        client = FakeController(failures={0x3100: 1})
+        data = read_all_data(client)
+        
+        self.assertEqual([address for address, _ in client.reads], [0x3000, 0x3100, 0x3100, 0x3200, 0x330A, 0x9000])
+        self.assertIn('pv_array_power', data['real_time_data'])
+        
+    def test_block_gives_up(self):
+        """Test that a block that keeps failing leaves only its own fields out"""
+        client = FakeController(failures={0x9000: 10})
+        data = read_all_data(client)
+        
+        self.assertEqual(data['settings'], {})
+        self.assertEqual(len(data['real_time_data']), 17)
+
+class ControllerSessionTests(TestCase):
+    def test_keeps_connection_open(self):
+        """Test that polls reuse one connection"""
+        clients = []
+        def connect():
+            clients.append(FakeController())
+            return clients[-1]
+        session = ControllerSession(connect=connect)
+        
+        for _ in range(3):
+            self.assertEqual(session.poll()['battery_voltage'], 0.04)
+        
+        self.assertEqual(len(clients), 1)
+        stats = session.stats()
+        self.assertEqual((stats['polls'], stats['errors'], stats['reconnects']), (3, 0, 0))
+        self.assertIsNotNone(stats['avg_latency'])
+        
+    def test_backoff(self):
+        """Test that a missing controller is retried with growing delays"""
+        attempts = []
+        session = ControllerSession(connect=lambda: attempts.append(1), initial_backoff=30)
+        
+        self.assertIsNone(session.poll())
+        self.assertIsNone(session.poll())
+        
+        # The second poll falls inside the backoff, so no connection is attempted
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(session.stats()['errors'], 2)
+        self.assertEqual(session._backoff, 60)
+        
+    def test_reconnects_after_failed_poll(self):
+        """Test that a poll with no data reopens the connection"""
+        clients = [FakeController(failures={0x3000: 3, 0x3100: 3, 0x9000: 3}), FakeController()]
+        session = ControllerSession(connect=lambda: clients.pop(0))
+        
+        self.assertIsNone(session.poll())
+        self.assertIsNotNone(session.poll())
+        self.assertEqual(session.stats()['reconnects'], 1)
+        
+    def test_slow_sections_are_cached(self):
+        """Test that rated info and settings are only read when their interval has passed"""
+        client = FakeController()
+        session = ControllerSession(connect=lambda: client)
+        
+        first = session.poll()
+        second = session.poll()
+        
+        # The second poll only reads the real-time blocks but still returns every field
+        self.assertEqual([address for address, _ in client.reads], [0x3000, 0x3100, 0x3200, 0x330A, 0x9000, 0x3100, 0x3200, 0x330A])
+        self.assertEqual(first, second)
+        
+        session.refresh('settings')
+        session.poll()
+        self.assertEqual([address for address, _ in client.reads[8:]], [0x3100, 0x3200, 0x330A, 0x9000])
+        
+    def test_failed_real_time_read(self):
+        """Test that cached values are not returned when the real-time block fails"""
+        client = FakeController()
+        session = ControllerSession(connect=lambda: client)
+        session.poll()
+        
+        client.failures[0x3100] = 3
+        self.assertIsNone(session.poll())
+
+class SharedBusTests(TestCase):
+    def test_failed_slave_keeps_the_bus(self):
+        """Test that a controller that stops answering neither reconnects the bus nor is polled every cycle"""
+        clients = []
+        def connect():
+            clients.append(FakeController(missing_slaves={7}))
+            return clients[-1]
+        bus = SharedConnection(connect)
+        bus.users = 2
+        good = ControllerSession(connect=bus, slave=1)
+        dead = ControllerSession(connect=bus, slave=7, initial_backoff=30)
+        
+        with self.assertLogs('solar.utils', level='WARNING'):
+            for cycle in range(3):
+                self.assertIsNotNone(good.poll())
+                self.assertIsNone(dead.poll())
+                if cycle == 1:
+                    dead_reads = clients[0].slaves.count(7)
+        
+        self.assertEqual(len(clients), 1)
+        self.assertFalse(hasattr(clients[0], 'closed'))
+        self.assertEqual(good.stats()['reconnects'], 0)
+        # After its second failure in a row the dead controller is skipped
+        self.assertEqual(clients[0].slaves.count(7), dead_reads)
+        self.assertEqual(dead.stats()['errors'], 3)
+        
+    def test_transport_failure_reopens_the_bus(self):
+        """Test that a bus whose transport went down is reopened"""
+        clients = []
+        def connect():
+            clients.append(FakeController())
+            return clients[-1]
+        bus = SharedConnection(connect)
+        bus.users = 2
+        session = ControllerSession(connect=bus)
+        session.poll()
+        
+        def drop(address, count, slave):
+            clients[0].connected = False
+            raise ConnectionError('Connection lost')
+        clients[0].read_input_registers = clients[0].read_holding_registers = drop
+        with self.assertLogs('solar.utils', level='WARNING'):
+            self.assertIsNone(session.poll())
+        self.assertTrue(clients[0].closed)
+        self.assertIsNotNone(session.poll())
+        self.assertEqual(len(clients), 2)
+
+class ModbusSimulator:
+    """
+    A pymodbus TCP server standing in for a gateway with Tracer controllers
+    behind it. Each register of slave n holds its address plus n.
+    """
+    
+    def __init__(self, slaves=(1,)):
+        from pymodbus.datastore import ModbusDeviceContext, ModbusServerContext, ModbusSparseDataBlock
+        
+        input_addresses = [
+            address for reg_info in INPUT_REGISTERS.values()
+            for address in range(reg_info['address'], reg_info['address'] + reg_info.get('registers', 1))
+        ]
+        self.context = ModbusServerContext(devices={
+            slave: ModbusDeviceContext(
+                ir=ModbusSparseDataBlock({address: address + slave for address in range(min(input_addresses), max(input_addresses) + 1)}),
+                hr=ModbusSparseDataBlock({address: slave for address in range(0x9000, 0x9010)}),
+            )
+            for slave in slaves
+        }, single=False)
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        
+    def __enter__(self):
+        from pymodbus.server import ModbusTcpServer
+        
+        started = threading.Event()
+        
+        async def listen():
+            self.server = ModbusTcpServer(self.context, address=('127.0.0.1', 0))
+            await self.server.listen()
+            self.port = self.server.transport.sockets[0].getsockname()[1]
+        
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(listen())
+            started.set()
+            self.loop.run_forever()
+        
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(5)
+        return self
+        
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self.server.shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+class ControllerPollerTests(TestCase):
+    def test_polls_gateways_and_slaves(self):
+        """Test that controllers behind two gateways are each read with their own slave ID"""
+        with ModbusSimulator(slaves=(1, 2)) as first, ModbusSimulator(slaves=(1,)) as second:
+            controllers = [
+                SolarController(name='east', transport='tcp', host='127.0.0.1', tcp_port=first.port, slave_id=1),
+                SolarController(name='west', transport='tcp', host='127.0.0.1', tcp_port=first.port, slave_id=2),
+                SolarController(name='barn', transport='tcp', host='127.0.0.1', tcp_port=second.port, slave_id=1),
+            ]
+            poller = ControllerPoller(controllers)
+            try:
+                readings = poller.poll()
+                sessions = poller.sessions
+            finally:
+                poller.close()
+        
+        self.assertEqual(len(poller.buses), 2)
+        # Controllers on one gateway share its connection
+        self.assertIs(sessions['east'].connect, sessions['west'].connect)
+        self.assertEqual(readings['east']['pv_array_power'], (0x3102 + 1) / 100)
+        self.assertEqual(readings['west']['pv_array_power'], (0x3102 + 2) / 100)
+        self.assertEqual(readings['barn']['battery_capacity'], 1)
+        self.assertEqual(readings['west']['energy_generated_total'], ((0x3313 + 2) << 16 | (0x3312 + 2)) / 100)
+        
+    def test_failed_controller(self):
+        """Test that a controller that doesn't answer leaves the others' readings alone"""
+        with ModbusSimulator(slaves=(1,)) as gateway:
+            poller = ControllerPoller([
+                SolarController(name='east', transport='tcp', host='127.0.0.1', tcp_port=gateway.port, slave_id=1),
+                SolarController(name='missing', transport='tcp', host='127.0.0.1', tcp_port=gateway.port, slave_id=7),
+            ])
+            try:
+                # The simulator logs the requests it can't answer
+                with self.assertLogs('pymodbus', level='ERROR'):
+                    readings = poller.poll()
+            finally:
+                poller.close()
+        
+        self.assertIsNotNone(readings['east'])
+        self.assertIsNone(readings['missing'])
+
+class MultiControllerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        
+    def test_settings_per_device(self):
+        """Test that each controller's settings are logged on their own"""
+        store_sample({'device': 'east', 'pv_array_power': 100.0, 'float_voltage': 13.8})
+        store_sample({'device': 'west', 'pv_array_power': 100.0, 'float_voltage': 27.6})
+        store_sample({'device': 'east', 'pv_array_power': 100.0, 'float_voltage': 13.8})
+        
+        self.assertEqual(SolarControllerSettings.objects.count(), 2)
+        self.assertEqual(SolarControllerSettings.current('west').float_voltage, 27.6)
+        
+    def test_daily_aggregates_per_device(self):
+        """Test that readings of different controllers are not paired and are added up per date"""
+        day = date(2025, 6, 1)
+        noon = datetime(2025, 6, 1, 12, 0)
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(device=device, timestamp=noon + timedelta(minutes=minutes), pv_array_power=power, load_power=0)
+            for minutes in (0, 10, 20)
+            for device, power in (('east', 600), ('west', 60))
+        ])
+        
+        aggregates = {row.device: row for row in build_daily_aggregates(day, day)}
+        self.assertAlmostEqual(aggregates['east'].energy_produced, 200)
+        self.assertAlmostEqual(aggregates['west'].energy_produced, 20)
+        
+        recompute_daily_aggregates(day, day)
+        site = site_days(SolarDailyAggregate.objects.all()).get()
+        self.assertAlmostEqual(site['produced'], 220)
+        self.assertEqual(site['peak'], 600)
+        
+    def test_accumulator_per_device(self):
+        """Test that today's totals are kept per controller and summed"""
+        noon = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        accumulator = TodayAccumulator()
+        for minutes in (0, 10):
+            for device, power in (('east', 600), ('west', 60)):
+                accumulator.add(SolarControllerData.objects.create(
+                    device=device, timestamp=noon + timedelta(minutes=minutes), pv_array_power=power, load_power=0
+                ))
+        
+        self.assertAlmostEqual(accumulator.state('east').energy_produced, 100)
+        self.assertAlmostEqual(accumulator.summary()['energy_produced'], 110)
+        
+    def test_batch_readings_name_their_device(self):
+        """Test that readings in a batch can come from several controllers"""
+        timestamp = datetime(2025, 6, 1, 12, 0).isoformat()
+        result = store_batch('collector', [
+            {'timestamp': timestamp, 'device': 'east', 'pv_array_power': 1.0},
+            {'timestamp': timestamp, 'device': 'west', 'pv_array_power': 2.0},
+            {'timestamp': timestamp, 'pv_array_power': 3.0},
+        ])
+        
+        self.assertEqual(result['inserted'], 3)
+        self.assertEqual(
+            sorted(SolarControllerData.objects.values_list('device', flat=True)), ['collector', 'east', 'west']
+        )
+        self.assertEqual(store_batch('collector', [{'timestamp': timestamp, 'device': 'east'}])['duplicates'], 1)
+
+class SettingsChangeLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.values = {
+            'pv_array_power': 120.5,
+            'battery_voltage': 13.2,
+            'charging_mode': 'MPPT',
+            'battery_type': 'Gel',
+            'battery_capacity': 200,
+            'float_voltage': 13.8,
+        }
+        
+    def test_settings_stored_once(self):
+        """Test that unchanged settings are not logged again"""
+        for _ in range(3):
+            store_sample(self.values)
+        
+        self.assertEqual(SolarControllerData.objects.count(), 3)
+        self.assertEqual(SolarControllerSettings.objects.count(), 1)
+        self.assertEqual(SolarControllerData.objects.first().pv_array_power, 120.5)
+        
+    def test_change_is_logged(self):
+        """Test that a changed setting adds a row that keeps the other values"""
+        first, _ = store_sample(self.values)
+        sample, settings = store_sample({**self.values, 'float_voltage': 13.6})
+        
+        self.assertEqual(SolarControllerSettings.objects.count(), 2)
+        self.assertEqual((settings.float_voltage, settings.battery_type), (13.6, 'Gel'))
+        self.assertEqual(SolarControllerSettings.at(first.timestamp).float_voltage, 13.8)
+        self.assertEqual(SolarControllerSettings.at(sample.timestamp).float_voltage, 13.6)
+        
+    def test_late_readings_use_settings_of_their_time(self):
+        """Test that replayed older readings are compared with the settings in effect when they were taken"""
+        start = datetime(2025, 6, 1, 12, 0)
+        SolarControllerSettings.record(self.values, timestamp=start)
+        SolarControllerSettings.record({**self.values, 'float_voltage': 13.6}, timestamp=start + timedelta(hours=2))
+        
+        # A reading from between the two, then an older one with a setting of its own
+        self.assertEqual(SolarControllerSettings.record(self.values, timestamp=start + timedelta(hours=1)).float_voltage, 13.6)
+        self.assertEqual(SolarControllerSettings.objects.count(), 2)
+        settings = SolarControllerSettings.record({**self.values, 'battery_capacity': 100}, timestamp=start + timedelta(hours=1))
+        
+        self.assertEqual(settings.float_voltage, 13.6)
+        self.assertEqual(SolarControllerSettings.at(start + timedelta(hours=1)).battery_capacity, 100)
+        self.assertEqual(SolarControllerSettings.current().valid_from, start + timedelta(hours=2))
+        
+        # The next live reading matches the latest settings, so nothing is logged
+        SolarControllerSettings.record({**self.values, 'float_voltage': 13.6}, timestamp=start + timedelta(hours=3))
+        self.assertEqual(SolarControllerSettings.objects.count(), 3)
+        
+    def test_missing_settings_are_kept(self):
+        """Test that samples without settings don't clear the logged ones"""
+        store_sample(self.values)
+        _, settings = store_sample({'pv_array_power': 80.0})
+        
+        self.assertEqual(SolarControllerSettings.objects.count(), 1)
+        self.assertEqual(settings.battery_capacity, 200)
+        
+    def test_payloads_include_settings(self):
+        """Test that the API and WebSocket payloads keep their shape"""
+        sample, settings = store_sample(self.values)
+        
+        data = SolarDataViewSet().format_solar_data(sample)
+        self.assertEqual(data['battery']['type'], 'Gel')
+        self.assertEqual(data['settings']['float_voltage'], 13.8)
+        self.assertEqual(data['controller']['charging_mode'], 'MPPT')
+        self.assertEqual(live_payload(sample, settings)['controller']['charging_mode'], 'MPPT')
+        self.assertEqual(live_payload(sample, settings)['today']['date'], sample.timestamp.date().isoformat())
+
+class DailyEnergyTests(TestCase):
+    day = date(2025, 6, 1)
+    
+    def add_readings(self, readings, day=None):
+        """Create readings from (hour, minute, pv power, load power, battery voltage[, generated, consumed]) tuples"""
+        midnight = datetime.combine(day or self.day, datetime.min.time())
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(
+                timestamp=midnight + timedelta(hours=hour, minutes=minute),
+                pv_array_power=pv, load_power=load, battery_voltage=voltage,
+                energy_generated_total=counters[0] if counters else None,
+                energy_consumed_total=counters[1] if counters else None,
+            )
+            for hour, minute, pv, load, voltage, *counters in readings
+        ])
+        
+    def test_trapezoidal_energy(self):
+        """Test that energy follows the sample times rather than the sample count"""
+        # 100W for an hour sampled every 10 minutes, then ramping to 300W over 10 minutes
+        self.add_readings(
+            [(10, minute, 100, 20, 12.5) for minute in range(0, 60, 10)]
+            + [(11, 0, 100, 20, 12.7), (11, 10, 300, 20, 13.1)]
+        )
+        
+        with self.assertNumQueries(1):
+            daily = build_daily_aggregates(self.day, self.day)[0]
+        
+        self.assertAlmostEqual(daily.energy_produced, 100 + 200 / 6)
+        self.assertAlmostEqual(daily.energy_consumed, 20 * 7 / 6)
+        self.assertEqual((daily.peak_power, daily.peak_load), (300, 20))
+        self.assertEqual((daily.min_battery_voltage, daily.max_battery_voltage), (12.5, 13.1))
+        self.assertAlmostEqual(daily.sunshine_hours, 7 / 6)
+        
+    def test_gaps_are_not_bridged(self):
+        """Test that intervals longer than the maximum gap add no energy"""
+        self.add_readings([(9, 0, 200, 0, 12.5), (9, 10, 200, 0, 12.5), (14, 0, 200, 0, 12.5), (14, 10, 200, 0, 12.5)])
+        
+        with self.settings(SOLAR_MAX_SAMPLE_GAP=900):
+            daily = build_daily_aggregates(self.day, self.day)[0]
+        
+        self.assertAlmostEqual(daily.energy_produced, 200 / 6 * 2)
+        self.assertAlmostEqual(daily.sunshine_hours, 1 / 3)
+        
+    def test_calculate_and_recompute(self):
+        """Test that existing aggregates are kept unless recomputed"""
+        self.add_readings([(12, 0, 60, 0, 12.5), (12, 10, 60, 0, 12.5)])
+        self.assertAlmostEqual(calculate_daily_aggregate(self.day).energy_produced, 10)
+        
+        SolarControllerData.objects.update(pv_array_power=120)
+        self.assertAlmostEqual(calculate_daily_aggregate(self.day).energy_produced, 10)
+        self.assertEqual(recompute_daily_aggregates(self.day, self.day), 1)
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=self.day).energy_produced, 20)
+        
+    def test_recompute_skips_removed_days(self):
+        """Test that --recompute leaves days alone whose raw data retention removed unless forced"""
+        self.add_readings([(12, 0, 60, 0, 12.5), (12, 10, 60, 0, 12.5)])
+        SolarDailyAggregate.objects.create(date=self.day, energy_produced=999)
+        
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('aggregate_solar_data', '--recompute', f'--start={self.day}', f'--end={self.day}', stdout=out)
+        self.assertIn('Skipping the days before', out.getvalue())
+        self.assertEqual(SolarDailyAggregate.objects.get(date=self.day).energy_produced, 999)
+        
+        call_command('aggregate_solar_data', '--recompute', '--force', f'--start={self.day}', f'--end={self.day}', stdout=StringIO())
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=self.day).energy_produced, 10)
+        
+    def test_energy_counters(self):
+        """Test that energy is the counter increase, including over gaps and from the previous day"""
+        self.add_readings([(23, 50, 0, 10, 12.5, 100.0, 50.0)], day=self.day - timedelta(days=1))
+        self.add_readings([
+            (0, 10, 0, 10, 12.5, 100.0, 50.5),
+            (9, 0, 200, 10, 12.5, 100.0, 51.0),
+            (14, 0, 200, 10, 12.5, 101.5, 51.2),
+            # The controller was reset
+            (15, 0, 200, 10, 12.5, 0.2, 0.1),
+        ])
+        
+        with self.assertNumQueries(1):
+            daily = build_daily_aggregates(self.day, self.day)[0]
+        
+        self.assertAlmostEqual(daily.energy_produced, 1700)
+        self.assertAlmostEqual(daily.energy_consumed, 1300)
+        self.assertEqual(daily.peak_power, 200)
+        
+    def test_counters_after_power_readings(self):
+        """Test that days start on power readings and switch to counters once they appear"""
+        self.add_readings([(12, 0, 60, 0, 12.5), (12, 10, 60, 0, 12.5), (12, 20, 60, 0, 12.5, 10.0, 0.0), (12, 30, 0, 0, 12.5, 10.5, 0.0)])
+        
+        self.assertAlmostEqual(build_daily_aggregates(self.day, self.day)[0].energy_produced, 20 + 500)
+        
+    def test_envelopes(self):
+        """Test that peaks and voltage extremes come from the envelopes of summarized readings"""
+        self.add_readings([(12, 0, 100, 20, 12.5), (12, 10, 100, 20, 12.5)])
+        SolarControllerData.objects.filter(timestamp__minute=10).update(
+            pv_array_power_max=450, load_power_max=80, battery_voltage_min=12.1, battery_voltage_max=13.9,
+        )
+        
+        daily = build_daily_aggregates(self.day, self.day)[0]
+        
+        self.assertAlmostEqual(daily.energy_produced, 100 / 6)
+        self.assertEqual((daily.peak_power, daily.peak_load), (450, 80))
+        self.assertEqual((daily.min_battery_voltage, daily.max_battery_voltage), (12.1, 13.9))
+        
+    def test_no_readings(self):
+        self.assertIsNone(calculate_daily_aggregate(self.day))
+        
+    def test_missing_controller_is_aggregated(self):
+        """Test that a day aggregated for one controller still gets the other controllers' rows"""
+        self.add_readings([(12, 0, 60, 0, 12.5), (12, 10, 60, 0, 12.5)])
+        calculate_daily_aggregate(self.day)
+        noon = datetime.combine(self.day, datetime.min.time()) + timedelta(hours=12)
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(device='roof', timestamp=noon + timedelta(minutes=minutes), pv_array_power=120)
+            for minutes in (0, 10)
+        ])
+        SolarDailyAggregate.objects.filter(device='local').update(energy_produced=999)
+        
+        calculate_daily_aggregate(self.day)
+        
+        self.assertEqual(SolarDailyAggregate.objects.get(date=self.day, device='local').energy_produced, 999)
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=self.day, device='roof').energy_produced, 20)
+        self.assertAlmostEqual(SolarMonthlyAggregate.objects.get(year=2025, month=6).energy_produced, 0.03)
+
+class BatchUploadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.start = datetime(2025, 6, 1, 12, 0)
+        
+    def reading(self, minutes, pv=100.0, **values):
+        return {
+            'timestamp': (self.start + timedelta(minutes=minutes)).isoformat(),
+            'pv_array_power': pv,
+            'battery_voltage': 13.0,
+            **values
+        }
+        
+    def test_readings_keep_device_timestamps(self):
+        """Test that readings are stored at the time they were taken"""
+        result = store_batch('pi', [self.reading(0), self.reading(1, pv=50.0)])
+        
+        self.assertEqual((result['inserted'], result['duplicates']), (2, 0))
+        self.assertEqual(
+            list(SolarControllerData.objects.order_by('timestamp').values_list('device', 'timestamp', 'pv_array_power')),
+            [('pi', self.start, 100.0), ('pi', self.start + timedelta(minutes=1), 50.0)]
+        )
+        self.assertEqual(result['newest'].timestamp, self.start + timedelta(minutes=1))
+        
+    def test_duplicates_are_skipped(self):
+        """Test that a batch sent again, in part or in whole, is only stored once"""
+        store_batch('pi', [self.reading(0), self.reading(1)])
+        result = store_batch('pi', [self.reading(1), self.reading(2), self.reading(2)])
+        
+        self.assertEqual((result['inserted'], result['duplicates']), (1, 2))
+        self.assertEqual(SolarControllerData.objects.filter(device='pi').count(), 3)
+        # The same time from another collector is a different reading
+        self.assertEqual(store_batch('shed', [self.reading(0)])['inserted'], 1)
+        
+    def test_settings_and_bad_readings(self):
+        """Test that settings are logged and invalid readings are reported"""
+        result = store_batch('pi', [
+            self.reading(0, float_voltage=13.8),
+            {'pv_array_power': 10.0},
+            self.reading(1, float_voltage=13.6),
+        ])
+        
+        self.assertEqual(result['inserted'], 2)
+        self.assertEqual([error['index'] for error in result['errors']], [1])
+        self.assertEqual(SolarControllerSettings.objects.count(), 2)
+        self.assertEqual(result['settings'].float_voltage, 13.6)
+        
+    def test_endpoint_broadcasts_newest(self):
+        """Test that the endpoint stores a batch and broadcasts only its newest reading"""
+        readings = [self.reading(minutes) for minutes in range(5)]
+        with mock.patch('solar.views.broadcast_sample') as broadcast:
+            response = self.client.post(
+                reverse('solar-upload-batch'), {'device': 'pi', 'readings': readings}, content_type='application/json'
+            )
+        
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['inserted'], 5)
+        broadcast.assert_called_once()
+        self.assertEqual(broadcast.call_args[0][0].timestamp, self.start + timedelta(minutes=4))
+        
+        with mock.patch('solar.views.broadcast_sample') as broadcast:
+            response = self.client.post(
+                reverse('solar-upload-batch'), {'device': 'pi', 'readings': readings}, content_type='application/json'
+            )
+        self.assertEqual(response.json()['duplicates'], 5)
+        broadcast.assert_not_called()
+        
+    def test_database_errors_are_retried(self):
+        """Test that a batch the server failed to store stays journaled and is sent again"""
+        def send(url, device, readings):
+            check_response(self.client.post(url, {'device': device, 'readings': readings}, content_type='application/json'))
+        
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal = SampleJournal(directory.name, batch_size=1, initial_backoff=0, send=send)
+        journal.append(self.reading(0))
+        
+        with mock.patch('solar.views.store_batch', side_effect=OperationalError("server closed the connection")):
+            with self.assertLogs('solar.views', level='ERROR'), self.assertLogs('solar.journal', level='WARNING'), \
+                    self.assertLogs('django.request', level='ERROR'):
+                self.assertEqual(journal.drain(reverse('solar-upload-batch'), 'pi'), 0)
+        self.assertEqual(journal.pending(), 1)
+        self.assertFalse([name for name in os.listdir(directory.name) if name.endswith('.rejected')])
+        
+        with mock.patch('solar.views.broadcast_sample'):
+            self.assertEqual(journal.drain(reverse('solar-upload-batch'), 'pi'), 1)
+        self.assertEqual(SolarControllerData.objects.filter(device='pi').count(), 1)
+        
+    def test_error_statuses(self):
+        """Test that only a bad payload gets a 4xx, which collectors don't retry"""
+        url = reverse('solar-upload-batch')
+        self.assertEqual(self.client.post(url, {'readings': 'none'}, content_type='application/json').status_code, 400)
+        with mock.patch('solar.views.store_batch', side_effect=KeyError('bug')), self.assertLogs('solar.views', level='ERROR'), \
+                self.assertLogs('django.request', level='ERROR'):
+            response = self.client.post(url, {'readings': []}, content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+
+class IntervalSummaryTests(TestCase):
+    def test_summary(self):
+        """Test that analog values are averaged with envelopes and the rest keep their last value"""
+        summary = IntervalSummary()
+        self.assertFalse(summary)
+        for power, voltage, status in [(100, 12.6, 0), (400, 12.2, 1), (100, None, 2)]:
+            summary.add({'pv_array_power': power, 'battery_voltage': voltage, 'charging_status': status})
+        
+        values = summary.result()
+        
+        self.assertEqual(values['sample_count'], 3)
+        self.assertEqual((values['pv_array_power'], values['pv_array_power_min'], values['pv_array_power_max']), (200, 100, 400))
+        self.assertAlmostEqual(values['battery_voltage'], 12.4)
+        self.assertEqual((values['battery_voltage_min'], values['battery_voltage_max']), (12.2, 12.6))
+        self.assertEqual(values['charging_status'], 2)
+        self.assertNotIn('load_power_min', values)
+        
+    def test_stored_summary(self):
+        """Test that a summarized reading is stored with its envelope"""
+        summary = IntervalSummary()
+        for power in (50, 150):
+            summary.add({'pv_array_power': power, 'battery_voltage': 12.5, 'load_power': 10})
+        
+        sample, _ = store_sample(summary.result())
+        sample.refresh_from_db()
+        
+        self.assertEqual((sample.pv_array_power, sample.pv_array_power_max, sample.sample_count), (100, 150, 2))
+
+class SampleJournalTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sent = []
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def send(self, url, device, readings):
+        self.sent.append((device, readings))
+        
+    def test_segments_uploaded_in_order(self):
+        """Test that full segments are uploaded oldest first and then deleted"""
+        journal = SampleJournal(self.directory.name, batch_size=2, send=self.send)
+        for n in range(5):
+            journal.append({'n': n})
+        
+        self.assertEqual(journal.drain('url', 'pi'), 4)
+        self.assertEqual(self.sent, [('pi', [{'n': 0}, {'n': 1}]), ('pi', [{'n': 2}, {'n': 3}])])
+        self.assertEqual(journal.pending(), 1)
+        self.assertEqual(journal.drain('url', 'pi', flush=True), 1)
+        self.assertEqual(journal.pending(), 0)
+        
+    def test_failed_upload_is_kept(self):
+        """Test that readings survive a failed upload and a restart"""
+        def fail(url, device, readings):
+            raise ConnectionError("offline")
+        
+        journal = SampleJournal(self.directory.name, batch_size=1, initial_backoff=0, send=fail)
+        journal.append({'n': 0})
+        self.assertEqual(journal.drain('url', 'pi'), 0)
+        self.assertEqual(journal._backoff, 0)
+        
+        journal.append({'n': 1})
+        restarted = SampleJournal(self.directory.name, batch_size=1, send=self.send)
+        self.assertEqual(restarted.pending(), 2)
+        self.assertEqual(restarted.drain('url', 'pi'), 2)
+        self.assertEqual([readings for _, readings in self.sent], [[{'n': 0}], [{'n': 1}]])
+        
+    def test_rejected_segment_is_set_aside(self):
+        """Test that a segment the server refuses doesn't block the ones after it"""
+        def send(url, device, readings):
+            if readings[0]['n'] == 0:
+                raise RejectedBatch("400")
+            self.send(url, device, readings)
+        
+        journal = SampleJournal(self.directory.name, batch_size=1, send=send)
+        journal.append({'n': 0})
+        journal.append({'n': 1})
+        
+        self.assertEqual(journal.drain('url', 'pi'), 1)
+        self.assertEqual(len([name for name in os.listdir(self.directory.name) if name.endswith('.rejected')]), 1)
+        
+    def test_uploader_does_not_block_appends(self):
+        """Test that readings are journaled while the uploader waits on the server"""
+        sending = threading.Event()
+        release = threading.Event()
+        
+        def send(url, device, readings):
+            sending.set()
+            release.wait(5)
+            self.send(url, device, readings)
+        
+        journal = SampleJournal(self.directory.name, batch_size=1, send=send)
+        uploader = JournalUploader(journal, 'url', 'pi', interval=0.01)
+        uploader.start()
+        journal.append({'n': 0})
+        self.assertTrue(sending.wait(5))
+        
+        journal.append({'n': 1})
+        self.assertEqual(journal.pending(), 2)
+        release.set()
+        uploader.stop()
+        
+        journal.drain('url', 'pi', flush=True)
+        self.assertEqual([readings for _, readings in self.sent], [[{'n': 0}], [{'n': 1}]])
+
+class TodayAccumulatorTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2025, 6, 1, 12, 0)
+        
+    def sample(self, minutes, pv, load=10, voltage=12.8, **counters):
+        """A stored sample the given number of minutes after noon"""
+        return SolarControllerData.objects.create(
+            timestamp=self.start + timedelta(minutes=minutes),
+            pv_array_power=pv, load_power=load, battery_voltage=voltage, **counters
+        )
+        
+    def test_running_totals(self):
+        """Test that samples are integrated as they arrive"""
+        accumulator = TodayAccumulator()
+        for minutes, pv in ((0, 100), (10, 100), (20, 200), (60, 200)):
+            accumulator.add(self.sample(minutes, pv))
+        
+        state = accumulator.state()
+        # The 40 minute gap is longer than SOLAR_MAX_SAMPLE_GAP
+        self.assertAlmostEqual(state.energy_produced, 100 / 6 + 150 / 6)
+        self.assertAlmostEqual(state.energy_consumed, 10 / 3)
+        self.assertEqual(state.peak_power, 200)
+        self.assertAlmostEqual(state.sunshine_hours, 1 / 3)
+        self.assertEqual(state.sample_count, 4)
+        
+    def test_processes_share_the_totals(self):
+        """Test that samples stored by different worker processes add up to one set of totals"""
+        first, second = TodayAccumulator(), TodayAccumulator()
+        for minutes, accumulator in ((0, first), (10, second), (20, first), (30, second)):
+            accumulator.add(self.sample(minutes, 60))
+        
+        state = SolarEnergyAccumulator.objects.get(date=self.start.date())
+        self.assertAlmostEqual(state.energy_produced, 30)
+        self.assertEqual(state.sample_count, 4)
+        self.assertAlmostEqual(first.summary()['energy_produced'], second.summary()['energy_produced'])
+        
+    def test_batch(self):
+        """Test that a batch is folded in time order, skipping samples already counted"""
+        accumulator = TodayAccumulator()
+        samples = [self.sample(minutes, 60) for minutes in (0, 10, 20)]
+        accumulator.add_many(reversed(samples))
+        accumulator.add_many(samples[1:])
+        
+        state = accumulator.state()
+        self.assertAlmostEqual(state.energy_produced, 20)
+        self.assertEqual(state.sample_count, 3)
+        
+    def test_rolls_over_at_midnight(self):
+        """Test that the first sample of a new day closes the previous one"""
+        accumulator = TodayAccumulator()
+        accumulator.add(self.sample(0, 120))
+        accumulator.add(self.sample(10, 120))
+        accumulator.add(self.sample(12 * 60 + 5, 0))
+        
+        daily = SolarDailyAggregate.objects.get(date=self.start.date())
+        self.assertAlmostEqual(daily.energy_produced, 20)
+        self.assertEqual(daily.peak_power, 120)
+        self.assertEqual(accumulator.state().date, self.start.date() + timedelta(days=1))
+        self.assertEqual(accumulator.state().energy_produced, 0)
+        self.assertFalse(SolarEnergyAccumulator.objects.filter(date=self.start.date()).exists())
+        self.assertAlmostEqual(SolarMonthlyAggregate.objects.get(year=2025, month=6).energy_produced, 0.02)
+        
+    def test_energy_counters(self):
+        """Test that counter increases are used when the samples have them, across gaps and midnight"""
+        accumulator = TodayAccumulator()
+        accumulator.add(self.sample(0, 100))
+        accumulator.add(self.sample(10, 100, energy_generated_total=50.0, energy_consumed_total=20.0))
+        accumulator.add(self.sample(120, 100, energy_generated_total=50.4, energy_consumed_total=20.1))
+        self.assertAlmostEqual(accumulator.state().energy_produced, 100 / 6 + 400)
+        self.assertAlmostEqual(accumulator.state().energy_consumed, 10 / 6 + 100)
+        
+        accumulator.add(self.sample(12 * 60 + 5, 0, energy_generated_total=50.5, energy_consumed_total=20.3))
+        self.assertAlmostEqual(accumulator.state().energy_produced, 100)
+        self.assertAlmostEqual(accumulator.state().energy_consumed, 200)
+        
+    def test_summary_reads_the_totals(self):
+        """Test that the summary reports the stored totals"""
+        SolarEnergyAccumulator.objects.create(date=timezone.now().date(), energy_produced=1500)
+        
+        summary = TodayAccumulator().summary()
+        self.assertEqual(summary['energy_produced'], 1500)
+
+class RollupTests(TestCase):
+    def add_days(self, days):
+        """Add daily aggregates from (date, device, Wh produced, peak power) tuples, one batch per date"""
+        for day in sorted({day for day, *_ in days}):
+            add_daily_aggregates([
+                SolarDailyAggregate(date=day, device=device, energy_produced=produced, energy_consumed=produced / 2, peak_power=peak)
+                for row_day, device, produced, peak in days if row_day == day
+            ])
+        
+    def test_incremental_fold(self):
+        """Test that folding day by day gives the same stats as recomputing them"""
+        self.add_days([
+            (date(2024, 12, 30), 'local', 3000, 400),
+            (date(2025, 1, 2), 'local', 1000, 300),
+            (date(2025, 1, 2), 'roof', 1500, 350),
+            (date(2025, 1, 3), 'local', 2000, 500),
+            (date(2025, 1, 4), 'local', 0, 0),
+            (date(2025, 2, 1), 'local', 500, 200),
+        ])
+        # A late controller upload for a day already folded
+        self.add_days([(date(2025, 1, 3), 'roof', 200, 100)])
+        
+        january = SolarMonthlyAggregate.objects.get(year=2025, month=1)
+        self.assertAlmostEqual(january.energy_produced, 4.7)
+        self.assertEqual((january.production_days, january.peak_power), (2, 500))
+        self.assertEqual((january.best_day, january.best_day_production), (date(2025, 1, 2), 2.5))
+        year = SolarYearlyAggregate.objects.get(year=2025)
+        self.assertAlmostEqual(year.avg_monthly_production, 2.6)
+        self.assertEqual(year.best_month, 1)
+        total = SolarTotalAggregate.objects.get()
+        self.assertAlmostEqual(total.total_energy_produced, 8.2)
+        self.assertEqual((total.peak_power_ever, total.peak_power_date), (500, date(2025, 1, 3)))
+        self.assertEqual((total.best_day_ever, total.best_month_ever), (date(2024, 12, 30), '2025-01'))
+        self.assertEqual((total.operational_days, total.system_install_date), (34, date(2024, 12, 30)))
+        self.assertEqual(verify_rollups(), [])
+        
+    def test_fold_reads_only_the_day(self):
+        """Test that folding a day costs the same however long the history is"""
+        self.add_days([(date(2025, 3, 1), 'local', 1000, 300)])
+        with CaptureQueriesContext(connection) as short:
+            self.add_days([(date(2025, 3, 2), 'local', 1000, 300)])
+        self.add_days([(date(2025, 3, 3) + timedelta(days=n), 'local', 1000, 300) for n in range(20)])
+        with CaptureQueriesContext(connection) as long:
+            self.add_days([(date(2025, 3, 30), 'local', 1000, 300)])
+        
+        self.assertEqual(len(long), len(short))
+        
+    def test_verify_command(self):
+        """Test that the verify command reports differences and fixes them"""
+        self.add_days([(date(2025, 5, 1), 'local', 1000, 300)])
+        SolarMonthlyAggregate.objects.update(energy_produced=5)
+        
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('verify_solar_aggregates', stdout=out)
+        self.assertIn('2025-05 energy_produced: stored 5.0, recomputed 1.0', out.getvalue())
+        
+        call_command('verify_solar_aggregates', '--fix', stdout=StringIO())
+        self.assertEqual(verify_rollups(), [])
+        
+    def test_prepare_cleanup(self):
+        """Test that days without aggregates are aggregated and folded before a cleanup"""
+        yesterday = timezone.now().date() - timedelta(days=1)
+        noon = datetime.combine(yesterday, datetime.min.time()) + timedelta(hours=12)
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(timestamp=noon + timedelta(minutes=minutes), pv_array_power=60) for minutes in (0, 10)
+        ])
+        
+        prepare_cleanup(timezone.now() - timedelta(days=3))
+        
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=yesterday).energy_produced, 10)
+        self.assertAlmostEqual(SolarTotalAggregate.objects.get().total_energy_produced, 0.01)
+
+class DirtyDayTests(TestCase):
+    def setUp(self):
+        self.day = timezone.now().date() - timedelta(days=3)
+        self.noon = datetime.combine(self.day, datetime.min.time()) + timedelta(hours=12)
+        
+    def upload(self, *minutes, pv=60):
+        store_batch('local', [
+            {'timestamp': (self.noon + timedelta(minutes=minute)).isoformat(), 'pv_array_power': pv} for minute in minutes
+        ])
+        
+    def test_late_readings_are_recomputed(self):
+        """Test that readings arriving after a day was aggregated update it and its rollups"""
+        self.upload(0, 10)
+        self.assertEqual(list(SolarDirtyDay.objects.values_list('date', flat=True)), [self.day])
+        
+        # The day after it, whose first counter interval it holds, is recomputed but not counted
+        with self.assertLogs('solar.tasks', level='INFO') as logs:
+            self.assertEqual(aggregate_dirty_days(), 1)
+        self.assertIn('Recomputed 1 solar days with late readings and 1 days following them', logs.output[-1])
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=self.day).energy_produced, 10)
+        self.assertFalse(SolarDirtyDay.objects.exists())
+        
+        self.upload(20)
+        aggregate_dirty_days()
+        
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=self.day).energy_produced, 20)
+        self.assertAlmostEqual(SolarTotalAggregate.objects.get().total_energy_produced, 0.02)
+        self.assertEqual(verify_rollups(), [])
+        
+    def test_corrections_lower_the_stats(self):
+        """Test that a recomputed day can lower peaks, which folding alone can't"""
+        self.upload(0, 10, pv=300)
+        aggregate_dirty_days()
+        
+        SolarControllerData.objects.update(pv_array_power=30)
+        SolarDirtyDay.mark([self.noon])
+        aggregate_dirty_days()
+        
+        total = SolarTotalAggregate.objects.get()
+        self.assertEqual((total.peak_power_ever, total.peak_power_date), (30, self.day))
+        self.assertEqual(SolarMonthlyAggregate.objects.get(year=self.day.year, month=self.day.month).peak_power, 30)
+        self.assertEqual(verify_rollups(), [])
+        
+    def test_day_past_retention_is_kept(self):
+        """Test that a day whose raw data was removed keeps its aggregate"""
+        old_day = timezone.now().date() - timedelta(days=30)
+        add_daily_aggregates([SolarDailyAggregate(date=old_day, energy_produced=5000, peak_power=800)])
+        SolarControllerData.objects.create(
+            timestamp=datetime.combine(old_day, datetime.min.time()) + timedelta(hours=12), pv_array_power=10,
+        )
+        SolarDirtyDay.mark([datetime.combine(old_day, datetime.min.time())])
+        
+        with self.assertLogs('solar.tasks', level='WARNING'):
+            self.assertEqual(aggregate_dirty_days(), 0)
+        
+        self.assertEqual(SolarDailyAggregate.objects.get(date=old_day).energy_produced, 5000)
+        self.assertFalse(SolarDirtyDay.objects.exists())
+        
+    def test_missing_controller_past_retention(self):
+        """Test that a controller without an aggregate gets one on a removed day, the others keep theirs"""
+        old_day = timezone.now().date() - timedelta(days=30)
+        noon = datetime.combine(old_day, datetime.min.time()) + timedelta(hours=12)
+        add_daily_aggregates([SolarDailyAggregate(date=old_day, device='local', energy_produced=5000, peak_power=800)])
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(timestamp=noon + timedelta(minutes=minutes), device=device, pv_array_power=60)
+            for device in ('local', 'roof') for minutes in (0, 10)
+        ])
+        SolarDirtyDay.mark([noon])
+        
+        with self.assertLogs('solar.tasks', level='WARNING'):
+            self.assertEqual(aggregate_dirty_days(), 1)
+        
+        self.assertEqual(SolarDailyAggregate.objects.get(date=old_day, device='local').energy_produced, 5000)
+        self.assertAlmostEqual(SolarDailyAggregate.objects.get(date=old_day, device='roof').energy_produced, 10)
+        self.assertEqual(verify_rollups(), [])
+
+class HistoryDownsamplingTests(TestCase):
+    def setUp(self):
+        # Readings every 10 minutes over the last 6 hours, power rising by 1W each
+        now = timezone.now().replace(second=0, microsecond=0)
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(pv_array_power=i, battery_voltage=12.0, battery_charging_power=i / 2, load_power=5)
+            for i in range(36)
+        ])
+        for i, sample in enumerate(SolarControllerData.objects.order_by('id')):
+            SolarControllerData.objects.filter(pk=sample.pk).update(timestamp=now - timedelta(minutes=10 * (35 - i)))
+        self.now = now
+        
+    def test_choose_bucket(self):
+        """Test that the bucket fits the window into about the requested points"""
+        self.assertEqual(choose_bucket(timedelta(hours=1)), 60)
+        self.assertEqual(choose_bucket(timedelta(days=30)), 3 * 3600)
+        self.assertEqual(choose_bucket(timedelta(days=30), points=720), 3600)
+        self.assertEqual(choose_bucket(timedelta(days=3650)), 86400)
+        
+    def test_downsample(self):
+        """Test that each bucket carries the average, minimum and maximum"""
+        start = datetime(2025, 6, 1, 12, 0)
+        samples = SolarControllerData.objects.bulk_create([SolarControllerData(pv_array_power=i) for i in range(6)])
+        for i, sample in enumerate(samples):
+            SolarControllerData.objects.filter(pk=sample.pk).update(timestamp=start + timedelta(minutes=10 * i))
+        
+        with self.assertNumQueries(1):
+            rows = list(downsample(start, 1800, until=start + timedelta(hours=1)))
+        
+        # Newest bucket first: 12:30 holds 3, 4 and 5, 12:00 holds 0, 1 and 2
+        self.assertEqual([row[0] for row in rows], [start + timedelta(minutes=30), start])
+        self.assertEqual(rows[0][1:4], (4, 3, 5))
+        self.assertEqual(rows[1][1:4], (1, 0, 2))
+        
+    def test_downsample_envelopes(self):
+        """Test that buckets take their extremes from the envelopes of summarized readings"""
+        start = datetime(2025, 6, 1, 12, 0)
+        sample = SolarControllerData.objects.create(pv_array_power=100, pv_array_power_min=40, pv_array_power_max=300)
+        SolarControllerData.objects.filter(pk=sample.pk).update(timestamp=start)
+        
+        rows = list(downsample(start, 1800, until=start + timedelta(hours=1)))
+        
+        self.assertEqual(rows[0][1:4], (100, 40, 300))
+        
+    def test_history_auto(self):
+        """Test that the endpoint returns bucketed series with their envelopes"""
+        response = self.client.get('/api/solar/data/history/', {'hours': 6, 'points': 12})
+        data = response.json()
+        
+        self.assertEqual(data['bucket_seconds'], 1800)
+        self.assertEqual(len(data['timestamps']), len(data['pv_power']))
+        self.assertIn(len(data['timestamps']), (12, 13))
+        self.assertEqual(data['pv_power_max'][0], 35)
+        self.assertEqual(data['load_power_min'][0], 5)
+        
+    def test_history_raw(self):
+        """Test that raw history returns every reading"""
+        data = self.client.get('/api/solar/data/history/', {'hours': 7, 'interval': 'raw'}).json()
+        
+        self.assertEqual(len(data['timestamps']), 36)
+        self.assertEqual(data['pv_power'][0], 35)
+        self.assertEqual(data['battery_power'][0], 17.5)
+
+class WindowStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        SolarControllerData.objects.bulk_create([
+            SolarControllerData(pv_array_power=i, battery_voltage=12 + i / 100, load_power=None if i % 2 else 10)
+            for i in range(101)
+        ])
+        
+    def test_single_query(self):
+        """Test that all statistics come from one query"""
+        with self.assertNumQueries(1):
+            stats = window_stats(24)
+        
+        self.assertEqual(stats['data_point_count'], 101)
+        self.assertEqual(stats['pv_power'], {'max': 100, 'min': 0, 'avg': 50, 'p50': 50, 'p95': 95})
+        self.assertAlmostEqual(stats['battery_voltage']['p95'], 12.95)
+        self.assertEqual(stats['load_power']['avg'], 10)
+        
+    def test_endpoint_is_cached(self):
+        """Test that repeated polls of the same window are served from the cache"""
+        self.assertEqual(self.client.get('/api/solar/data/stats/', {'hours': 24}).json()['data_point_count'], 101)
+        with self.assertNumQueries(0):
+            data = self.client.get('/api/solar/data/stats/', {'hours': 24}).json()
+        self.assertEqual(data['pv_power']['p50'], 50)
+        
+    def test_per_device(self):
+        """Test that ?device= filters the stats and is cached separately"""
+        SolarControllerData.objects.create(device='east', pv_array_power=500)
+        
+        self.assertEqual(self.client.get('/api/solar/data/stats/', {'hours': 24}).json()['data_point_count'], 102)
+        data = self.client.get('/api/solar/data/stats/', {'hours': 24, 'device': 'east'}).json()
+        self.assertEqual(data['data_point_count'], 1)
+        self.assertEqual(data['pv_power']['max'], 500)
+        self.assertEqual(self.client.get('/api/solar/data/stats/', {'hours': 24, 'device': 'local'}).json()['data_point_count'], 101)
+        
+    def test_empty_window(self):
+        SolarControllerData.objects.all().delete()
+        response = self.client.get('/api/solar/data/stats/', {'hours': 1})
+        self.assertEqual(response.status_code, 404)
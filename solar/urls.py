@@ -12,5 +12,6 @@ urlpatterns = [
     
     # Upload and cleanup endpoints
     path('api/solar/upload/', views.solar_data_upload, name='solar-upload'),
+    path('api/solar/upload/batch/', views.solar_data_upload_batch, name='solar-upload-batch'),
     path('api/solar/cleanup/', views.cleanup_solar_data, name='solar-cleanup'),
 ]
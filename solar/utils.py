@@ -4,9 +4,15 @@ Epever Tracer4210AN Data Reader utility for the solar app.
 This utility reads and interprets key data from the Epever Tracer4210AN solar charge controller.
 """
 
+import inspect
 import logging
+import time
+from collections import namedtuple
 from datetime import datetime
-from pymodbus.client import ModbusSerialClient
+from functools import lru_cache
+from pymodbus.client import ModbusSerialClient, ModbusTcpClient
+
+from .sampling import IntervalSummary
 
 # Set up logging
 logging.basicConfig(
@@ -15,10 +21,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Connection settings
+# Connection settings, used when no SolarController is registered
 SERIAL_PORT = '/dev/ttyACM0'
 BAUD_RATE = 115200
 DEVICE_ADDRESS = 1
+MODBUS_TCP_PORT = 502
 
 # Register definitions based on scan results
 # The values below are based on the Epever documentation
@@ -46,6 +53,15 @@ INPUT_REGISTERS = {
     'battery_temp': {'address': 0x3110, 'scale': 100, 'unit': '°C'},
     'controller_temp': {'address': 0x3111, 'scale': 100, 'unit': '°C'},
     'heat_sink_temp': {'address': 0x3112, 'scale': 100, 'unit': '°C'},
+    
+    # 0x3200 range (status bit fields, stored as read)
+    'battery_status': {'address': 0x3200, 'scale': 1, 'unit': ''},
+    'charging_status': {'address': 0x3201, 'scale': 1, 'unit': ''},
+    'discharging_status': {'address': 0x3202, 'scale': 1, 'unit': ''},
+    
+    # 0x3300 range (lifetime energy counters, 32 bits in a low/high register pair)
+    'energy_consumed_total': {'address': 0x330A, 'registers': 2, 'scale': 100, 'unit': 'kWh'},
+    'energy_generated_total': {'address': 0x3312, 'registers': 2, 'scale': 100, 'unit': 'kWh'},
 }
 
 HOLDING_REGISTERS = {
@@ -77,11 +93,64 @@ CHARGING_MODES = {
     1: "MPPT"
 }
 
-def connect_to_controller():
+# Fields reported under controller_info, the rest of INPUT_REGISTERS is real-time data
+CONTROLLER_INFO_FIELDS = list(INPUT_REGISTERS)[:8]
+
+# Registers closer together than this are read in one request, including the unused ones between them
+MAX_BLOCK_GAP = 8
+# Modbus allows at most 125 registers per read
+MAX_BLOCK_SIZE = 125
+# Extra attempts for a block read that fails
+BLOCK_RETRIES = 2
+
+# Seconds between reads of each section when polling continuously (0: every poll).
+# Rated info and settings rarely change, so the bus time goes to real-time data.
+POLL_INTERVALS = {
+    'controller_info': 3600,
+    'real_time_data': 0,
+    'settings': 300,
+}
+
+# One read request covering consecutive registers of a section: fields is a list of (name, reg_info)
+Block = namedtuple('Block', ['kind', 'section', 'start', 'count', 'fields'])
+
+def build_read_plan(registers, kind, section):
+    """
+    Coalesce a register map into as few block reads as possible.
+    kind is 'input' or 'holding', section is where read_all_data reports the values.
+    """
+    blocks = []
+    start = end = None
+    fields = []
+    for name, reg_info in sorted(registers.items(), key=lambda item: item[1]['address']):
+        address = reg_info['address']
+        last = address + reg_info.get('registers', 1) - 1
+        if fields and (address - end > MAX_BLOCK_GAP or last - start >= MAX_BLOCK_SIZE):
+            blocks.append(Block(kind, section, start, end - start + 1, fields))
+            fields = []
+        if not fields:
+            start = address
+        end = last
+        fields.append((name, reg_info))
+    if fields:
+        blocks.append(Block(kind, section, start, end - start + 1, fields))
+    return blocks
+
+# 0x3000-0x300E, 0x3100-0x3112, 0x3200-0x3202, 0x330A-0x3313 and 0x9000-0x900D
+READ_PLAN = (
+    build_read_plan({name: INPUT_REGISTERS[name] for name in CONTROLLER_INFO_FIELDS}, 'input', 'controller_info')
+    + build_read_plan(
+        {name: reg_info for name, reg_info in INPUT_REGISTERS.items() if name not in CONTROLLER_INFO_FIELDS},
+        'input', 'real_time_data'
+    )
+    + build_read_plan(HOLDING_REGISTERS, 'holding', 'settings')
+)
+
+def connect_to_controller(port=SERIAL_PORT, baudrate=BAUD_RATE):
     """Establish connection to the Tracer controller."""
     client = ModbusSerialClient(
-        port=SERIAL_PORT,
-        baudrate=BAUD_RATE,
+        port=port,
+        baudrate=baudrate,
         bytesize=8,
         parity='N',
         stopbits=1,
@@ -95,10 +164,27 @@ def connect_to_controller():
     logger.info("Successfully connected to the controller")
     return client
 
-def read_input_register(client, address, count=1):
+def connect_to_gateway(host, port=MODBUS_TCP_PORT):
+    """Establish connection to a Modbus TCP gateway in front of Tracer controllers."""
+    client = ModbusTcpClient(host, port=port, timeout=1)
+    
+    if not client.connect():
+        logger.error(f"Failed to connect to the gateway {host}:{port}")
+        return None
+    
+    logger.info(f"Successfully connected to the gateway {host}:{port}")
+    return client
+
+@lru_cache(maxsize=None)
+def _unit_keyword(client_class):
+    """Newer pymodbus releases renamed the slave argument of reads to device_id"""
+    parameters = inspect.signature(client_class.read_input_registers).parameters
+    return 'device_id' if 'device_id' in parameters else 'slave'
+
+def read_input_register(client, address, count=1, slave=DEVICE_ADDRESS):
     """Read input registers from the controller."""
     try:
-        result = client.read_input_registers(address=address, count=count, slave=DEVICE_ADDRESS)
+        result = client.read_input_registers(address=address, count=count, **{_unit_keyword(type(client)): slave})
         if hasattr(result, 'registers'):
             return result.registers
         logger.error(f"Error reading input register {hex(address)}: {result}")
@@ -107,10 +193,10 @@ def read_input_register(client, address, count=1):
         logger.error(f"Exception reading input register {hex(address)}: {e}")
         return None
 
-def read_holding_register(client, address, count=1):
+def read_holding_register(client, address, count=1, slave=DEVICE_ADDRESS):
     """Read holding registers from the controller."""
     try:
-        result = client.read_holding_registers(address=address, count=count, slave=DEVICE_ADDRESS)
+        result = client.read_holding_registers(address=address, count=count, **{_unit_keyword(type(client)): slave})
         if hasattr(result, 'registers'):
             return result.registers
         logger.error(f"Error reading holding register {hex(address)}: {result}")
@@ -119,7 +205,38 @@ def read_holding_register(client, address, count=1):
         logger.error(f"Exception reading holding register {hex(address)}: {e}")
         return None
 
-def read_all_data(client):
+def read_block(client, block, retries=BLOCK_RETRIES, slave=DEVICE_ADDRESS):
+    """Read a block of registers, retrying only this block if it fails."""
+    read = read_input_register if block.kind == 'input' else read_holding_register
+    for attempt in range(retries + 1):
+        registers = read(client, block.start, block.count, slave=slave)
+        if registers is not None and len(registers) >= block.count:
+            return registers
+        if attempt < retries:
+            logger.warning(f"Retrying {block.kind} registers {hex(block.start)}-{hex(block.start + block.count - 1)}")
+    return None
+
+def decode_block(block, registers):
+    """Scaled values of a block's fields, with the mode and battery type mapped to names."""
+    values = {}
+    for name, reg_info in block.fields:
+        offset = reg_info['address'] - block.start
+        raw = registers[offset]
+        if reg_info.get('registers', 1) == 2:
+            # 32-bit values come low word first
+            raw |= registers[offset + 1] << 16
+        value = raw / reg_info['scale'] if reg_info['scale'] > 0 else raw
+        
+        # Special handling for charging mode and battery type
+        if name == 'charging_mode' and value in CHARGING_MODES:
+            value = CHARGING_MODES[int(value)]
+        elif name == 'battery_type' and value in BATTERY_TYPES:
+            value = BATTERY_TYPES[int(value)]
+        
+        values[name] = value
+    return values
+
+def read_all_data(client, plan=READ_PLAN, slave=DEVICE_ADDRESS):
     """Read all relevant data from the controller."""
     data = {
         'timestamp': datetime.now().isoformat(),
@@ -128,73 +245,49 @@ def read_all_data(client):
         'settings': {}
     }
     
-    # Read controller info
-    for name, reg_info in list(INPUT_REGISTERS.items())[:8]:  # First 8 are controller info
-        registers = read_input_register(client, reg_info['address'])
-        if registers:
-            value = registers[0] / reg_info['scale'] if reg_info['scale'] > 0 else registers[0]
-            
-            # Special handling for charging mode
-            if name == 'charging_mode' and value in CHARGING_MODES:
-                value = CHARGING_MODES[int(value)]
-                
-            data['controller_info'][name] = {
-                'value': value,
-                'unit': reg_info['unit']
-            }
-    
-    # Read real-time data
-    for name, reg_info in list(INPUT_REGISTERS.items())[8:]:  # Remaining are real-time data
-        registers = read_input_register(client, reg_info['address'])
-        if registers:
-            value = registers[0] / reg_info['scale'] if reg_info['scale'] > 0 else registers[0]
-            data['real_time_data'][name] = {
+    for block in plan:
+        registers = read_block(client, block, slave=slave)
+        if registers is None:
+            continue
+        units = {name: reg_info['unit'] for name, reg_info in block.fields}
+        for name, value in decode_block(block, registers).items():
+            data[block.section][name] = {
                 'value': value,
-                'unit': reg_info['unit']
-            }
-    
-    # Read settings
-    for name, reg_info in HOLDING_REGISTERS.items():
-        registers = read_holding_register(client, reg_info['address'])
-        if registers:
-            value = registers[0] / reg_info['scale'] if reg_info['scale'] > 0 else registers[0]
-            
-            # Special handling for battery type
-            if name == 'battery_type' and value in BATTERY_TYPES:
-                value = BATTERY_TYPES[int(value)]
-                
-            data['settings'][name] = {
-                'value': value,
-                'unit': reg_info['unit']
+                'unit': units[name]
             }
     
     return data
 
-def get_solar_data():
-    """Get solar data and format it for the database."""
+def flatten_data(raw_data):
+    """Flatten the output of read_all_data into field values for database storage."""
+    data = {}
+    for section in ('controller_info', 'real_time_data', 'settings'):
+        for name, info in raw_data[section].items():
+            data[name] = info['value']
+    return data
+
+def get_solar_data(samples=1, sample_interval=1.0):
+    """
+    Get solar data and format it for the database.
+    
+    With several samples, the controller is read that many times
+    sample_interval seconds apart over one connection and the readings are
+    summarized into one, with min/max envelopes (see solar.sampling).
+    """
     client = connect_to_controller()
     if not client:
         return None
     
     try:
-        raw_data = read_all_data(client)
-        
-        # Prepare the data in a flat format for database storage
-        data = {}
-        
-        # Extract controller info
-        for name, info in raw_data['controller_info'].items():
-            data[name] = info['value']
-        
-        # Extract real-time data
-        for name, info in raw_data['real_time_data'].items():
-            data[name] = info['value']
-        
-        # Extract settings
-        for name, info in raw_data['settings'].items():
-            data[name] = info['value']
-        
-        return data
+        summary = IntervalSummary()
+        for sample in range(samples):
+            if sample:
+                time.sleep(sample_interval)
+            started = time.monotonic()
+            raw_data = read_all_data(client)
+            logger.debug(f"Read controller in {time.monotonic() - started:.2f}s")
+            summary.add(flatten_data(raw_data))
+        return summary.result()
     
     except Exception as e:
         logger.error(f"Error getting solar data: {e}")
@@ -204,3 +297,174 @@ def get_solar_data():
         if client:
             client.close()
             logger.info("Connection closed")
+
+class ControllerSession:
+    """
+    A long-lived connection to the controller for repeated polling.
+    
+    The serial port stays open between polls. A poll that gets no data marks
+    the connection unhealthy, and it is reopened with exponential backoff so
+    that a missing controller is not hammered. Poll latency and error
+    counters are kept for reporting.
+    
+    After consecutive failed polls the controller is skipped with exponential
+    backoff as well. On a connection shared with other controllers (see
+    solar.polling) a controller that doesn't answer leaves the connection
+    open, it is only reopened when the transport itself went down.
+    
+    Each section is only read when its entry in poll_intervals has elapsed.
+    The last values of sections that were not read are returned from a cache,
+    and refresh() makes the next poll read a section again.
+    """
+    
+    def __init__(self, connect=connect_to_controller, initial_backoff=1.0, max_backoff=60.0,
+                 poll_intervals=None, plan=READ_PLAN, slave=DEVICE_ADDRESS):
+        self.connect = connect
+        self.slave = slave
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.poll_intervals = {**POLL_INTERVALS, **(poll_intervals or {})}
+        self.plan = plan
+        self._last_read = {}
+        self._cached = {}
+        self.client = None
+        self._backoff = initial_backoff
+        self._next_attempt = 0.0
+        self._connected_before = False
+        self._failures = 0
+        self._skip_until = 0.0
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.polls = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+    
+    def stats(self):
+        """Poll counters and latencies in seconds since the last reset"""
+        successful = self.polls - self.errors
+        return {
+            'polls': self.polls,
+            'errors': self.errors,
+            'reconnects': self.reconnects,
+            'connected': self.is_healthy(),
+            'last_latency': self.last_latency,
+            'avg_latency': self.total_latency / successful if successful else None,
+            'max_latency': self.max_latency,
+        }
+    
+    def is_healthy(self):
+        return self.client is not None and getattr(self.client, 'connected', True)
+    
+    def _ensure_connected(self):
+        if self.is_healthy():
+            return True
+        self.close()
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return False
+        
+        try:
+            self.client = self.connect()
+        except Exception as e:
+            logger.error(f"Error connecting to the controller: {e}")
+            self.client = None
+        if self.client is None:
+            self._next_attempt = now + self._backoff
+            logger.warning(f"Controller unavailable, retrying in {self._backoff:.0f}s")
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            return False
+        
+        if self._connected_before:
+            self.reconnects += 1
+        self._connected_before = True
+        self._backoff = self.initial_backoff
+        return True
+    
+    def refresh(self, section=None):
+        """Read a section (default: all of them) on the next poll regardless of its interval"""
+        if section is None:
+            self._last_read.clear()
+        else:
+            self._last_read.pop(section, None)
+    
+    def _due_blocks(self, now):
+        due = set()
+        for section, interval in self.poll_intervals.items():
+            last = self._last_read.get(section)
+            if last is None or now - last >= interval:
+                due.add(section)
+        return [block for block in self.plan if block.section in due]
+    
+    @property
+    def shared(self):
+        """Whether other sessions poll other controllers over the same connection"""
+        return getattr(self.connect, 'users', 1) > 1
+    
+    def _failed(self):
+        """Count a failed poll, skipping the controller for a while once failures repeat"""
+        self.errors += 1
+        self._failures += 1
+        if self._failures > 1:
+            delay = min(self.initial_backoff * 2 ** (self._failures - 2), self.max_backoff)
+            self._skip_until = time.monotonic() + delay
+            logger.warning(f"Controller {self.slave} failed {self._failures} polls in a row, skipping it for {delay:.0f}s")
+        # Only this controller failed if the shared transport is still up, the others keep using it
+        if not self.shared or not self.is_healthy():
+            # Reopen the port (or the bus, if the transport went down) before the next poll
+            self.close()
+    
+    def poll(self):
+        """Read the controller, returning field values for database storage or None"""
+        self.polls += 1
+        if time.monotonic() < self._skip_until:
+            self.errors += 1
+            return None
+        if not self._ensure_connected():
+            self.errors += 1
+            return None
+        
+        started = time.monotonic()
+        try:
+            raw_data = read_all_data(self.client, plan=self._due_blocks(started), slave=self.slave)
+        except Exception as e:
+            logger.error(f"Error polling the controller: {e}")
+            raw_data = None
+        
+        # Sections read on every poll must come back whole, cached values would be stale
+        required = [
+            (block.section, name) for block in self.plan if not self.poll_intervals.get(block.section)
+            for name, _ in block.fields
+        ]
+        if not raw_data or not any(raw_data[section] for section in self.poll_intervals) \
+                or not all(name in raw_data[section] for section, name in required):
+            self._failed()
+            return None
+        self._failures = 0
+        
+        # Sections that were read replace their cached values, failed ones are tried again next poll
+        for section in self.poll_intervals:
+            if raw_data[section]:
+                self._cached[section] = {name: info['value'] for name, info in raw_data[section].items()}
+                self._last_read[section] = started
+        
+        latency = time.monotonic() - started
+        self.last_latency = latency
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        
+        data = {}
+        for values in self._cached.values():
+            data.update(values)
+        return data
+    
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception as e:
+                logger.error(f"Error closing the controller connection: {e}")
+            self.client = None
@@ -3,14 +3,22 @@ from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, DataError
 from django.utils import timezone
 from datetime import timedelta
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import json
+import logging
 
-from .models import SolarControllerData, SolarDailyAggregate, SolarMonthlyAggregate, SolarYearlyAggregate, SolarTotalAggregate
+from .models import SolarControllerData, SolarControllerSettings, SolarDailyAggregate, SolarMonthlyAggregate, SolarYearlyAggregate, SolarTotalAggregate
 from .utils import get_solar_data
+from .ingest import store_sample, store_batch, flatten_upload, broadcast_sample
+from .accumulator import today
+from .energy import site_days
+from .history import SERIES, DEFAULT_POINTS, MAX_POINTS, choose_bucket, downsample, cached_window_stats
+from wyandata.retention import RetentionEngine
+
+logger = logging.getLogger(__name__)
 
 # REST API ViewSet for retrieving solar data
 class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
@@ -20,10 +28,18 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = SolarControllerData.objects.all().order_by('-timestamp')
     permission_classes = [AllowAny]  # Adjust permissions as needed
     
+    def get_queryset(self):
+        """Readings of one controller with ?device=, of all of them otherwise"""
+        queryset = self.queryset
+        device = self.request.query_params.get('device')
+        if device:
+            queryset = queryset.filter(device=device)
+        return queryset
+    
     def list(self, request):
         """Get the latest solar data"""
         try:
-            latest_data = self.queryset.first()
+            latest_data = self.get_queryset().first()
             if not latest_data:
                 return Response(
                     {"error": "No solar data available"}, 
@@ -40,18 +56,18 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
     
     @action(detail=False, methods=['get'])
     def history(self, request):
-        """Get historical solar data"""
+        """
+        Get historical solar data.
+        
+        interval=auto (default) averages readings into time buckets sized to give
+        about `points` values, interval=hourly uses hour buckets and interval=raw
+        returns every reading. Bucketed responses also carry each bucket's min/max.
+        """
         hours = int(request.query_params.get('hours', 24))
-        interval = request.query_params.get('interval', 'raw')
+        interval = request.query_params.get('interval', 'auto')
+        points = min(int(request.query_params.get('points', DEFAULT_POINTS)), MAX_POINTS)
         
         since = timezone.now() - timedelta(hours=hours)
-        data_points = self.queryset.filter(timestamp__gte=since)
-        
-        if interval == 'hourly' and hours > 24:
-            # Group by hour for longer periods
-            # This would require a more complex query with aggregation
-            # For simplicity, just sample one reading per hour
-            pass
         
         result = {
             "timestamps": [],
@@ -61,63 +77,58 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
             "load_power": []
         }
         
-        for entry in data_points:
-            result["timestamps"].append(entry.timestamp.isoformat())
-            result["pv_power"].append(entry.pv_array_power)
-            result["battery_voltage"].append(entry.battery_voltage)
-            result["battery_power"].append(entry.battery_charging_power)
-            result["load_power"].append(entry.load_power)
+        if interval == 'raw':
+            # Plain tuples, so no model instances are built for long windows
+            rows = self.get_queryset().filter(timestamp__gte=since).values_list(
+                'timestamp', *SERIES.values()
+            ).iterator(chunk_size=5000)
+            for timestamp, *values in rows:
+                result["timestamps"].append(timestamp.isoformat())
+                for name, value in zip(SERIES, values):
+                    result[name].append(value)
+            return Response(result)
+        
+        bucket = 3600 if interval == 'hourly' else choose_bucket(timedelta(hours=hours), points)
+        result["bucket_seconds"] = bucket
+        for name in SERIES:
+            result[f"{name}_min"] = []
+            result[f"{name}_max"] = []
+        
+        for bucket_start, *values in downsample(since, bucket, device=request.query_params.get('device')):
+            result["timestamps"].append(bucket_start.isoformat())
+            for index, name in enumerate(SERIES):
+                average, minimum, maximum = values[index * 3:index * 3 + 3]
+                result[name].append(average)
+                result[f"{name}_min"].append(minimum)
+                result[f"{name}_max"].append(maximum)
         
         return Response(result)
     
     @action(detail=False, methods=['get'])
     def stats(self, request):
-        """Get statistics for solar data"""
+        """Get statistics for solar data (of one controller with ?device=), computed in the database and cached briefly"""
         hours = int(request.query_params.get('hours', 24))
-        since = timezone.now() - timedelta(hours=hours)
-        
-        data_points = self.queryset.filter(timestamp__gte=since)
         
-        if not data_points:
+        stats = cached_window_stats(hours, device=request.query_params.get('device'))
+        if stats is None:
             return Response(
                 {"error": "No data available for the specified period"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Calculate some basic statistics
-        pv_power_values = [dp.pv_array_power for dp in data_points if dp.pv_array_power is not None]
-        battery_voltage_values = [dp.battery_voltage for dp in data_points if dp.battery_voltage is not None]
-        load_power_values = [dp.load_power for dp in data_points if dp.load_power is not None]
-        
-        stats = {
-            "period_hours": hours,
-            "data_point_count": data_points.count(),
-            "pv_power": {
-                "max": max(pv_power_values) if pv_power_values else None,
-                "min": min(pv_power_values) if pv_power_values else None,
-                "avg": sum(pv_power_values) / len(pv_power_values) if pv_power_values else None
-            },
-            "battery_voltage": {
-                "max": max(battery_voltage_values) if battery_voltage_values else None,
-                "min": min(battery_voltage_values) if battery_voltage_values else None,
-                "avg": sum(battery_voltage_values) / len(battery_voltage_values) if battery_voltage_values else None
-            },
-            "load_power": {
-                "max": max(load_power_values) if load_power_values else None,
-                "min": min(load_power_values) if load_power_values else None,
-                "avg": sum(load_power_values) / len(load_power_values) if load_power_values else None
-            }
-        }
-        
         return Response(stats)
     
     @action(detail=False, methods=['get'])
     def daily_stats(self, request):
-        """Get daily aggregated solar stats"""
+        """Get daily aggregated solar stats over all controllers (or one with ?device=), with today's running totals"""
         days = int(request.query_params.get('days', 30))
         since = timezone.now().date() - timedelta(days=days)
         
-        daily_stats = SolarDailyAggregate.objects.filter(date__gte=since)
+        daily_aggregates = SolarDailyAggregate.objects.filter(date__gte=since)
+        device = request.query_params.get('device')
+        if device:
+            daily_aggregates = daily_aggregates.filter(device=device)
+        daily_stats = site_days(daily_aggregates)
         
         data = {
             "dates": [],
@@ -128,11 +139,14 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
         }
         
         for stat in daily_stats:
-            data["dates"].append(stat.date.isoformat())
-            data["energy_produced"].append(stat.energy_produced)
-            data["energy_consumed"].append(stat.energy_consumed)
-            data["peak_power"].append(stat.peak_power)
-            data["sunshine_hours"].append(stat.sunshine_hours)
+            data["dates"].append(stat['date'].isoformat())
+            data["energy_produced"].append(stat['produced'])
+            data["energy_consumed"].append(stat['consumed'])
+            data["peak_power"].append(stat['peak'])
+            data["sunshine_hours"].append(stat['sunshine'])
+        
+        # Today is only aggregated after midnight, so report the running totals
+        data["today"] = today.summary()
         
         return Response(data)
 
@@ -208,9 +222,11 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def format_solar_data(self, data_point):
-        """Format a solar data point for API response"""
+        """Format a solar data point for API response, with the current controller settings"""
+        settings = SolarControllerSettings.current(data_point.device) or SolarControllerSettings()
         return {
             "timestamp": data_point.timestamp.isoformat(),
+            "device": data_point.device,
             "pv_array": {
                 "voltage": data_point.pv_array_voltage,
                 "current": data_point.pv_array_current,
@@ -221,8 +237,8 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
                 "charging_current": data_point.battery_charging_current,
                 "charging_power": data_point.battery_charging_power,
                 "temperature": data_point.battery_temp,
-                "type": data_point.battery_type,
-                "capacity": data_point.battery_capacity
+                "type": settings.battery_type,
+                "capacity": settings.battery_capacity
             },
             "load": {
                 "voltage": data_point.load_voltage,
@@ -232,16 +248,23 @@ class SolarDataViewSet(viewsets.ReadOnlyModelViewSet):
             "controller": {
                 "temperature": data_point.controller_temp,
                 "heat_sink_temperature": data_point.heat_sink_temp,
-                "charging_mode": data_point.charging_mode
+                "charging_mode": settings.charging_mode,
+                "battery_status": data_point.battery_status,
+                "charging_status": data_point.charging_status,
+                "discharging_status": data_point.discharging_status
+            },
+            "energy_counters": {
+                "generated_total": data_point.energy_generated_total,
+                "consumed_total": data_point.energy_consumed_total
             },
             "settings": {
-                "high_voltage_disconnect": data_point.high_voltage_disconnect,
-                "charging_limit_voltage": data_point.charging_limit_voltage,
-                "equalization_voltage": data_point.equalization_voltage,
-                "boost_voltage": data_point.boost_voltage,
-                "float_voltage": data_point.float_voltage,
-                "low_voltage_reconnect": data_point.low_voltage_reconnect,
-                "low_voltage_disconnect": data_point.low_voltage_disconnect
+                "high_voltage_disconnect": settings.high_voltage_disconnect,
+                "charging_limit_voltage": settings.charging_limit_voltage,
+                "equalization_voltage": settings.equalization_voltage,
+                "boost_voltage": settings.boost_voltage,
+                "float_voltage": settings.float_voltage,
+                "low_voltage_reconnect": settings.low_voltage_reconnect,
+                "low_voltage_disconnect": settings.low_voltage_disconnect
             }
         }
 
@@ -255,67 +278,14 @@ def solar_data_upload(request):
     try:
         data = request.data
         
-        # Extract the data we need for our model
-        controller_data = {}
-        
-        # Process controller info
-        if 'controller_info' in data:
-            for key, info in data['controller_info'].items():
-                controller_data[key] = info['value']
-        
-        # Process real-time data
-        if 'real_time_data' in data:
-            for key, info in data['real_time_data'].items():
-                controller_data[key] = info['value']
-        
-        # Process settings
-        if 'settings' in data:
-            for key, info in data['settings'].items():
-                controller_data[key] = info['value']
-        
-        # Extract individual fields if data is flat
-        if not controller_data:
-            controller_data = data
+        # Readings may come sectioned like read_all_data() output, or flat
+        controller_data = flatten_upload(data)
         
-        # Create and save the model
-        solar_data = SolarControllerData(**controller_data)
-        solar_data.save()
-        
-        # Format data for WebSocket
-        ws_data = {
-            "timestamp": solar_data.timestamp.isoformat(),
-            "pv_array": {
-                "voltage": solar_data.pv_array_voltage,
-                "current": solar_data.pv_array_current,
-                "power": solar_data.pv_array_power
-            },
-            "battery": {
-                "voltage": solar_data.battery_voltage,
-                "charging_current": solar_data.battery_charging_current,
-                "charging_power": solar_data.battery_charging_power,
-                "temperature": solar_data.battery_temp
-            },
-            "load": {
-                "voltage": solar_data.load_voltage,
-                "current": solar_data.load_current,
-                "power": solar_data.load_power
-            },
-            "controller": {
-                "temperature": solar_data.controller_temp,
-                # Ensure charging_mode is consistently a string
-                "charging_mode": str(solar_data.charging_mode) if solar_data.charging_mode is not None else None
-            }
-        }
+        # Save the readings, logging the settings only if they changed
+        solar_data, controller_settings = store_sample(controller_data)
         
         # Send update to all WebSocket clients
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            "solar_data",
-            {
-                "type": "solar_update",
-                "data": ws_data
-            }
-        )
+        broadcast_sample(solar_data, controller_settings)
         
         return Response({
             "status": "success", 
@@ -329,6 +299,62 @@ def solar_data_upload(request):
             "message": str(e)
         }, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+@permission_classes([AllowAny])  # For internal network use only
+def solar_data_upload_batch(request):
+    """
+    Endpoint to receive a batch of readings buffered by a remote collector
+
+    Body: {"device": "<collector name>", "readings": [...]} where each reading
+    carries the timestamp it was taken at. Readings already stored for the
+    device at that time are skipped, so a batch can be sent again safely.
+    Only the newest reading is broadcast to WebSocket clients.
+    """
+    try:
+        data = request.data
+        if isinstance(data, list):
+            device, readings = request.query_params.get('device', 'local'), data
+        elif hasattr(data, 'get'):
+            device, readings = data.get('device', 'local'), data.get('readings')
+        else:
+            raise ValueError("Expected an object with the device and its readings")
+        if not isinstance(readings, list):
+            raise ValueError("Expected a list of readings")
+        
+        result = store_batch(device, readings)
+        if result['newest'] is not None:
+            broadcast_sample(result['newest'], result['settings'])
+        
+        return Response({
+            "status": "success",
+            "device": device,
+            "received": result['received'],
+            "inserted": result['inserted'],
+            "duplicates": result['duplicates'],
+            "errors": result['errors'],
+            "newest": result['newest'].timestamp if result['newest'] is not None else None
+        }, status=status.HTTP_201_CREATED)
+    
+    # Collectors drop batches answered with a 4xx, so only a bad payload gets one.
+    # Anything else is worth retrying and keeps the batch in the collector's journal
+    except (ValueError, ValidationError, DataError) as e:
+        return Response({
+            "status": "error", 
+            "message": str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    except DatabaseError as e:
+        logger.error(f"Database error storing solar batch: {e}")
+        return Response({
+            "status": "error",
+            "message": "Database unavailable, try again later"
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except Exception as e:
+        logger.exception(f"Error storing solar batch: {e}")
+        return Response({
+            "status": "error",
+            "message": str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 @api_view(['POST'])
 @permission_classes([AllowAny])  # For internal network use only
 def cleanup_solar_data(request):
@@ -339,19 +365,17 @@ def cleanup_solar_data(request):
         # Default to 7 days if not specified
         days = int(request.data.get('days', 7))
         
-        # Calculate the cutoff date
-        cutoff_date = timezone.now() - timedelta(days=days)
-        
-        # Delete old records
-        old_records = SolarControllerData.objects.filter(timestamp__lt=cutoff_date)
-        count = old_records.count()
-        old_records.delete()
+        # Aggregates are brought up to date before any raw data is removed
+        result = RetentionEngine().apply(SolarControllerData, keep=timedelta(days=days))
+        cutoff_date = result.cutoff
+        count = result.rows_removed
         
         return Response({
             "status": "success", 
             "message": f"Deleted {count} records older than {cutoff_date.strftime('%Y-%m-%d')}",
             "deleted_count": count,
-            "cutoff_date": cutoff_date
+            "cutoff_date": cutoff_date,
+            "complete": result.complete
         })
         
     except Exception as e:
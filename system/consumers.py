@@ -156,8 +156,8 @@ class SystemMetricsConsumer(AsyncWebsocketConsumer):
         metrics = data.get('metrics', {})
         timestamp = timezone.now()
         
-        # Ensure host exists
-        host = await self.get_host_by_hostname(hostname)
+        # Store the whole message in one round trip, updating the host's last seen timestamp
+        host = await self.store_metrics(hostname, metrics, timestamp)
         if not host:
             print(f"ERROR: Metrics rejected - unknown host {hostname}")
             await self.send(text_data=json.dumps({
@@ -166,13 +166,6 @@ class SystemMetricsConsumer(AsyncWebsocketConsumer):
             }))
             return
         
-        # Update host's last seen timestamp
-        await self.update_host_last_seen(host)
-        
-        # Store metrics without printing details
-        for metric_name, value_data in metrics.items():
-            await self.store_metric(host, metric_name, value_data, timestamp)
-        
         # Broadcast to all connected clients
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -347,13 +340,6 @@ class SystemMetricsConsumer(AsyncWebsocketConsumer):
         except Host.DoesNotExist:
             return None
     
-    @database_sync_to_async
-    def update_host_last_seen(self, host):
-        """Update a host's last_seen timestamp"""
-        host.last_seen = timezone.now()
-        host.save(update_fields=['last_seen'])
-        return host
-    
     @database_sync_to_async
     def update_storage_devices(self, host, storage_devices_data):
         """Update a host's storage devices"""
@@ -396,24 +382,66 @@ class SystemMetricsConsumer(AsyncWebsocketConsumer):
         NetworkInterface.objects.filter(host=host).exclude(id__in=existing_ids).delete()
     
     @database_sync_to_async
-    def store_metric(self, host, metric_name, value_data, timestamp):
-        """Store a metric value"""
-        # Get or create the metric type
-        category = value_data.get('category', 'OTHER')
-        unit = value_data.get('unit', '')
-        data_type = value_data.get('data_type', 'FLOAT')
+    @with_retry(max_retries=5, retry_delay=0.2)
+    def store_metrics(self, hostname, metrics, timestamp):
+        """
+        Store all metric values of a message, returning the host or None if it isn't registered.
         
-        metric_type, _ = MetricType.objects.get_or_create(
-            name=metric_name,
-            defaults={
-                'description': f'Auto-created metric for {metric_name}',
-                'unit': unit,
-                'data_type': data_type,
-                'category': category,
-            }
-        )
+        Metric types, storage devices and network interfaces are looked up once
+        for the whole message, and the values are inserted with one bulk_create.
+        """
+        try:
+            host = Host.objects.get(hostname=hostname)
+        except Host.DoesNotExist:
+            return None
+        
+        host.last_seen = timezone.now()
+        host.save(update_fields=['last_seen'])
+        
+        # Get or create the metric types
+        metric_types = {}
+        for metric_type in MetricType.objects.filter(name__in=list(metrics)):
+            metric_types.setdefault(metric_type.name, metric_type)
+        new_types = [
+            MetricType(
+                name=metric_name,
+                description=f'Auto-created metric for {metric_name}',
+                unit=value_data.get('unit', ''),
+                data_type=value_data.get('data_type', 'FLOAT'),
+                category=value_data.get('category', 'OTHER'),
+            )
+            for metric_name, value_data in metrics.items() if metric_name not in metric_types
+        ]
+        if new_types:
+            MetricType.objects.bulk_create(new_types)
+            metric_types.update((metric_type.name, metric_type) for metric_type in new_types)
+        
+        # Context references, only looked up if any metric names one
+        storage_device_names = {value_data['storage_device'] for value_data in metrics.values() if value_data.get('storage_device')}
+        storage_devices = {
+            device.name: device for device in StorageDevice.objects.filter(host=host, name__in=storage_device_names)
+        } if storage_device_names else {}
+        network_interface_names = {value_data['network_interface'] for value_data in metrics.values() if value_data.get('network_interface')}
+        network_interfaces = {
+            interface.name: interface for interface in NetworkInterface.objects.filter(host=host, name__in=network_interface_names)
+        } if network_interface_names else {}
+        
+        metric_values = []
+        for metric_name, value_data in metrics.items():
+            try:
+                metric_values.append(self.build_metric_value(
+                    host, metric_types[metric_name], value_data, timestamp, storage_devices, network_interfaces
+                ))
+            except (TypeError, ValueError) as e:
+                print(f"ERROR: Invalid value for metric {metric_name} from {hostname}: {e}")
         
-        # Create the metric value
+        MetricValue.objects.bulk_create(metric_values)
+        return host
+    
+    @staticmethod
+    def build_metric_value(host, metric_type, value_data, timestamp, storage_devices, network_interfaces):
+        """An unsaved MetricValue for one metric of a message"""
+        data_type = value_data.get('data_type', 'FLOAT')
         value = value_data.get('value')
         metric_value = MetricValue(
             host=host,
@@ -432,24 +460,8 @@ class SystemMetricsConsumer(AsyncWebsocketConsumer):
             metric_value.bool_value = bool(value) if value is not None else None
         
         # Set context references if provided
-        storage_device_name = value_data.get('storage_device')
-        if storage_device_name:
-            try:
-                metric_value.storage_device = StorageDevice.objects.get(
-                    host=host, name=storage_device_name
-                )
-            except StorageDevice.DoesNotExist:
-                pass
-        network_interface_name = value_data.get('network_interface')
-        if network_interface_name:
-            try:
-                metric_value.network_interface = NetworkInterface.objects.get(
-                    host=host, name=network_interface_name
-                )
-            except NetworkInterface.DoesNotExist:
-                pass
-        
-        metric_value.save()
+        metric_value.storage_device = storage_devices.get(value_data.get('storage_device'))
+        metric_value.network_interface = network_interfaces.get(value_data.get('network_interface'))
         return metric_value
     
     @database_sync_to_async
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from wyandata.retention import RetentionEngine, get_policies
+
+class Command(BaseCommand):
+    help = 'Remove raw time-series data past the retention configured in RETENTION_POLICIES'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            action='append',
+            help='Only handle this model, e.g. weather.OutdoorWeatherReading (may be repeated)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the rows that would be removed'
+        )
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            help='Seconds to spend before stopping, the rest is left for the next run (default: RETENTION_TIME_BUDGET)'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Rows deleted per transaction (default: RETENTION_CHUNK_SIZE)'
+        )
+
+    def handle(self, *args, **options):
+        models = None
+        if options['model']:
+            models = [model for model, _ in get_policies() if model._meta.label in options['model']]
+            if not models:
+                raise CommandError('None of the given models are configured in RETENTION_POLICIES')
+
+        engine = RetentionEngine(chunk_size=options['chunk_size'], time_budget=options['time_budget'])
+        results = engine.run(models, dry_run=options['dry_run'])
+
+        for result in results:
+            if options['dry_run']:
+                self.stdout.write(f'{result.label}: would remove {result.rows_removed} rows older than {result.cutoff}')
+                continue
+            message = (
+                f'{result.label}: removed {result.rows_removed} rows older than {result.cutoff} '
+                f'({result.partitions_dropped} partitions, {result.chunks} chunks) in {result.seconds:.1f}s, '
+                f'{result.rows_per_second:.0f} rows/sec'
+            )
+            if result.paused_seconds:
+                message += f', paused {result.paused_seconds:.0f}s for ingest'
+            if result.complete:
+                self.stdout.write(self.style.SUCCESS(message))
+            else:
+                self.stdout.write(self.style.WARNING(message + ', incomplete'))
@@ -0,0 +1,139 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from datetime import datetime, timedelta
+import statistics
+import threading
+import time
+
+class Command(BaseCommand):
+    help = (
+        'Compare retention by row DELETE with dropping partitions, measuring cleanup time '
+        'and the latency of concurrent inserts. Uses scratch tables that are removed afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=500000,
+            help='Rows to seed into each scratch table (default: 500000)'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=14,
+            help='Days of history the rows are spread over (default: 14)'
+        )
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=7,
+            help='Days to keep when cleaning up (default: 7)'
+        )
+
+    def handle(self, *args, **options):
+        end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        start = end - timedelta(days=options['days'])
+        cutoff = end - timedelta(days=options['keep'])
+
+        results = []
+        for mode in ('delete', 'partitions'):
+            table = f'benchmark_retention_{mode}'
+            try:
+                self._create_table(table, mode == 'partitions', start, end, options['rows'])
+                self.stdout.write(f'Seeded {table} with {options["rows"]} rows')
+                results.append((mode, *self._run(table, mode, cutoff)))
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+        self.stdout.write('')
+        self.stdout.write(f'{"Method":<12}{"Removed":>10}{"Cleanup s":>11}{"Inserts":>9}{"p50 ms":>9}{"p99 ms":>9}{"Max ms":>9}')
+        for mode, removed, seconds, latencies in results:
+            self.stdout.write(
+                f'{mode:<12}{removed:>10}{seconds:>11.2f}{len(latencies):>9}'
+                f'{self._percentile(latencies, 50):>9.1f}{self._percentile(latencies, 99):>9.1f}'
+                f'{max(latencies, default=0):>9.1f}'
+            )
+
+    def _create_table(self, table, partitioned, start, end, rows):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+            if partitioned:
+                cursor.execute(
+                    f'CREATE TABLE {table} (id bigint GENERATED BY DEFAULT AS IDENTITY, time timestamp NOT NULL, '
+                    f'value double precision) PARTITION BY RANGE (time)'
+                )
+                day = start
+                while day < end:
+                    cursor.execute(
+                        f"CREATE TABLE {table}_p{day:%Y%m%d} PARTITION OF {table} "
+                        f"FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')"
+                    )
+                    day += timedelta(days=1)
+                cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, time)')
+            else:
+                cursor.execute(
+                    f'CREATE TABLE {table} (id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, '
+                    f'time timestamp NOT NULL, value double precision)'
+                )
+            cursor.execute(f'CREATE INDEX ON {table} (time)')
+
+            # Spread the rows evenly over the history
+            step = (end - start).total_seconds() / rows
+            cursor.execute(
+                f"INSERT INTO {table} (time, value) "
+                f"SELECT %s::timestamp + (n * %s) * interval '1 second', random() FROM generate_series(0, %s - 1) n",
+                [start, step, rows]
+            )
+            cursor.execute(f'ANALYZE {table}')
+
+    def _run(self, table, mode, cutoff):
+        """Clean up while another connection inserts rows, returning removed rows, seconds and insert latencies"""
+        latencies = []
+        stop = threading.Event()
+
+        def ingest():
+            try:
+                with connections['default'].cursor() as cursor:
+                    while not stop.is_set():
+                        began = time.perf_counter()
+                        cursor.execute(f'INSERT INTO {table} (time, value) VALUES (%s, 0)', [datetime.now()])
+                        latencies.append((time.perf_counter() - began) * 1000)
+                        time.sleep(0.005)
+            finally:
+                connections.close_all()
+
+        writer = threading.Thread(target=ingest)
+        writer.start()
+        time.sleep(0.5)  # Let ingest reach a steady state first
+        latencies.clear()
+
+        began = time.perf_counter()
+        with connection.cursor() as cursor:
+            if mode == 'delete':
+                cursor.execute(f'DELETE FROM {table} WHERE time < %s', [cutoff])
+                removed = cursor.rowcount
+            else:
+                removed = 0
+                day = cutoff - timedelta(days=1)
+                while True:
+                    partition = f'{table}_p{day:%Y%m%d}'
+                    cursor.execute('SELECT to_regclass(%s)', [partition])
+                    if cursor.fetchone()[0] is None:
+                        break
+                    cursor.execute(f'SELECT count(*) FROM {partition}')
+                    removed += cursor.fetchone()[0]
+                    cursor.execute(f'DROP TABLE {partition}')
+                    day -= timedelta(days=1)
+        seconds = time.perf_counter() - began
+
+        time.sleep(0.5)  # Catch inserts that were blocked by the cleanup
+        stop.set()
+        writer.join()
+        return removed, seconds, latencies
+
+    def _percentile(self, values, percentile):
+        if len(values) < 2:
+            return values[0] if values else 0
+        return statistics.quantiles(values, n=100, method='inclusive')[percentile - 1]
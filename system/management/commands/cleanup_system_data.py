@@ -28,18 +28,12 @@ class Command(BaseCommand):
         cutoff_date = timezone.now() - timedelta(hours=hours)
         
         if dry_run:
-            from system.models import SystemMetrics, ProcessMetrics, NetworkMetrics
-            system_count = SystemMetrics.objects.filter(timestamp__lt=cutoff_date).count()
-            process_count = ProcessMetrics.objects.filter(timestamp__lt=cutoff_date).count()
-            network_count = NetworkMetrics.objects.filter(timestamp__lt=cutoff_date).count()
-            total_count = system_count + process_count + network_count
+            from system.models import MetricValue
+            total_count = MetricValue.objects.filter(timestamp__lt=cutoff_date).count()
             
             self.stdout.write(
-                self.style.WARNING(f'Would delete {total_count} metric records older than {cutoff_date.strftime("%Y-%m-%d %H:%M:%S")}:')
+                self.style.WARNING(f'Would delete {total_count} metric records older than {cutoff_date.strftime("%Y-%m-%d %H:%M:%S")}')
             )
-            self.stdout.write(self.style.WARNING(f'  - {system_count} system metrics records'))
-            self.stdout.write(self.style.WARNING(f'  - {process_count} process metrics records'))
-            self.stdout.write(self.style.WARNING(f'  - {network_count} network metrics records'))
             self.stdout.write(self.style.SUCCESS('System identification records would remain intact.'))
         else:
             # Execute the cleanup
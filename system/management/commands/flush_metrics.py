@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.utils import timezone
 from system.models import MetricValue, Host
+from wyandata.retention import RetentionEngine
 import logging
 import time
 
@@ -66,6 +66,23 @@ class Command(BaseCommand):
                 self.style.WARNING(f"Deleting metrics older than {days} days")
             )
 
+        # Retention by age alone goes through the retention engine, which drops
+        # whole partitions and deletes the rest in chunks
+        if options['older_than'] and not options['host']:
+            engine = RetentionEngine(chunk_size=options['batch_size'], time_budget=float('inf'))
+            result = engine.apply(MetricValue, keep=timezone.timedelta(days=days))
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Successfully deleted {result.rows_removed} metrics records "
+                    f"({result.partitions_dropped} partitions dropped) in {result.seconds:.1f} seconds, "
+                    f"{result.rows_per_second:.0f} rows/sec"
+                )
+            )
+            self.stdout.write(
+                self.style.SUCCESS(f"Host records preserved: {hosts.count()}")
+            )
+            return
+
         # Get count before deletion
         total_metrics = MetricValue.objects.filter(**host_filter).count()
         
@@ -75,31 +92,30 @@ class Command(BaseCommand):
         
         batch_size = options['batch_size']
         
-        # Perform deletion in batches to avoid memory issues
-        with transaction.atomic():
-            while True:
-                # Get the IDs for the batch
-                ids_to_delete = list(MetricValue.objects.filter(**host_filter)
-                                    .values_list('id', flat=True)[:batch_size])
-                
-                if not ids_to_delete:
-                    break
-                
-                # Delete the batch
-                delete_count = MetricValue.objects.filter(id__in=ids_to_delete).delete()[0]
-                total_deleted += delete_count
-                
-                # Progress report
-                elapsed = time.time() - start_time
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"Deleted {total_deleted} of {total_metrics} metrics "
-                        f"({(total_deleted/total_metrics*100):.1f}%) in {elapsed:.1f} seconds"
-                    )
+        # Perform deletion in batches, each committed on its own so locks are released between batches
+        while True:
+            # Get the IDs for the batch
+            ids_to_delete = list(MetricValue.objects.filter(**host_filter)
+                                .values_list('id', flat=True)[:batch_size])
+            
+            if not ids_to_delete:
+                break
+            
+            # Delete the batch
+            delete_count = MetricValue.objects.filter(id__in=ids_to_delete).delete()[0]
+            total_deleted += delete_count
+            
+            # Progress report
+            elapsed = time.time() - start_time
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Deleted {total_deleted} of {total_metrics} metrics "
+                    f"({(total_deleted/total_metrics*100):.1f}%) in {elapsed:.1f} seconds"
                 )
-                
-                # Small pause to allow other queries to run
-                time.sleep(0.1)
+            )
+            
+            # Small pause to allow other queries to run
+            time.sleep(0.1)
         
         # Final report
         elapsed = time.time() - start_time
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from wyandata.partitioning import (
+    partitioned_models, is_partitioned, partitions, ensure_partitions, convert_to_partitioned
+)
+
+class Command(BaseCommand):
+    help = 'Create upcoming partitions of the raw time-series tables, or convert tables to partitioned tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Convert configured tables that are still ordinary tables (locks each table while its rows are copied)'
+        )
+        parser.add_argument(
+            '--model',
+            action='append',
+            help='Only handle this model, e.g. weather.OutdoorWeatherReading (may be repeated)'
+        )
+        parser.add_argument(
+            '--ahead',
+            type=int,
+            help='Number of future partitions to keep created (default: TIME_SERIES_PARTITIONS_AHEAD)'
+        )
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help='List the partitions of each table without changing anything'
+        )
+
+    def handle(self, *args, **options):
+        configured = partitioned_models()
+        if options['model']:
+            configured = [(model, spec) for model, spec in configured if model._meta.label in options['model']]
+            if not configured:
+                raise CommandError('None of the given models are configured in TIME_SERIES_PARTITIONS')
+
+        for model, spec in configured:
+            table = model._meta.db_table
+
+            if options['status']:
+                self._show_status(model)
+                continue
+
+            if not is_partitioned(model):
+                if not options['convert']:
+                    self.stdout.write(f'{table} is not partitioned, use --convert to convert it')
+                    continue
+                self.stdout.write(self.style.WARNING(f'Converting {table} to a partitioned table...'))
+                convert_to_partitioned(model, spec, ahead=options['ahead'])
+                self.stdout.write(self.style.SUCCESS(f'Converted {table} ({len(partitions(model))} partitions)'))
+                continue
+
+            created = ensure_partitions(model, spec, ahead=options['ahead'])
+            for name in created:
+                self.stdout.write(f'Created partition {name}')
+            if not created:
+                self.stdout.write(f'{table}: partitions are up to date')
+
+    def _show_status(self, model):
+        table = model._meta.db_table
+        if not is_partitioned(model):
+            self.stdout.write(f'{table}: not partitioned')
+            return
+        self.stdout.write(f'{table}:')
+        for partition in partitions(model):
+            if partition.start is None:
+                self.stdout.write(f'  {partition.name} (default)')
+            else:
+                self.stdout.write(f'  {partition.name} {partition.start} to {partition.end}')
@@ -1,3 +1,216 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from wyandata.testing import QueryPlanTestCase
+from wyandata.partitioning import is_partitioned, partitions, convert_to_partitioned, ensure_partitions, drop_partitions_before
+from wyandata.retention import RetentionEngine
+from .models import Host, MetricType, MetricValue, StorageDevice
+from .consumers import SystemMetricsConsumer
 
-# Create your tests here.
+class QueryPlanTests(QueryPlanTestCase):
+    """Hot system metric queries must be served from an index"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        # Five hosts reporting ten metrics every minute
+        hosts = [Host.objects.create(hostname=f'host-{i}') for i in range(5)]
+        metric_types = [MetricType.objects.create(name=f'metric-{i}', unit='%') for i in range(10)]
+        cls.host, cls.metric_type = hosts[0], metric_types[0]
+        MetricValue.objects.bulk_create([
+            MetricValue(host=hosts[i % 5], metric_type=metric_types[i // 5 % 10], float_value=i % 100)
+            for i in range(cls.SEED_ROWS)
+        ], batch_size=5000)
+        # timestamp is auto_now_add, so spread the rows afterwards
+        cls.now = timezone.now()
+        cls.minutes = cls.SEED_ROWS // 50
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {MetricValue._meta.db_table} AS metric SET timestamp = %s - (numbered.n / 50) * interval '1 minute'
+                FROM (SELECT id, row_number() OVER () - 1 AS n FROM {MetricValue._meta.db_table}) AS numbered
+                WHERE metric.id = numbered.id
+            """, [cls.now])
+        cls.analyze(MetricValue)
+        
+    def test_metric_history(self):
+        since = self.now - timedelta(hours=1)
+        self.assertNoSeqScan(MetricValue.objects.filter(
+            host=self.host,
+            metric_type=self.metric_type,
+            timestamp__gte=since,
+        ).order_by('timestamp'))
+        
+    def test_cleanup_range(self):
+        # An hourly cleanup removes about an hour of the oldest rows
+        cutoff = self.now - timedelta(minutes=self.minutes - 60)
+        self.assertNoSeqScan(MetricValue.objects.filter(timestamp__lt=cutoff))
+
+class PartitioningTests(TestCase):
+    def setUp(self):
+        self.host = Host.objects.create(hostname='test-host')
+        self.metric_type = MetricType.objects.create(name='cpu_usage', unit='%')
+        MetricValue.objects.bulk_create([
+            MetricValue(host=self.host, metric_type=self.metric_type, float_value=i)
+            for i in range(10)
+        ])
+        # timestamp is auto_now_add, so spread the rows an hour apart afterwards
+        self.now = timezone.now()
+        for i, metric in enumerate(MetricValue.objects.order_by('float_value')):
+            MetricValue.objects.filter(pk=metric.pk).update(timestamp=self.now - timedelta(hours=i))
+        
+    def test_convert_keeps_rows(self):
+        """Test that converting the table keeps its rows and creates partitions ahead"""
+        self.assertFalse(is_partitioned(MetricValue))
+        self.assertTrue(convert_to_partitioned(MetricValue, ahead=2))
+        
+        self.assertTrue(is_partitioned(MetricValue))
+        self.assertEqual(MetricValue.objects.count(), 10)
+        hourly = [p for p in partitions(MetricValue) if p.start is not None]
+        self.assertEqual(len(hourly), 10 + 2)
+        self.assertEqual(ensure_partitions(MetricValue, ahead=2), [])
+        
+        # Inserts keep working, including rows outside the created partitions
+        MetricValue.objects.create(host=self.host, metric_type=self.metric_type, float_value=99)
+        self.assertEqual(MetricValue.objects.count(), 11)
+        
+    def test_drop_partitions_before(self):
+        """Test that retention drops partitions entirely past the cutoff"""
+        convert_to_partitioned(MetricValue)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {MetricValue._meta.db_table}")
+        
+        cutoff = self.now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=5)
+        with CaptureQueriesContext(connection) as queries:
+            dropped, rows = drop_partitions_before(MetricValue, cutoff)
+        
+        # Readings 6 to 9 hours old are in partitions that end by the cutoff
+        self.assertEqual((dropped, rows), (4, 4))
+        self.assertFalse(any('count(' in query['sql'] for query in queries))
+        self.assertEqual(MetricValue.objects.count(), 6)
+        
+    def assert_hourly_partitions(self, since, now, expected):
+        """Create hourly partitions from since to a mocked now and check each covers exactly an hour"""
+        convert_to_partitioned(MetricValue, ahead=0)
+        with patch('wyandata.partitioning.timezone.now', return_value=now):
+            created = ensure_partitions(MetricValue, ahead=0, since=since)
+        
+        self.assertEqual(len(created), expected)
+        added = [p for p in partitions(MetricValue) if p.name in created]
+        self.assertTrue(all(p.end - p.start == timedelta(hours=1) for p in added))
+        
+    def test_spring_forward(self):
+        """Test that the hour skipped when daylight saving time begins does not become an empty partition"""
+        # 00:00 MST to 03:30 MDT spans three hours, 02:00 to 03:00 does not exist
+        self.assert_hourly_partitions(datetime(2026, 3, 8, 0, 0), datetime(2026, 3, 8, 3, 30), 3)
+        
+        metric = MetricValue.objects.create(host=self.host, metric_type=self.metric_type, float_value=99)
+        MetricValue.objects.filter(pk=metric.pk).update(timestamp=datetime(2026, 3, 8, 3, 30))
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {MetricValue._meta.db_table}_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+        
+    def test_fall_back(self):
+        """Test that the hour repeated when daylight saving time ends gets a partition of its own"""
+        # 00:00 MDT to 02:30 MST spans four hours, 01:00 to 02:00 happens twice
+        self.assert_hourly_partitions(datetime(2026, 11, 1, 0, 0), datetime(2026, 11, 1, 2, 30), 4)
+        
+    def test_unpartitioned_table_is_left_alone(self):
+        """Test that retention helpers are no-ops for ordinary tables"""
+        self.assertEqual(drop_partitions_before(MetricValue, self.now), (0, 0))
+        self.assertEqual(ensure_partitions(MetricValue), [])
+
+class RetentionEngineTests(TestCase):
+    def setUp(self):
+        host = Host.objects.create(hostname='test-host')
+        metric_type = MetricType.objects.create(name='cpu_usage', unit='%')
+        MetricValue.objects.bulk_create([
+            MetricValue(host=host, metric_type=metric_type, float_value=i)
+            for i in range(10)
+        ])
+        # Half the rows are past the 6 hour retention window
+        now = timezone.now()
+        for metric in MetricValue.objects.filter(float_value__lt=5):
+            MetricValue.objects.filter(pk=metric.pk).update(timestamp=now - timedelta(hours=7))
+        
+    def test_deletes_in_chunks(self):
+        """Test that old rows are removed in chunks and recent rows are kept"""
+        result = RetentionEngine(chunk_size=2, ingest_latency=lambda model: 0).apply(MetricValue)
+        
+        self.assertEqual(result.rows_removed, 5)
+        self.assertEqual(result.chunks, 3)
+        self.assertTrue(result.complete)
+        self.assertEqual(MetricValue.objects.count(), 5)
+        
+    def test_dry_run(self):
+        """Test that a dry run only counts the old rows"""
+        result = RetentionEngine().apply(MetricValue, dry_run=True)
+        
+        self.assertEqual(result.rows_removed, 5)
+        self.assertEqual(MetricValue.objects.count(), 10)
+        
+    def test_time_budget(self):
+        """Test that a run out of time stops and leaves the rest for later"""
+        result = RetentionEngine(time_budget=0, ingest_latency=lambda model: 0).apply(MetricValue)
+        
+        self.assertFalse(result.complete)
+        self.assertEqual(result.rows_removed, 0)
+        self.assertEqual(MetricValue.objects.count(), 10)
+        
+    def test_pauses_for_slow_ingest(self):
+        """Test that deletes wait while inserts into the table are slow"""
+        latencies = [900, 900, 0]
+        engine = RetentionEngine(
+            chunk_size=10, max_ingest_latency_ms=500, pause_seconds=0,
+            ingest_latency=lambda model: latencies.pop(0) if latencies else 0
+        )
+        result = engine.apply(MetricValue)
+        
+        self.assertEqual(latencies, [])
+        self.assertEqual(result.rows_removed, 5)
+        self.assertTrue(result.complete)
+        
+    def test_keep_override(self):
+        """Test that callers can keep a different amount of history than the policy"""
+        result = RetentionEngine(ingest_latency=lambda model: 0).apply(MetricValue, keep=timedelta(hours=8))
+        
+        self.assertEqual(result.rows_removed, 0)
+
+class MetricIngestTests(TestCase):
+    def setUp(self):
+        self.host = Host.objects.create(hostname='test-host')
+        self.disk = StorageDevice.objects.create(host=self.host, name='/')
+        self.consumer = SystemMetricsConsumer()
+        
+    def store(self, metrics, hostname='test-host'):
+        # The wrapped sync function, database_sync_to_async would close the test's connection
+        store_metrics = SystemMetricsConsumer.__dict__['store_metrics'].func
+        return store_metrics(self.consumer, hostname, metrics, timezone.now())
+        
+    def test_message_stored_in_one_batch(self):
+        """Test that the queries per message don't grow with the number of metrics"""
+        MetricType.objects.create(name='cpu_usage', unit='%')
+        small = {'cpu_usage': {'value': 12.5}, 'disk_used': {'value': 40, 'data_type': 'INT', 'storage_device': '/'}}
+        large = {f'core_{n}_usage': {'value': n, 'unit': '%', 'category': 'CPU'} for n in range(40)}
+        large.update(small)
+        
+        self.store(large)
+        with CaptureQueriesContext(connection) as small_queries:
+            self.store(small)
+        with CaptureQueriesContext(connection) as large_queries:
+            self.store(large)
+        
+        self.assertEqual(len(large_queries), len(small_queries))
+        self.assertEqual(MetricType.objects.filter(name='core_3_usage').get().category, 'CPU')
+        self.assertEqual(MetricValue.objects.filter(metric_type__name='core_3_usage').count(), 2)
+        disk_used = MetricValue.objects.filter(metric_type__name='disk_used').first()
+        self.assertEqual((disk_used.int_value, disk_used.storage_device), (40, self.disk))
+        
+    def test_bad_value_and_unknown_host(self):
+        """Test that an invalid value is skipped and unregistered hosts are rejected"""
+        host = self.store({'cpu_usage': {'value': 'n/a'}, 'load': {'value': 0.5}})
+        
+        self.assertEqual(host, self.host)
+        self.assertEqual(list(MetricValue.objects.values_list('float_value', flat=True)), [0.5])
+        self.assertIsNone(self.store({'load': {'value': 0.5}}, hostname='unknown'))
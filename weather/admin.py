@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import OutdoorWeatherReading, IndoorSensor, DailyWeatherSummary, MonthlyWeatherSummary
+from .models import OutdoorWeatherReading, IndoorSensor, DailyWeatherSummary, HourlyWeatherSummary, MonthlyWeatherSummary
 
 @admin.register(OutdoorWeatherReading)
 class OutdoorWeatherReadingAdmin(admin.ModelAdmin):
@@ -27,6 +27,13 @@ class DailyWeatherSummaryAdmin(admin.ModelAdmin):
     readonly_fields = ('min_temp_f', 'max_temp_f', 'avg_temp_f', 'total_rainfall_inches')
     date_hierarchy = 'date'
 
+@admin.register(HourlyWeatherSummary)
+class HourlyWeatherSummaryAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'reading_count', 'min_temp_f', 'max_temp_f', 'avg_temp_f', 'rainfall_inches',
+                   'max_wind_speed_mph', 'predominant_wind_direction')
+    readonly_fields = ('min_temp_f', 'max_temp_f', 'avg_temp_f', 'rainfall_inches', 'max_wind_speed_mph')
+    date_hierarchy = 'hour'
+
 @admin.register(MonthlyWeatherSummary)
 class MonthlyWeatherSummaryAdmin(admin.ModelAdmin):
     list_display = ('year_month', 'min_temp_f', 'max_temp_f', 'avg_temp_f', 
@@ -0,0 +1,187 @@
+"""
+Write-behind buffering for ingested weather readings.
+
+When WEATHER_WRITE_BEHIND is enabled, the receive endpoint validates a packet,
+appends the reading to an in-process queue and responds immediately. A
+background thread flushes the queue with bulk inserts every
+WEATHER_WRITE_BEHIND_FLUSH_MS milliseconds, or as soon as
+WEATHER_WRITE_BEHIND_BATCH_SIZE readings are waiting.
+
+The queue holds at most WEATHER_WRITE_BEHIND_MAX_QUEUE readings. When it is
+full, enqueue() refuses the reading and the caller writes it synchronously.
+The queue is drained when the worker shuts down.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import DatabaseError, InterfaceError, OperationalError, close_old_connections
+
+from .ingest import store_readings, broadcast_update
+from .snapshot import snapshot
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindBuffer:
+    """Bounded queue of unsaved readings with a background flush thread"""
+
+    def __init__(self, flush_interval_ms=500, batch_size=200, max_queue=10000):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        # Counters exposed through stats()
+        self.flushed_rows = 0
+        self.flush_count = 0
+        self.dropped_rows = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = None
+
+    @property
+    def depth(self):
+        """Number of readings waiting to be written"""
+        return len(self._queue)
+
+    def start(self):
+        """Start the flush thread if it is not already running"""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="weather-write-behind", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the flush thread and write everything still queued"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # Anything left (or queued before the thread ever started) is written here
+        while self._queue:
+            if not self.flush():
+                break
+
+    def enqueue(self, reading):
+        """
+        Queue a reading for writing. Returns False if the queue is full or
+        shutting down, in which case the caller should save the reading itself.
+        """
+        with self._cond:
+            if self._stopping or len(self._queue) >= self.max_queue:
+                return False
+            self._queue.append(reading)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        self.start()
+        return True
+
+    def _take_batch(self):
+        with self._cond:
+            count = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _requeue(self, batch):
+        with self._cond:
+            self._queue.extendleft(reversed(batch))
+
+    def flush(self):
+        """
+        Write up to one batch of queued readings.
+
+        Returns False if the database is unavailable and the batch was put
+        back on the queue.
+        """
+        with self._flush_lock:
+            batch = self._take_batch()
+            if not batch:
+                return True
+
+            started = time.monotonic()
+            try:
+                latest_outdoor, latest_indoor = store_readings(batch)
+                self.flushed_rows += len(batch)
+            except (OperationalError, InterfaceError) as e:
+                # Connection problems: keep the readings and try again later
+                logger.error(f"Write-behind flush of {len(batch)} readings failed, will retry: {e}")
+                self.failed_flushes += 1
+                self._requeue(batch)
+                return False
+            except DatabaseError as e:
+                # A bad row fails the whole INSERT, so write the batch row by row to isolate it
+                logger.error(f"Write-behind flush of {len(batch)} readings failed, writing individually: {e}")
+                self.failed_flushes += 1
+                latest_outdoor, latest_indoor = self._store_individually(batch)
+
+            try:
+                broadcast_update(latest_outdoor or snapshot.outdoor(), latest_indoor or snapshot.latest_indoor())
+            except Exception as e:
+                logger.error(f"Error sending weather update after flush: {e}")
+
+            self.flush_count += 1
+            self.last_flush_seconds = time.monotonic() - started
+            return True
+
+    def _store_individually(self, batch):
+        latest_outdoor = latest_indoor = None
+        for reading in batch:
+            try:
+                outdoor, indoor = store_readings([reading])
+            except DatabaseError as e:
+                logger.error(f"Dropping weather reading from {reading.model} at {reading.time}: {e}")
+                self.dropped_rows += 1
+                continue
+            self.flushed_rows += 1
+            latest_outdoor = outdoor or latest_outdoor
+            latest_indoor = indoor or latest_indoor
+        return latest_outdoor, latest_indoor
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._queue) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_interval)
+                if self._stopping:
+                    break
+            if not self.flush():
+                # Database unavailable, back off before retrying
+                time.sleep(self.flush_interval)
+            close_old_connections()
+        close_old_connections()
+
+    def stats(self):
+        """Queue depth and flush counters"""
+        return {
+            'enabled': is_enabled(),
+            'depth': self.depth,
+            'max_queue': self.max_queue,
+            'flushed_rows': self.flushed_rows,
+            'flush_count': self.flush_count,
+            'failed_flushes': self.failed_flushes,
+            'dropped_rows': self.dropped_rows,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 1) if self.last_flush_seconds is not None else None,
+        }
+
+def is_enabled():
+    return getattr(settings, 'WEATHER_WRITE_BEHIND', False)
+
+write_buffer = WriteBehindBuffer(
+    flush_interval_ms=getattr(settings, 'WEATHER_WRITE_BEHIND_FLUSH_MS', 500),
+    batch_size=getattr(settings, 'WEATHER_WRITE_BEHIND_BATCH_SIZE', 200),
+    max_queue=getattr(settings, 'WEATHER_WRITE_BEHIND_MAX_QUEUE', 10000),
+)
+
+# Make sure queued readings are written when the process exits
+atexit.register(write_buffer.stop)
@@ -2,7 +2,7 @@ import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.db import close_old_connections
-from .models import OutdoorWeatherReading, IndoorSensor
+from .snapshot import snapshot
 
 class WeatherDataConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for real-time weather data updates"""
@@ -50,16 +50,16 @@ class WeatherDataConsumer(AsyncWebsocketConsumer):
 
     @database_sync_to_async
     def get_latest_data(self):
-        """Get the latest weather data from the database"""
+        """Get the latest weather data from the snapshot (rebuilt from the database if needed)"""
         try:
             # Close any old connections before making new queries
             close_old_connections()
             
             # Get the latest outdoor reading
-            outdoor_reading = OutdoorWeatherReading.objects.order_by('-time').first()
+            outdoor_reading = snapshot.outdoor()
             
             # Get the latest indoor reading
-            indoor_reading = IndoorSensor.objects.order_by('-time').first()
+            indoor_reading = snapshot.latest_indoor()
             
             if not outdoor_reading:
                 return None
@@ -142,9 +142,9 @@ class WeatherDataConsumer(AsyncWebsocketConsumer):
                 
                 # Find additional indoor sensors (including WH31B sensors with locations)
                 recent_sensors = {}
-                for sensor in IndoorSensor.objects.filter(location__isnull=False).order_by('-time'):
+                for sensor in snapshot.indoor_sensors():
                     key = f"{sensor.sensor_id}_{sensor.channel}"
-                    if key != main_indoor_key and key not in recent_sensors:
+                    if sensor.location is not None and key != main_indoor_key and key not in recent_sensors:
                         recent_sensors[key] = sensor
                 
                 # Add each ambient sensor to the data
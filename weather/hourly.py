@@ -0,0 +1,222 @@
+"""
+Hourly weather rollups.
+
+HourlyWeatherSummary rows are updated as outdoor readings are ingested, so
+recent charts and today's daily summary can be served without scanning raw
+readings. rebuild_hourly_summaries() recomputes them from the raw history.
+Rainfall follows the rain gauge configured by WEATHER_RAIN_GAUGE.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Max, Min
+from django.db.models.functions import TruncHour
+from django.db.models.lookups import Exact
+
+from .models import OutdoorWeatherReading, DailyWeatherSummary, HourlyWeatherSummary, WIND_DIRECTIONS, empty_wind_sectors
+from .summaries import wind_sector, rain_counter_aggregates, counter_increase, day_bounds, rain_gauge, is_rain_gauge
+
+# Fields changed by HourlyWeatherSummary.add_reading()
+HOURLY_FIELDS = [
+    'reading_count', 'min_temp_c', 'max_temp_c', 'avg_temp_c', 'temp_samples',
+    'min_humidity', 'max_humidity', 'avg_humidity', 'humidity_samples',
+    'max_wind_speed_m_s', 'wind_sectors', 'rainfall_mm', 'rain_counter_mm', 'max_uvi',
+]
+
+def hour_start(time):
+    return time.replace(minute=0, second=0, microsecond=0)
+
+def rain_increment(previous, counter):
+    """Rain measured since the previous counter value, counting a reset as the new value"""
+    if counter is None or previous is None:
+        return 0
+    if counter < previous:
+        return counter
+    return counter - previous
+
+def last_rain_counter(before, **filters):
+    """The most recent rain counter value before a time, or None"""
+    return OutdoorWeatherReading.objects.filter(
+        time__lt=before,
+        rain_mm__isnull=False,
+        **filters
+    ).order_by('-time').values_list('rain_mm', flat=True).first()
+
+def lock_hourly_summaries():
+    """
+    Hold the lock on the hourly summaries until the transaction ends.
+
+    Outdoor readings are inserted and folded in while holding it, so a
+    rebuild never sees readings that are folded in again afterwards.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ['weather-hourly'])
+
+def update_hourly_summaries(readings):
+    """
+    Fold newly stored outdoor readings into their hourly summaries. Call it
+    in the transaction that stored them, after lock_hourly_summaries().
+
+    Rain is the increase of the gauge's counter since its previous reading,
+    which can only be folded in for readings newer than every stored one.
+    If the batch holds late or replayed readings, the hours from the
+    earliest of them on are rebuilt from the raw readings instead.
+    """
+    outdoor = sorted((r for r in readings if isinstance(r, OutdoorWeatherReading)), key=lambda r: r.time)
+    if not outdoor:
+        return
+
+    latest = OutdoorWeatherReading.objects.filter(
+        time__gte=outdoor[0].time,
+    ).exclude(pk__in=[reading.pk for reading in outdoor]).aggregate(latest=Max('time'))['latest']
+    if latest is not None:
+        last_hour = hour_start(max(latest, outdoor[-1].time))
+        rebuild_hourly_summaries(hour_start(outdoor[0].time), last_hour + timedelta(hours=1))
+        return
+
+    # Rain counter of each sensor just before this batch, to measure the first increment
+    previous = {}
+    increments = []
+    for reading in outdoor:
+        if not is_rain_gauge(reading):
+            increments.append(0)
+            continue
+        key = (reading.sensor_id, reading.model)
+        if key not in previous:
+            previous[key] = last_rain_counter(reading.time, sensor_id=reading.sensor_id, model=reading.model)
+        increments.append(rain_increment(previous[key], reading.rain_mm))
+        if reading.rain_mm is not None:
+            previous[key] = reading.rain_mm
+
+    hours = sorted({hour_start(reading.time) for reading in outdoor})
+    with transaction.atomic():
+        # Make sure the rows exist, then lock them so concurrent ingests don't lose updates
+        HourlyWeatherSummary.objects.bulk_create(
+            [HourlyWeatherSummary(hour=hour) for hour in hours],
+            ignore_conflicts=True,
+        )
+        summaries = {
+            summary.hour: summary
+            for summary in HourlyWeatherSummary.objects.select_for_update().filter(hour__in=hours).order_by('hour')
+        }
+        for reading, increment in zip(outdoor, increments):
+            summaries[hour_start(reading.time)].add_reading(reading, increment, rain_gauge=is_rain_gauge(reading))
+        HourlyWeatherSummary.objects.bulk_update(summaries.values(), HOURLY_FIELDS)
+
+def build_hourly_summaries(start, end):
+    """Summarize raw outdoor readings for each hour in [start, end) with one query"""
+    sector_counts = {
+        f'sector_{i}': Count('id', filter=Exact(wind_sector(), i))
+        for i in range(len(WIND_DIRECTIONS))
+    }
+    readings = OutdoorWeatherReading.objects.filter(time__gte=start, time__lt=end)
+    # A replayed packet is stored again, count each sensor's reading at a given time once
+    first_copies = readings.order_by('sensor_id', 'model', 'time', 'pk').distinct('sensor_id', 'model', 'time').values('pk')
+    rows = readings.filter(pk__in=first_copies).annotate(
+        hour=TruncHour('time')
+    ).values('hour').annotate(
+        reading_count=Count('id'),
+        min_temp=Min('temperature_C'),
+        max_temp=Max('temperature_C'),
+        avg_temp=Avg('temperature_C'),
+        temp_samples=Count('temperature_C'),
+        min_humidity=Min('humidity'),
+        max_humidity=Max('humidity'),
+        avg_humidity=Avg('humidity'),
+        humidity_samples=Count('humidity'),
+        max_wind=Max('wind_max_m_s'),
+        max_uvi=Max('uvi'),
+        **sector_counts,
+        **rain_counter_aggregates(),
+    ).order_by('hour')
+
+    summaries = []
+    previous_counter = last_rain_counter(start, **rain_gauge())
+    for row in rows:
+        # Rain within the hour, plus rain between the previous reading and the first one of the hour
+        rainfall = counter_increase(row['rain_first'], row['rain_last'], row['rain_max']) or 0
+        rainfall += rain_increment(previous_counter, row['rain_first'])
+        if row['rain_last'] is not None:
+            previous_counter = row['rain_last']
+
+        summaries.append(HourlyWeatherSummary(
+            hour=row['hour'],
+            reading_count=row['reading_count'],
+            min_temp_c=row['min_temp'],
+            max_temp_c=row['max_temp'],
+            avg_temp_c=row['avg_temp'],
+            temp_samples=row['temp_samples'],
+            min_humidity=row['min_humidity'],
+            max_humidity=row['max_humidity'],
+            avg_humidity=row['avg_humidity'],
+            humidity_samples=row['humidity_samples'],
+            max_wind_speed_m_s=row['max_wind'],
+            wind_sectors=[row[name] for name in sector_counts],
+            rainfall_mm=rainfall,
+            rain_counter_mm=row['rain_last'],
+            max_uvi=row['max_uvi'],
+        ))
+    return summaries
+
+def rebuild_hourly_summaries(start, end):
+    """Replace the hourly summaries in [start, end) with ones computed from raw readings"""
+    with transaction.atomic():
+        lock_hourly_summaries()
+        summaries = build_hourly_summaries(start, end)
+        HourlyWeatherSummary.objects.filter(hour__gte=start, hour__lt=end).delete()
+        HourlyWeatherSummary.objects.bulk_create(summaries)
+    return len(summaries)
+
+def daily_summaries_from_hourly(dates):
+    """
+    Build unsaved daily summaries from hourly rows, keyed by date.
+
+    Used for days the nightly summary job has not covered yet, such as today.
+    Dates without hourly rows are left out.
+    """
+    dates = set(dates)
+    if not dates:
+        return {}
+
+    start, end = day_bounds(min(dates), max(dates))
+    hours_by_date = defaultdict(list)
+    for summary in HourlyWeatherSummary.objects.filter(hour__gte=start, hour__lt=end).order_by('hour'):
+        if summary.hour.date() in dates:
+            hours_by_date[summary.hour.date()].append(summary)
+
+    return {day: combine_hours(day, hours) for day, hours in hours_by_date.items()}
+
+def _weighted_average(hours, value_field, samples_field):
+    samples = sum(getattr(hour, samples_field) for hour in hours if getattr(hour, value_field) is not None)
+    if not samples:
+        return None
+    return sum(getattr(hour, value_field) * getattr(hour, samples_field) for hour in hours if getattr(hour, value_field) is not None) / samples
+
+def _extreme(function, values):
+    values = [value for value in values if value is not None]
+    return function(values) if values else None
+
+def combine_hours(day, hours):
+    """Combine a day's hourly summaries into an unsaved DailyWeatherSummary"""
+    sectors = empty_wind_sectors()
+    for hour in hours:
+        for i, count in enumerate(hour.wind_sectors or []):
+            sectors[i] += count
+
+    avg_humidity = _weighted_average(hours, 'avg_humidity', 'humidity_samples')
+    max_wind = _extreme(max, [hour.max_wind_speed_m_s for hour in hours])
+
+    return DailyWeatherSummary(
+        date=day,
+        min_temp_c=_extreme(min, [hour.min_temp_c for hour in hours]),
+        max_temp_c=_extreme(max, [hour.max_temp_c for hour in hours]),
+        avg_temp_c=_weighted_average(hours, 'avg_temp_c', 'temp_samples'),
+        min_humidity=_extreme(min, [hour.min_humidity for hour in hours]),
+        max_humidity=_extreme(max, [hour.max_humidity for hour in hours]),
+        avg_humidity=round(avg_humidity) if avg_humidity is not None else None,
+        total_rainfall_mm=sum(hour.rainfall_mm for hour in hours),
+        max_wind_speed_mph=max_wind * 2.237 if max_wind is not None else None,
+        predominant_wind_direction=WIND_DIRECTIONS[sectors.index(max(sectors))] if any(sectors) else None,
+        max_uvi=_extreme(max, [hour.max_uvi for hour in hours]),
+    )
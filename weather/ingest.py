@@ -0,0 +1,245 @@
+"""
+Parsing and broadcasting of rtl_433 weather packets.
+
+Shared by the single packet and batch receive endpoints.
+"""
+
+import logging
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.db import transaction
+import pytz
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .models import OutdoorWeatherReading, IndoorSensor
+from .snapshot import snapshot
+from .hourly import lock_hourly_summaries, update_hourly_summaries
+
+logger = logging.getLogger(__name__)
+
+OUTDOOR_MODELS = ('WH24', 'WH65')
+INDOOR_MODELS = ('WN32P', 'WH32B', 'WH31B', 'AmbientWeather-WH31B')
+
+# Locations for WH31B sensors that do not report one, keyed by (sensor_id, channel)
+WH31B_LOCATIONS = {
+    (238, 1): "First location",
+    (232, 3): "Garden Shed",
+}
+
+class PacketError(ValueError):
+    """Raised when a packet cannot be turned into a reading"""
+
+def parse_time(time_str):
+    """Parse an rtl_433 timestamp (Mountain Time) into the project's timezone"""
+    # Parse naive datetime and make it timezone-aware (Mountain Time)
+    naive_time = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
+
+    # Use Mountain Time timezone
+    mountain_tz = pytz.timezone('America/Denver')
+    aware_time = mountain_tz.localize(naive_time)
+
+    # Convert to the project's timezone if different (as defined in settings.py)
+    time = timezone.localtime(aware_time)
+
+    # Without timezone support, readings loaded from the database are naive local
+    # times, so match them to allow comparisons with ingested readings
+    if not settings.USE_TZ:
+        time = timezone.make_naive(time)
+    return time
+
+def parse_packet(data):
+    """
+    Build an unsaved reading from an rtl_433 packet.
+
+    Returns an OutdoorWeatherReading or IndoorSensor, or None if the packet
+    comes from a sensor model we do not store. Raises PacketError if the
+    packet is malformed.
+    """
+    if not isinstance(data, dict):
+        raise PacketError("Packet must be a JSON object")
+
+    # Extract common fields
+    time_str = data.get('time')
+    if not time_str:
+        raise PacketError("Missing 'time' field")
+
+    try:
+        time = parse_time(time_str)
+    except Exception as e:
+        raise PacketError(f"Invalid datetime format: {str(e)}")
+
+    model = data.get('model')
+    if not model:
+        raise PacketError("Missing 'model' field")
+
+    if data.get('id') is None:
+        raise PacketError("Missing 'id' field")
+
+    common = {
+        'time': time,
+        'model': model,
+        'sensor_id': data.get('id'),
+        'battery_ok': bool(data.get('battery_ok', 1)),
+        'temperature_C': data.get('temperature_C'),
+        'temperature_F': data.get('temperature_F'),  # Store provided temperature_F
+        'humidity': data.get('humidity'),
+        'location': data.get('location'),  # Store provided location
+        'mic': data.get('mic'),
+    }
+
+    # Process based on model type
+    if any(name in model for name in OUTDOOR_MODELS):
+        return OutdoorWeatherReading(
+            **common,
+            wind_dir_deg=data.get('wind_dir_deg'),
+            wind_avg_m_s=data.get('wind_avg_m_s'),
+            wind_max_m_s=data.get('wind_max_m_s'),
+            rain_mm=data.get('rain_mm'),
+            uv=data.get('uv'),
+            uvi=data.get('uvi'),
+            light_lux=data.get('light_lux'),
+        )
+
+    if any(name in model for name in INDOOR_MODELS):
+        reading = IndoorSensor(
+            **common,
+            channel=data.get('channel'),
+            pressure_hPa=data.get('pressure_hPa'),
+        )
+
+        # Set location for specific indoor sensors if no location was provided
+        if not reading.location and 'WH31B' in model:
+            reading.location = WH31B_LOCATIONS.get((reading.sensor_id, reading.channel))
+
+        return reading
+
+    return None
+
+def store_readings(readings):
+    """
+    Insert parsed readings with one bulk INSERT per table and update the snapshot.
+
+    Returns the newest outdoor reading and the newest indoor reading in the batch.
+    """
+    outdoor = [r for r in readings if isinstance(r, OutdoorWeatherReading)]
+    indoor = [r for r in readings if isinstance(r, IndoorSensor)]
+
+    with transaction.atomic():
+        if outdoor:
+            # Ingests of outdoor readings take turns, see update_hourly_summaries
+            lock_hourly_summaries()
+            OutdoorWeatherReading.objects.bulk_create(outdoor)
+        if indoor:
+            IndoorSensor.objects.bulk_create(indoor)
+        if outdoor:
+            update_rollups(outdoor)
+
+    latest_outdoor = max(outdoor, key=lambda r: r.time) if outdoor else None
+    latest_indoor = max(indoor, key=lambda r: r.time) if indoor else None
+
+    if latest_outdoor:
+        OutdoorWeatherReading.objects.attach_rainfall([latest_outdoor])
+    snapshot.update(outdoor=latest_outdoor, indoor=indoor)
+
+    return latest_outdoor, latest_indoor
+
+def update_rollups(readings):
+    """
+    Fold stored outdoor readings into the hourly summaries, in the
+    transaction that stored them. A failure only rolls back its savepoint
+    and is logged rather than raised, so the raw readings are kept; the
+    rebuild_hourly_summaries command can repair the rollups.
+    """
+    try:
+        with transaction.atomic():
+            update_hourly_summaries(readings)
+    except Exception as e:
+        logger.error(f"Error updating hourly weather summaries: {e}")
+
+def build_ws_data(outdoor_reading, indoor_reading=None):
+    """Format the WebSocket payload for an outdoor reading and optional indoor reading"""
+    ws_data = {
+        "timestamp": outdoor_reading.time.isoformat(),
+        "outdoor": {
+            "model": outdoor_reading.model,
+            "sensor_id": outdoor_reading.sensor_id,
+            "location": outdoor_reading.location,  # Include source location
+            "temperature": {
+                "celsius": outdoor_reading.temperature_C,
+                "fahrenheit": outdoor_reading.temperature_F or outdoor_reading.calculated_temperature_F  # Use provided F if available
+            },
+            "humidity": outdoor_reading.humidity,
+            "wind": {
+                "direction_degrees": outdoor_reading.wind_dir_deg,
+                "direction_cardinal": outdoor_reading.wind_direction_cardinal,
+                "speed": {
+                    "avg_m_s": outdoor_reading.wind_avg_m_s,
+                    "avg_mph": outdoor_reading.wind_avg_mph,
+                    "max_m_s": outdoor_reading.wind_max_m_s,
+                    "max_mph": outdoor_reading.wind_max_mph
+                }
+            },
+            "rain": {
+                "counter": {
+                    "total_mm": outdoor_reading.rain_mm,
+                    "total_inches": outdoor_reading.rain_inches,
+                    "description": "Cumulative rainfall counter since station installation or last reset"
+                },
+                "recent": {
+                    "since_previous_reading_inches": outdoor_reading.rainfall_since_previous,
+                    "last_hour_inches": outdoor_reading.get_rainfall_since(hours=1),
+                    "last_24h_inches": outdoor_reading.get_rainfall_since(hours=24),
+                    "description": "Rainfall measured over recent time periods"
+                }
+            }
+        }
+    }
+
+    # Add UV and light data if available
+    if outdoor_reading.uv is not None:
+        ws_data['outdoor']['uv'] = outdoor_reading.uv
+
+    if outdoor_reading.uvi is not None:
+        ws_data['outdoor']['uvi'] = outdoor_reading.uvi
+
+    if outdoor_reading.light_lux is not None:
+        ws_data['outdoor']['light_lux'] = outdoor_reading.light_lux
+
+    # Add indoor data if available
+    if indoor_reading:
+        ws_data['indoor'] = {
+            "model": indoor_reading.model,
+            "sensor_id": indoor_reading.sensor_id,
+            "location": indoor_reading.location,  # Include source location
+            "temperature": {
+                "celsius": indoor_reading.temperature_C,
+                "fahrenheit": indoor_reading.temperature_F or indoor_reading.calculated_temperature_F  # Use provided F if available
+            },
+            "humidity": indoor_reading.humidity,
+            "timestamp": indoor_reading.time.isoformat()
+        }
+
+        # Add pressure data to the indoor reading if available
+        if indoor_reading.pressure_hPa is not None:
+            ws_data['indoor']['pressure'] = {
+                'hPa': indoor_reading.pressure_hPa,
+                'inHg': indoor_reading.pressure_inHg
+            }
+
+    return ws_data
+
+def broadcast_update(outdoor_reading, indoor_reading=None):
+    """Send one update to the weather_data WebSocket group"""
+    if not outdoor_reading:
+        return
+
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        "weather_data",
+        {
+            "type": "weather_update",
+            "data": build_ws_data(outdoor_reading, indoor_reading)
+        }
+    )
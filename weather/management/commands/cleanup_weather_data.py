@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 from weather.models import OutdoorWeatherReading, IndoorSensor
+from wyandata.retention import RetentionEngine
 from datetime import timedelta
 import logging
 
@@ -30,27 +30,23 @@ class Command(BaseCommand):
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - no data will be deleted'))
         
-        # Calculate the cutoff date
-        cutoff_date = timezone.now() - timedelta(days=days_to_keep)
-        
-        # Process outdoor readings
-        outdoor_count = OutdoorWeatherReading.objects.filter(time__lt=cutoff_date).count()
-        self.stdout.write(f'Found {outdoor_count} outdoor readings older than {cutoff_date}')
-        
-        if not dry_run and outdoor_count > 0:
-            OutdoorWeatherReading.objects.filter(time__lt=cutoff_date).delete()
-            self.stdout.write(self.style.SUCCESS(f'Deleted {outdoor_count} outdoor readings'))
-        
-        # Process indoor readings
-        indoor_count = IndoorSensor.objects.filter(time__lt=cutoff_date).count()
-        self.stdout.write(f'Found {indoor_count} indoor readings older than {cutoff_date}')
-        
-        if not dry_run and indoor_count > 0:
-            IndoorSensor.objects.filter(time__lt=cutoff_date).delete()
-            self.stdout.write(self.style.SUCCESS(f'Deleted {indoor_count} indoor readings'))
+        # Whole partitions are dropped first, the rest is deleted in chunks
+        engine = RetentionEngine()
+        total_removed = 0
+        for model, description in ((OutdoorWeatherReading, 'outdoor readings'), (IndoorSensor, 'indoor readings')):
+            result = engine.apply(model, keep=timedelta(days=days_to_keep), dry_run=dry_run)
+            total_removed += result.rows_removed
+            if dry_run:
+                self.stdout.write(f'Found {result.rows_removed} {description} older than {result.cutoff}')
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'Deleted {result.rows_removed} {description} '
+                f'({result.partitions_dropped} partitions dropped, {result.rows_per_second:.0f} rows/sec)'
+            ))
+            if not result.complete:
+                self.stdout.write(self.style.WARNING(f'Ran out of time, older {description} remain for the next run'))
         
         # Summary
-        total_removed = outdoor_count + indoor_count
         if dry_run:
             self.stdout.write(self.style.WARNING(f'DRY RUN: Would have removed {total_removed} records'))
         else:
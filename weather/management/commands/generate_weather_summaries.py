@@ -1,10 +1,27 @@
-from django.core.management.base import BaseCommand
-from django.db.models import Min, Max, Avg, Sum, Count
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
 from django.utils import timezone
-from weather.models import OutdoorWeatherReading, DailyWeatherSummary, MonthlyWeatherSummary
-from datetime import datetime, timedelta, date
-from collections import Counter
-import pytz
+from weather.models import DailyWeatherSummary, MonthlyWeatherSummary
+from weather.summaries import (
+    build_daily_summaries, build_monthly_summaries, save_summaries, month_chunks, regenerate_range
+)
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+import django
+import json
+import os
+import time
+
+def _init_backfill_worker():
+    """Set up Django in a pool worker; each worker opens its own database connection"""
+    django.setup()
+
+def _backfill_chunk(chunk_start, chunk_end):
+    """Regenerate the summaries for one chunk (runs in a pool worker)"""
+    started = time.monotonic()
+    days_with_readings = regenerate_range(chunk_start, chunk_end)
+    return chunk_start, chunk_end, days_with_readings, time.monotonic() - started
 
 class Command(BaseCommand):
     help = 'Generate daily and monthly weather summaries from raw readings'
@@ -21,154 +38,187 @@ class Command(BaseCommand):
             action='store_true',
             help='Force regeneration of existing summaries'
         )
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help='Regenerate all summaries in the range in parallel month chunks'
+        )
+        parser.add_argument(
+            '--start',
+            type=date.fromisoformat,
+            help='First day to process (YYYY-MM-DD), instead of counting back --days'
+        )
+        parser.add_argument(
+            '--end',
+            type=date.fromisoformat,
+            help='Last day to process (YYYY-MM-DD, default: today)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of worker processes for --backfill (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default=str(settings.BASE_DIR / 'logs' / 'weather_backfill_checkpoint.json'),
+            help='File recording completed chunks so an interrupted --backfill can resume'
+        )
 
     def handle(self, *args, **options):
         days_to_process = options['days']
         force_regenerate = options['regenerate']
-        self.stdout.write(f'Processing summaries for the last {days_to_process} days...')
         
         # Get timezone-aware date range
-        end_date = timezone.now().date()
-        start_date = end_date - timedelta(days=days_to_process-1)
+        end_date = options['end'] or timezone.now().date()
+        start_date = options['start'] or end_date - timedelta(days=days_to_process-1)
+        if start_date > end_date:
+            raise CommandError('--start must not be after --end')
+        
+        if options['backfill']:
+            self._backfill(start_date, end_date, options['workers'], options['checkpoint'])
+            return
+        
+        self.stdout.write(f'Processing summaries from {start_date} to {end_date}...')
         
         # Process daily summaries
         self._generate_daily_summaries(start_date, end_date, force_regenerate)
         
-        # Process monthly summaries
-        months_to_process = set()
-        current_date = start_date
-        while current_date <= end_date:
-            months_to_process.add(current_date.strftime('%Y-%m'))
-            current_date += timedelta(days=1)
-            
-        for year_month in months_to_process:
-            self._generate_monthly_summary(year_month, force_regenerate)
+        # Process monthly summaries for every month touched by the range
+        self._generate_monthly_summaries(start_date, end_date, force_regenerate)
             
         self.stdout.write(self.style.SUCCESS(f'Successfully processed weather summaries'))
 
     def _generate_daily_summaries(self, start_date, end_date, force_regenerate=False):
-        """Generate summary for each day in the date range"""
+        """Generate summaries for every day in the date range with one query and one upsert"""
+        existing = set(DailyWeatherSummary.objects.filter(
+            date__range=(start_date, end_date)
+        ).values_list('date', flat=True))
+
+        summaries = build_daily_summaries(start_date, end_date)
+        summarized = {summary.date for summary in summaries}
+
+        # Keep existing summaries unless we're forcing regeneration
+        if not force_regenerate:
+            summaries = [summary for summary in summaries if summary.date not in existing]
+        save_summaries(DailyWeatherSummary, summaries, update_existing=force_regenerate)
+
         current_date = start_date
         while current_date <= end_date:
-            # Check if summary already exists and we're not forcing regeneration
-            if not force_regenerate and DailyWeatherSummary.objects.filter(date=current_date).exists():
+            if current_date not in summarized:
+                self.stdout.write(self.style.WARNING(f'No readings found for {current_date}, skipping'))
+            elif current_date in existing and not force_regenerate:
                 self.stdout.write(f'Skipping {current_date}, summary already exists')
-                current_date += timedelta(days=1)
-                continue
-                
-            # Get readings for the day
-            day_start = datetime.combine(current_date, datetime.min.time())
-            day_end = datetime.combine(current_date, datetime.max.time())
-            
-            # Make timezone-aware
-            mountain_tz = pytz.timezone('America/Denver')
-            day_start = mountain_tz.localize(day_start)
-            day_end = mountain_tz.localize(day_end)
-            
-            # Get all readings for this day
-            readings = OutdoorWeatherReading.objects.filter(
-                time__range=(day_start, day_end)
-            )
-            
-            if readings.exists():
-                # Calculate aggregates
-                temp_agg = readings.aggregate(
-                    min_temp=Min('temperature_C'),
-                    max_temp=Max('temperature_C'),
-                    avg_temp=Avg('temperature_C')
-                )
-                
-                humid_agg = readings.aggregate(
-                    min_humidity=Min('humidity'),
-                    max_humidity=Max('humidity'),
-                    avg_humidity=Avg('humidity')
-                )
-                
-                # Get predominant wind direction
-                wind_directions = readings.exclude(wind_dir_deg__isnull=True).values_list('wind_direction_cardinal', flat=True)
-                predominant_dir = None
-                if wind_directions:
-                    direction_counts = Counter(wind_directions)
-                    predominant_dir = direction_counts.most_common(1)[0][0]
-                
-                # Calculate rainfall for the day
-                first_reading = readings.filter(rain_mm__isnull=False).order_by('time').first()
-                last_reading = readings.filter(rain_mm__isnull=False).order_by('-time').first()
-                
-                total_rainfall_mm = None
-                if first_reading and last_reading and first_reading.rain_mm is not None and last_reading.rain_mm is not None:
-                    # Calculate the difference between first and last reading of the day
-                    total_rainfall_mm = max(0, last_reading.rain_mm - first_reading.rain_mm)
-                
-                # Create or update daily summary
-                daily_summary, created = DailyWeatherSummary.objects.update_or_create(
-                    date=current_date,
-                    defaults={
-                        'min_temp_c': temp_agg['min_temp'],
-                        'max_temp_c': temp_agg['max_temp'],
-                        'avg_temp_c': temp_agg['avg_temp'],
-                        'min_humidity': humid_agg['min_humidity'],
-                        'max_humidity': humid_agg['max_humidity'],
-                        'avg_humidity': round(humid_agg['avg_humidity']) if humid_agg['avg_humidity'] is not None else None,
-                        'total_rainfall_mm': total_rainfall_mm,
-                        'max_wind_speed_mph': readings.aggregate(Max('wind_max_m_s'))['wind_max_m_s__max'] * 2.237 if readings.aggregate(Max('wind_max_m_s'))['wind_max_m_s__max'] is not None else None,
-                        'predominant_wind_direction': predominant_dir,
-                        'max_uvi': readings.aggregate(Max('uvi'))['uvi__max'],
-                    }
-                )
-                
-                self.stdout.write(f'{"Created" if created else "Updated"} summary for {current_date}')
             else:
-                self.stdout.write(self.style.WARNING(f'No readings found for {current_date}, skipping'))
-                
+                self.stdout.write(f'{"Updated" if current_date in existing else "Created"} summary for {current_date}')
             current_date += timedelta(days=1)
 
-    def _generate_monthly_summary(self, year_month, force_regenerate=False):
-        """Generate summary for a specific year-month"""
-        # Check if summary already exists and we're not forcing regeneration
-        if not force_regenerate and MonthlyWeatherSummary.objects.filter(year_month=year_month).exists():
-            self.stdout.write(f'Skipping {year_month}, summary already exists')
-            return
-            
-        # Extract year and month
-        year, month = map(int, year_month.split('-'))
-        
-        # Get all daily summaries for this month
-        daily_summaries = DailyWeatherSummary.objects.filter(
-            date__year=year,
-            date__month=month
+    def _generate_monthly_summaries(self, start_date, end_date, force_regenerate=False):
+        """Roll up daily summaries for every month touched by the date range"""
+        months = set()
+        current_date = start_date
+        while current_date <= end_date:
+            months.add(current_date.strftime('%Y-%m'))
+            current_date += timedelta(days=1)
+
+        existing = set(MonthlyWeatherSummary.objects.filter(
+            year_month__in=months
+        ).values_list('year_month', flat=True))
+
+        summaries = build_monthly_summaries(start_date, end_date)
+        summarized = {summary.year_month for summary in summaries}
+
+        # Keep existing summaries unless we're forcing regeneration
+        if not force_regenerate:
+            summaries = [summary for summary in summaries if summary.year_month not in existing]
+        save_summaries(MonthlyWeatherSummary, summaries, update_existing=force_regenerate)
+
+        for year_month in sorted(months):
+            if year_month not in summarized:
+                self.stdout.write(self.style.WARNING(f'No daily summaries found for {year_month}, skipping'))
+            elif year_month in existing and not force_regenerate:
+                self.stdout.write(f'Skipping {year_month}, summary already exists')
+            else:
+                self.stdout.write(f'{"Updated" if year_month in existing else "Created"} summary for {year_month}')
+
+    def _backfill(self, start_date, end_date, workers, checkpoint_path):
+        """Regenerate summaries for the range in month chunks across a process pool"""
+        chunks = month_chunks(start_date, end_date)
+        completed = self._load_checkpoint(checkpoint_path, start_date, end_date)
+        pending = [chunk for chunk in chunks if chunk[0].isoformat() not in completed]
+
+        if len(pending) < len(chunks):
+            self.stdout.write(f'Resuming backfill: {len(chunks) - len(pending)} of {len(chunks)} chunks already done')
+        self.stdout.write(
+            f'Backfilling summaries from {start_date} to {end_date} '
+            f'in {len(pending)} chunks with {min(workers, len(pending)) or 1} workers...'
         )
-        
-        if daily_summaries.exists():
-            # Calculate aggregates
-            temp_agg = daily_summaries.aggregate(
-                min_temp=Min('min_temp_c'),
-                max_temp=Max('max_temp_c'),
-                avg_temp=Avg('avg_temp_c')
-            )
-            
-            # Calculate rainy days
-            rainy_days = daily_summaries.filter(total_rainfall_mm__gt=0).count()
-            
-            # Calculate total rainfall
-            total_rainfall = daily_summaries.aggregate(Sum('total_rainfall_mm'))['total_rainfall_mm__sum']
-            
-            # Get max wind speed
-            max_wind = daily_summaries.aggregate(Max('max_wind_speed_mph'))['max_wind_speed_mph__max']
-            
-            # Create or update monthly summary
-            monthly_summary, created = MonthlyWeatherSummary.objects.update_or_create(
-                year_month=year_month,
-                defaults={
-                    'min_temp_c': temp_agg['min_temp'],
-                    'max_temp_c': temp_agg['max_temp'],
-                    'avg_temp_c': temp_agg['avg_temp'],
-                    'total_rainfall_mm': total_rainfall,
-                    'rainy_days': rainy_days,
-                    'max_wind_speed_mph': max_wind
-                }
+
+        started = time.monotonic()
+        total_days = 0
+        failed = []
+
+        def record(chunk_start, chunk_end, days_with_readings, seconds):
+            nonlocal total_days
+            days = (chunk_end - chunk_start).days + 1
+            total_days += days
+            completed.add(chunk_start.isoformat())
+            self._save_checkpoint(checkpoint_path, start_date, end_date, completed)
+            self.stdout.write(
+                f'{chunk_start} to {chunk_end}: {days_with_readings} of {days} days summarized '
+                f'in {seconds:.1f}s ({len(completed)}/{len(chunks)} chunks)'
             )
-            
-            self.stdout.write(f'{"Created" if created else "Updated"} summary for {year_month}')
-        else:
-            self.stdout.write(self.style.WARNING(f'No daily summaries found for {year_month}, skipping'))
+
+        if workers <= 1:
+            for chunk in pending:
+                record(*_backfill_chunk(*chunk))
+        elif pending:
+            # Don't hand our connection to forked workers, they must open their own
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_init_backfill_worker) as pool:
+                futures = {pool.submit(_backfill_chunk, *chunk): chunk for chunk in pending}
+                for future in as_completed(futures):
+                    try:
+                        record(*future.result())
+                    except Exception as e:
+                        failed.append(futures[future])
+                        self.stdout.write(self.style.ERROR(f'{futures[future][0]} to {futures[future][1]} failed: {e}'))
+
+        elapsed = time.monotonic() - started
+        rate = total_days / elapsed if elapsed > 0 else 0
+        self.stdout.write(f'Backfilled {total_days} days in {elapsed:.1f}s ({rate:.1f} days/sec)')
+
+        if failed:
+            raise CommandError(f'{len(failed)} chunks failed, run the backfill again to retry them')
+
+        # Start from scratch next time
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(self.style.SUCCESS('Successfully backfilled weather summaries'))
+
+    def _load_checkpoint(self, path, start_date, end_date):
+        """Chunks already completed by an earlier run over the same range"""
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return set()
+        except ValueError:
+            self.stdout.write(self.style.WARNING(f'Ignoring unreadable checkpoint {path}'))
+            return set()
+
+        if checkpoint.get('start') != start_date.isoformat() or checkpoint.get('end') != end_date.isoformat():
+            self.stdout.write(self.style.WARNING(f'Ignoring checkpoint {path} for a different date range'))
+            return set()
+        return set(checkpoint.get('completed', []))
+
+    def _save_checkpoint(self, path, start_date, end_date, completed):
+        # Write to a temporary file first so an interruption can't leave a partial checkpoint
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'start': start_date.isoformat(),
+                'end': end_date.isoformat(),
+                'completed': sorted(completed),
+            }, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from weather.hourly import rebuild_hourly_summaries
+from weather.summaries import day_bounds, month_chunks
+from datetime import date, timedelta
+import time
+
+class Command(BaseCommand):
+    help = 'Rebuild hourly weather summaries from raw readings'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=7,
+            help='Number of days to look back and process (default: 7)'
+        )
+        parser.add_argument(
+            '--start',
+            type=date.fromisoformat,
+            help='First day to process (YYYY-MM-DD), instead of counting back --days'
+        )
+        parser.add_argument(
+            '--end',
+            type=date.fromisoformat,
+            help='Last day to process (YYYY-MM-DD, default: today)'
+        )
+
+    def handle(self, *args, **options):
+        end_date = options['end'] or timezone.now().date()
+        start_date = options['start'] or end_date - timedelta(days=options['days']-1)
+        if start_date > end_date:
+            raise CommandError('--start must not be after --end')
+
+        self.stdout.write(f'Rebuilding hourly summaries from {start_date} to {end_date}...')
+        started = time.monotonic()
+        total_hours = 0
+
+        # Work a month at a time to keep each query and transaction small
+        for chunk_start, chunk_end in month_chunks(start_date, end_date):
+            start, end = day_bounds(chunk_start, chunk_end)
+            hours = rebuild_hourly_summaries(start, end)
+            total_hours += hours
+            self.stdout.write(f'Rebuilt {hours} hours from {chunk_start} to {chunk_end}')
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt {total_hours} hourly summaries in {elapsed:.1f}s'))
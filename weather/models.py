@@ -1,8 +1,15 @@
 from django.db import models
+from django.contrib.postgres.indexes import BrinIndex
 import math
+from bisect import bisect_left
+from collections import defaultdict
 from django.utils import timezone
 from datetime import timedelta
 
+# Cardinal directions for each 22.5 degree wind sector, starting from north
+WIND_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                   'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
 class BaseWeatherReading(models.Model):
     """Base model for all weather readings"""
     time = models.DateTimeField()
@@ -28,6 +35,104 @@ class BaseWeatherReading(models.Model):
         abstract = True
         ordering = ['-time']
 
+def _mm_to_inches(value_mm):
+    return round(value_mm / 25.4, 2)
+
+class OutdoorWeatherReadingQuerySet(models.QuerySet):
+    """QuerySet with batched rainfall calculations for outdoor readings"""
+
+    def _rain_series(self, readings, lookback):
+        """
+        Fetch the rain counter series needed to evaluate the given readings in
+        a single query, grouped by (sensor_id, model) and ordered by time.
+        """
+        timed = [r for r in readings if r.rain_mm is not None]
+        if not timed:
+            return {}
+
+        series = defaultdict(lambda: ([], []))
+        rows = OutdoorWeatherReading.objects.filter(
+            sensor_id__in={r.sensor_id for r in timed},
+            model__in={r.model for r in timed},
+            time__gte=min(r.time for r in timed) - lookback,
+            time__lt=max(r.time for r in timed),
+            rain_mm__isnull=False,
+        ).order_by('time').values_list('sensor_id', 'model', 'time', 'rain_mm')
+
+        for sensor_id, model, time, rain_mm in rows:
+            times, values = series[(sensor_id, model)]
+            times.append(time)
+            values.append(rain_mm)
+        return series
+
+    def with_rainfall(self, hours=(1, 24)):
+        """
+        Evaluate the queryset and attach rainfall figures to each reading.
+
+        The rainfall since the previous reading and over each window in
+        ``hours`` is computed for the whole page from one columnar fetch of
+        the rain counter, instead of three queries per reading. Results are
+        returned by ``rainfall_since_previous`` and ``get_rainfall_since()``
+        and follow the same counter reset rules.
+        """
+        return self.attach_rainfall(list(self), hours)
+
+    def attach_rainfall(self, readings, hours=(1, 24)):
+        """Attach rainfall figures to already loaded readings (see with_rainfall)"""
+        lookback = timedelta(hours=max(hours)) if hours else timedelta(0)
+        series = self._rain_series(readings, lookback)
+
+        for reading in readings:
+            rainfall = {'previous': None}
+            rainfall.update({window: None for window in hours})
+            reading._rainfall = rainfall
+            if reading.rain_mm is None:
+                continue
+
+            times, values = series.get((reading.sensor_id, reading.model), ([], []))
+            # Everything before this index is strictly older than the reading
+            end = bisect_left(times, reading.time)
+
+            # Rainfall since the previous reading from the same sensor
+            if end and reading.rain_mm >= values[end - 1]:
+                rainfall['previous'] = _mm_to_inches(reading.rain_mm - values[end - 1])
+            else:
+                # No previous reading, or the counter was reset
+                rainfall['previous'] = _mm_to_inches(reading.rain_mm)
+
+            # Rainfall over each time window, measured from the earliest reading in it
+            for window in hours:
+                start = bisect_left(times, reading.time - timedelta(hours=window), 0, end)
+                if start == end:
+                    rainfall[window] = 0
+                elif reading.rain_mm >= values[start]:
+                    rainfall[window] = _mm_to_inches(reading.rain_mm - values[start])
+
+        return readings
+
+    def rainfall_total(self):
+        """
+        Total rainfall in mm across the readings in this queryset.
+
+        Sums the per-sensor counter increments between consecutive readings.
+        A drop in the counter is treated as a reset, in which case the new
+        counter value is counted as the increment.
+        """
+        total = None
+        last_values = {}
+        rows = self.filter(rain_mm__isnull=False).order_by('time').values_list(
+            'sensor_id', 'model', 'rain_mm'
+        )
+        for sensor_id, model, rain_mm in rows:
+            key = (sensor_id, model)
+            previous = last_values.get(key)
+            last_values[key] = rain_mm
+            if previous is None:
+                total = total or 0.0
+                continue
+            total += rain_mm - previous if rain_mm >= previous else rain_mm
+        return total
+
 class OutdoorWeatherReading(BaseWeatherReading):
     """Model for outdoor weather stations (WH24 and WH65)"""
     wind_dir_deg = models.FloatField(null=True, blank=True)
@@ -38,6 +143,8 @@ class OutdoorWeatherReading(BaseWeatherReading):
     uvi = models.IntegerField(null=True, blank=True)
     light_lux = models.FloatField(null=True, blank=True)
     
+    objects = OutdoorWeatherReadingQuerySet.as_manager()
+    
     @property
     def wind_avg_mph(self):
         """Convert m/s to mph"""
@@ -65,6 +172,11 @@ class OutdoorWeatherReading(BaseWeatherReading):
         if self.rain_mm is None:
             return None
         
+        # Use the value precomputed by with_rainfall() if available
+        rainfall = getattr(self, '_rainfall', None)
+        if rainfall is not None:
+            return rainfall['previous']
+        
         try:
             # Find the previous reading from the same sensor
             previous = OutdoorWeatherReading.objects.filter(
@@ -97,15 +209,18 @@ class OutdoorWeatherReading(BaseWeatherReading):
         if self.wind_dir_deg is None:
             return None
             
-        directions = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-                      'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-        idx = round(self.wind_dir_deg / 22.5) % 16
-        return directions[idx]
+        idx = round(self.wind_dir_deg / 22.5) % len(WIND_DIRECTIONS)
+        return WIND_DIRECTIONS[idx]
     
     def get_rainfall_since(self, hours=24):
         """Get rainfall in the last X hours (default 24)"""
         if self.rain_mm is None:
             return None
+        
+        # Use the value precomputed by with_rainfall() if available
+        rainfall = getattr(self, '_rainfall', None)
+        if rainfall is not None and hours in rainfall:
+            return rainfall[hours]
             
         try:
             # Calculate the time window
@@ -136,6 +251,16 @@ class OutdoorWeatherReading(BaseWeatherReading):
         except Exception as e:
             print(f"Error calculating rainfall over time: {e}")
             return None
+    
+    class Meta(BaseWeatherReading.Meta):
+        indexes = [
+            # Latest reading
+            models.Index(fields=['-time']),
+            # Rain counter history of one sensor
+            models.Index(fields=['sensor_id', 'model', 'time']),
+            # Range scans over the append-only history (summaries, cleanup)
+            BrinIndex(fields=['time'], autosummarize=True),
+        ]
 
 class IndoorSensor(BaseWeatherReading):
     """Model for indoor sensors (WN32P, WH32B, and WH31B)"""
@@ -151,6 +276,14 @@ class IndoorSensor(BaseWeatherReading):
     
     class Meta:
         ordering = ['-time']
+        indexes = [
+            # Latest reading
+            models.Index(fields=['-time']),
+            # Latest reading per sensor/channel (DISTINCT ON)
+            models.Index(fields=['sensor_id', 'channel', '-time']),
+            # Range scans over the append-only history (cleanup)
+            BrinIndex(fields=['time'], autosummarize=True),
+        ]
 
 class DailyWeatherSummary(models.Model):
     """Daily weather statistics summary"""
@@ -194,6 +327,97 @@ class DailyWeatherSummary(models.Model):
         ordering = ['-date']
         verbose_name_plural = "Daily weather summaries"
 
+def empty_wind_sectors():
+    return [0] * len(WIND_DIRECTIONS)
+
+class HourlyWeatherSummary(models.Model):
+    """Hourly weather statistics, updated as each outdoor reading arrives"""
+    hour = models.DateTimeField(primary_key=True)  # Start of the hour
+    reading_count = models.IntegerField(default=0)
+    min_temp_c = models.FloatField(null=True, blank=True)
+    max_temp_c = models.FloatField(null=True, blank=True)
+    avg_temp_c = models.FloatField(null=True, blank=True)
+    temp_samples = models.IntegerField(default=0)  # Readings included in avg_temp_c
+    min_humidity = models.IntegerField(null=True, blank=True)
+    max_humidity = models.IntegerField(null=True, blank=True)
+    avg_humidity = models.FloatField(null=True, blank=True)
+    humidity_samples = models.IntegerField(default=0)  # Readings included in avg_humidity
+    max_wind_speed_m_s = models.FloatField(null=True, blank=True)  # Highest gust
+    wind_sectors = models.JSONField(default=empty_wind_sectors)  # Readings per WIND_DIRECTIONS sector
+    rainfall_mm = models.FloatField(default=0)
+    rain_counter_mm = models.FloatField(null=True, blank=True)  # Rain counter at the latest reading
+    max_uvi = models.IntegerField(null=True, blank=True)
+    
+    def add_reading(self, reading, rainfall_mm=0, rain_gauge=True):
+        """Fold an outdoor reading and the rain it measured into the hour"""
+        self.reading_count += 1
+        
+        if reading.temperature_C is not None:
+            self.min_temp_c = min(self.min_temp_c, reading.temperature_C) if self.min_temp_c is not None else reading.temperature_C
+            self.max_temp_c = max(self.max_temp_c, reading.temperature_C) if self.max_temp_c is not None else reading.temperature_C
+            self.avg_temp_c = ((self.avg_temp_c or 0) * self.temp_samples + reading.temperature_C) / (self.temp_samples + 1)
+            self.temp_samples += 1
+        
+        if reading.humidity is not None:
+            self.min_humidity = min(self.min_humidity, reading.humidity) if self.min_humidity is not None else reading.humidity
+            self.max_humidity = max(self.max_humidity, reading.humidity) if self.max_humidity is not None else reading.humidity
+            self.avg_humidity = ((self.avg_humidity or 0) * self.humidity_samples + reading.humidity) / (self.humidity_samples + 1)
+            self.humidity_samples += 1
+        
+        if reading.wind_max_m_s is not None:
+            self.max_wind_speed_m_s = max(self.max_wind_speed_m_s or 0, reading.wind_max_m_s)
+        
+        if reading.wind_dir_deg is not None:
+            sectors = list(self.wind_sectors or empty_wind_sectors())
+            sectors[round(reading.wind_dir_deg / 22.5) % len(WIND_DIRECTIONS)] += 1
+            self.wind_sectors = sectors
+        
+        if reading.uvi is not None:
+            self.max_uvi = max(self.max_uvi, reading.uvi) if self.max_uvi is not None else reading.uvi
+        
+        self.rainfall_mm += rainfall_mm
+        if rain_gauge and reading.rain_mm is not None:
+            self.rain_counter_mm = reading.rain_mm
+    
+    @property
+    def min_temp_f(self):
+        if self.min_temp_c is not None:
+            return round((self.min_temp_c * 9/5) + 32, 1)
+        return None
+    
+    @property
+    def max_temp_f(self):
+        if self.max_temp_c is not None:
+            return round((self.max_temp_c * 9/5) + 32, 1)
+        return None
+    
+    @property
+    def avg_temp_f(self):
+        if self.avg_temp_c is not None:
+            return round((self.avg_temp_c * 9/5) + 32, 1)
+        return None
+    
+    @property
+    def max_wind_speed_mph(self):
+        if self.max_wind_speed_m_s is not None:
+            return round(self.max_wind_speed_m_s * 2.237, 1)
+        return None
+    
+    @property
+    def rainfall_inches(self):
+        return _mm_to_inches(self.rainfall_mm or 0)
+    
+    @property
+    def predominant_wind_direction(self):
+        """Cardinal direction of the sector with the most readings"""
+        if not self.wind_sectors or not any(self.wind_sectors):
+            return None
+        counts = self.wind_sectors
+        return WIND_DIRECTIONS[max(range(len(counts)), key=lambda i: counts[i])]
+    
+    class Meta:
+        ordering = ['-hour']
+
 class MonthlyWeatherSummary(models.Model):
     """Monthly weather statistics summary"""
     year_month = models.CharField(max_length=7, primary_key=True)  # Format: YYYY-MM
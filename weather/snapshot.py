@@ -0,0 +1,178 @@
+"""
+In-process snapshot of the latest weather readings.
+
+The snapshot holds the latest outdoor reading (with its rain windows already
+computed) and the latest reading from each indoor sensor/channel. It is
+updated by the ingest path, so the current weather endpoint, the dashboard
+and WebSocket connects can be served without touching the database.
+
+Each worker process has its own snapshot. When a worker ingests a reading it
+notifies the others through the channel layer, and they rebuild their
+snapshot from the database on the next read. That only reaches the other
+workers over a channel layer shared between processes (channels_redis); with
+a per-process layer such as InMemoryChannelLayer the snapshot is instead
+reloaded once it is WEATHER_SNAPSHOT_MAX_AGE seconds old.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .models import OutdoorWeatherReading, IndoorSensor
+
+logger = logging.getLogger(__name__)
+
+# Channel layer group used to keep the snapshots of all workers consistent
+SNAPSHOT_GROUP = "weather_snapshot"
+
+# Packages whose channel layers deliver group messages to other processes
+CROSS_PROCESS_LAYERS = ('channels_redis',)
+
+def is_cross_process(channel_layer):
+    """Whether group messages sent on this channel layer reach other worker processes"""
+    return type(channel_layer).__module__.split('.')[0] in CROSS_PROCESS_LAYERS
+
+class WeatherSnapshot:
+    """Latest outdoor reading and latest reading per indoor sensor/channel"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._outdoor = None
+        self._indoor = {}
+        self._loaded_at = None
+        # Identifies this process so it can ignore its own invalidations
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.listening = False
+
+    @property
+    def max_age(self):
+        """Seconds after which the snapshot is rebuilt when no invalidations are being received"""
+        return getattr(settings, 'WEATHER_SNAPSHOT_MAX_AGE', 300)
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        # Without the invalidation listener we cannot see other workers' writes
+        return not self.listening and time.monotonic() - self._loaded_at > self.max_age
+
+    def rebuild(self):
+        """Load the snapshot from the database"""
+        outdoor_readings = OutdoorWeatherReading.objects.order_by('-time')[:1].with_rainfall()
+        indoor_readings = IndoorSensor.objects.order_by('sensor_id', 'channel', '-time').distinct('sensor_id', 'channel')
+
+        with self._lock:
+            self._outdoor = outdoor_readings[0] if outdoor_readings else None
+            self._indoor = {(sensor.sensor_id, sensor.channel): sensor for sensor in indoor_readings}
+            self._loaded_at = time.monotonic()
+        logger.debug(f"Weather snapshot rebuilt with {len(self._indoor)} indoor sensors")
+
+    def invalidate(self):
+        """Drop the snapshot so that the next read rebuilds it from the database"""
+        with self._lock:
+            self._outdoor = None
+            self._indoor = {}
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._is_stale():
+                self.rebuild()
+
+    def update(self, outdoor=None, indoor=()):
+        """
+        Record newly ingested readings and notify the other workers once.
+
+        ``outdoor`` should be the newest outdoor reading, with rainfall already
+        attached; ``indoor`` may contain several readings per sensor.
+        """
+        with self._lock:
+            if self._loaded_at is not None:
+                if outdoor is not None and (self._outdoor is None or outdoor.time >= self._outdoor.time):
+                    self._outdoor = outdoor
+                for reading in indoor:
+                    key = (reading.sensor_id, reading.channel)
+                    current = self._indoor.get(key)
+                    if current is None or reading.time >= current.time:
+                        self._indoor[key] = reading
+        self._notify()
+
+    def update_outdoor(self, reading):
+        """Record a newly ingested outdoor reading (rainfall should already be attached)"""
+        self.update(outdoor=reading)
+
+    def update_indoor(self, reading):
+        """Record a newly ingested indoor sensor reading"""
+        self.update(indoor=[reading])
+
+    def outdoor(self):
+        """Latest outdoor reading, or None"""
+        self._ensure_loaded()
+        return self._outdoor
+
+    def indoor_sensors(self):
+        """Latest reading from each indoor sensor/channel, newest first"""
+        self._ensure_loaded()
+        with self._lock:
+            sensors = list(self._indoor.values())
+        return sorted(sensors, key=lambda sensor: sensor.time, reverse=True)
+
+    def latest_indoor(self):
+        """Most recent indoor reading from any sensor, or None"""
+        sensors = self.indoor_sensors()
+        return sensors[0] if sensors else None
+
+    def _notify(self):
+        """Tell the other workers that their snapshots are out of date"""
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                SNAPSHOT_GROUP,
+                {
+                    "type": "snapshot.invalidate",
+                    "origin": self.origin,
+                }
+            )
+        except Exception as e:
+            logger.warning(f"Could not send weather snapshot invalidation: {e}")
+
+    def handle_message(self, message):
+        """Handle a message received on the snapshot group"""
+        if message.get("type") == "snapshot.invalidate" and message.get("origin") != self.origin:
+            self.invalidate()
+
+snapshot = WeatherSnapshot()
+
+async def listen(channel_layer=None):
+    """
+    Receive snapshot invalidations from other workers until cancelled.
+
+    Intended to run as a background task for the lifetime of an ASGI worker.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    if channel_layer is None:
+        return
+    if not is_cross_process(channel_layer):
+        # Other workers' invalidations would never arrive, keep reloading by max age
+        logger.info(f"{type(channel_layer).__name__} is per-process, weather snapshots reload every {snapshot.max_age}s")
+        return
+
+    channel_name = await channel_layer.new_channel()
+    await channel_layer.group_add(SNAPSHOT_GROUP, channel_name)
+    # Anything written before we started listening is unknown to us
+    snapshot.listening = True
+    snapshot.invalidate()
+    try:
+        while True:
+            message = await channel_layer.receive(channel_name)
+            snapshot.handle_message(message)
+    finally:
+        snapshot.listening = False
+        await channel_layer.group_discard(SNAPSHOT_GROUP, channel_name)
@@ -0,0 +1,189 @@
+"""
+Set-based generation of daily and monthly weather summaries.
+
+A whole date range of raw readings is summarized by one GROUP BY query and
+written with one bulk upsert; monthly summaries are rolled up from the daily
+rows the same way. These queries use PostgreSQL aggregates.
+"""
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import Aggregate, Avg, Case, Count, F, FloatField, IntegerField, Max, Min, Q, Sum, When
+from django.db.models.functions import Cast, Mod, TruncDate, TruncMonth
+from django.utils import timezone
+
+from .models import OutdoorWeatherReading, DailyWeatherSummary, MonthlyWeatherSummary, WIND_DIRECTIONS
+
+class CounterAt(Aggregate):
+    """
+    Value of a column at the first row of each group in the given ordering,
+    ignoring NULLs. Used to read a counter at the start or end of a period.
+    """
+    function = 'ARRAY_AGG'
+    template = '(ARRAY_REMOVE(%(function)s(%(expressions)s), NULL))[1]'
+    arg_joiner = ' ORDER BY '
+
+    def __init__(self, expression, ordering, **extra):
+        super().__init__(expression, ordering, output_field=FloatField(), **extra)
+
+class Mode(Aggregate):
+    """Most frequent value in each group"""
+    function = 'MODE'
+    template = '%(function)s() WITHIN GROUP (ORDER BY %(expressions)s)'
+
+def wind_sector(field='wind_dir_deg'):
+    """
+    Index into WIND_DIRECTIONS for a wind direction in degrees. Casting to an
+    integer rounds half to even, like round() in wind_direction_cardinal.
+    """
+    return Mod(Cast(F(field) / 22.5, IntegerField()), len(WIND_DIRECTIONS))
+
+def rain_gauge():
+    """
+    Field filters selecting the readings of the rain gauge, from the
+    WEATHER_RAIN_GAUGE setting. Counters of different sensors can't be
+    compared, so rainfall summaries only follow this one; an empty dict
+    counts every outdoor sensor, which is only right with a single one.
+    """
+    return dict(getattr(settings, 'WEATHER_RAIN_GAUGE', None) or {})
+
+def is_rain_gauge(reading):
+    """Whether a reading comes from the rain gauge"""
+    return all(getattr(reading, name) == value for name, value in rain_gauge().items())
+
+def rain_counter_aggregates(field='rain_mm'):
+    """Aggregates needed by counter_increase(), over the rain gauge's readings"""
+    gauge = rain_gauge()
+    counter = Case(When(Q(**gauge), then=F(field))) if gauge else F(field)
+    return {
+        'rain_first': CounterAt(counter, F('time').asc()),
+        'rain_last': CounterAt(counter, F('time').desc()),
+        'rain_max': Max(counter),
+    }
+
+def counter_increase(first, last, maximum):
+    """
+    Rainfall from a counter's first, last and maximum values over a period.
+
+    If the period ends below its maximum the counter was reset, so rain up to
+    the maximum is added to the rain counted since the reset. This matches
+    OutdoorWeatherReadingQuerySet.rainfall_total() for a single reset.
+    """
+    if first is None or last is None:
+        return None
+    if maximum is not None and last < maximum:
+        return (maximum - first) + last
+    return last - first
+
+def day_bounds(start_date, end_date):
+    """Datetime range covering whole local days from start_date to end_date"""
+    start = datetime.combine(start_date, datetime.min.time())
+    end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    if settings.USE_TZ:
+        start, end = timezone.make_aware(start), timezone.make_aware(end)
+    return start, end
+
+def build_daily_summaries(start_date, end_date):
+    """Summarize raw outdoor readings for each day in the range with one query"""
+    start, end = day_bounds(start_date, end_date)
+    rows = OutdoorWeatherReading.objects.filter(
+        time__gte=start,
+        time__lt=end,
+    ).annotate(
+        day=TruncDate('time')
+    ).values('day').annotate(
+        min_temp=Min('temperature_C'),
+        max_temp=Max('temperature_C'),
+        avg_temp=Avg('temperature_C'),
+        min_humidity=Min('humidity'),
+        max_humidity=Max('humidity'),
+        avg_humidity=Avg('humidity'),
+        max_wind=Max('wind_max_m_s'),
+        max_uvi=Max('uvi'),
+        wind_sector=Mode(wind_sector(), output_field=IntegerField()),
+        **rain_counter_aggregates(),
+    ).order_by('day')
+
+    return [
+        DailyWeatherSummary(
+            date=row['day'],
+            min_temp_c=row['min_temp'],
+            max_temp_c=row['max_temp'],
+            avg_temp_c=row['avg_temp'],
+            min_humidity=row['min_humidity'],
+            max_humidity=row['max_humidity'],
+            avg_humidity=round(row['avg_humidity']) if row['avg_humidity'] is not None else None,
+            total_rainfall_mm=counter_increase(row['rain_first'], row['rain_last'], row['rain_max']),
+            max_wind_speed_mph=row['max_wind'] * 2.237 if row['max_wind'] is not None else None,
+            predominant_wind_direction=WIND_DIRECTIONS[row['wind_sector']] if row['wind_sector'] is not None else None,
+            max_uvi=row['max_uvi'],
+        )
+        for row in rows
+    ]
+
+def build_monthly_summaries(start_date, end_date):
+    """Roll up daily summaries for each whole month touched by the range with one query"""
+    first_month = start_date.replace(day=1)
+    after_last_month = (end_date.replace(day=1) + timedelta(days=32)).replace(day=1)
+    rows = DailyWeatherSummary.objects.filter(
+        date__gte=first_month,
+        date__lt=after_last_month,
+    ).annotate(
+        month=TruncMonth('date')
+    ).values('month').annotate(
+        min_temp=Min('min_temp_c'),
+        max_temp=Max('max_temp_c'),
+        avg_temp=Avg('avg_temp_c'),
+        total_rainfall=Sum('total_rainfall_mm'),
+        rainy_days=Count('date', filter=Q(total_rainfall_mm__gt=0)),
+        max_wind=Max('max_wind_speed_mph'),
+    ).order_by('month')
+
+    return [
+        MonthlyWeatherSummary(
+            year_month=row['month'].strftime('%Y-%m'),
+            min_temp_c=row['min_temp'],
+            max_temp_c=row['max_temp'],
+            avg_temp_c=row['avg_temp'],
+            total_rainfall_mm=row['total_rainfall'],
+            rainy_days=row['rainy_days'],
+            max_wind_speed_mph=row['max_wind'],
+        )
+        for row in rows
+    ]
+
+def save_summaries(model, summaries, update_existing=True):
+    """Insert summaries with one bulk upsert, optionally leaving existing rows untouched"""
+    if not summaries:
+        return
+    pk_name = model._meta.pk.name
+    if update_existing:
+        model.objects.bulk_create(
+            summaries,
+            update_conflicts=True,
+            unique_fields=[pk_name],
+            update_fields=[f.name for f in model._meta.concrete_fields if f.name != pk_name],
+        )
+    else:
+        model.objects.bulk_create(summaries, ignore_conflicts=True)
+
+def month_chunks(start_date, end_date):
+    """Split a date range into (start, end) pieces that do not cross a month boundary"""
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        next_month = (chunk_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        chunk_end = min(next_month - timedelta(days=1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = next_month
+    return chunks
+
+def regenerate_range(start_date, end_date):
+    """
+    Rebuild the daily summaries for a date range and the monthly summaries of
+    the months it touches. Returns the number of days that had readings.
+    """
+    daily = build_daily_summaries(start_date, end_date)
+    save_summaries(DailyWeatherSummary, daily)
+    save_summaries(MonthlyWeatherSummary, build_monthly_summaries(start_date, end_date))
+    return len(daily)
@@ -1,14 +1,32 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 import json
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
 from django.utils import timezone
 import pytz
-from datetime import datetime
-from .models import OutdoorWeatherReading, IndoorSensor
+from datetime import datetime, timedelta
+from collections import Counter
+from django.core.management import call_command
+from io import StringIO
+import os
+import tempfile
+from .models import OutdoorWeatherReading, IndoorSensor, DailyWeatherSummary, HourlyWeatherSummary, MonthlyWeatherSummary
+from .hourly import build_hourly_summaries
+from .summaries import build_daily_summaries, build_monthly_summaries, save_summaries, month_chunks
+from .snapshot import snapshot, listen, is_cross_process
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from .ingest import parse_packet, store_readings
+from django.db import DataError, OperationalError, connection
+from .buffer import WriteBehindBuffer
+from unittest.mock import patch
+from wyandata.testing import QueryPlanTestCase
 
 class WeatherDataTests(TestCase):
     def setUp(self):
         self.client = Client()
+        snapshot.invalidate()
         self.url = reverse('weather:receive_weather_data')
         
     def test_receive_outdoor_weather_data(self):
@@ -110,6 +128,7 @@ class WeatherDataTests(TestCase):
 class CurrentWeatherAPITest(TestCase):
     def setUp(self):
         self.client = Client()
+        snapshot.invalidate()
         
         # Create an outdoor weather reading
         mountain_tz = pytz.timezone('America/Denver')
@@ -168,3 +187,631 @@ class CurrentWeatherAPITest(TestCase):
         self.assertEqual(data['indoor']['temperature']['celsius'], 21.8)
         self.assertEqual(data['indoor']['temperature']['fahrenheit'], 71.2)
         self.assertEqual(data['indoor']['humidity'], 42)
+
+class RainfallEngineTests(TestCase):
+    def setUp(self):
+        mountain_tz = pytz.timezone('America/Denver')
+        self.start = mountain_tz.localize(datetime(2025, 4, 21, 0, 0, 0))
+        
+        # A rain counter every 20 minutes over 30 hours, with a reset part way through
+        counter = 100.0
+        for i in range(90):
+            if i == 60:
+                counter = 0.5  # Counter reset
+            elif i % 3 == 0:
+                counter += 0.3
+            OutdoorWeatherReading.objects.create(
+                time=self.start + timedelta(minutes=20 * i),
+                model="Fineoffset-WH24",
+                sensor_id=182,
+                rain_mm=counter,
+            )
+        
+        # A reading without a rain counter
+        OutdoorWeatherReading.objects.create(
+            time=self.start + timedelta(minutes=20 * 90),
+            model="Fineoffset-WH24",
+            sensor_id=182,
+            rain_mm=None,
+        )
+        
+    def test_with_rainfall_matches_per_reading_queries(self):
+        """Test that batched rainfall gives the same results as the per-reading properties"""
+        expected = [
+            (r.rainfall_since_previous, r.get_rainfall_since(hours=1), r.get_rainfall_since(hours=24))
+            for r in OutdoorWeatherReading.objects.order_by('-time')
+        ]
+        
+        with self.assertNumQueries(2):
+            readings = OutdoorWeatherReading.objects.order_by('-time').with_rainfall()
+            actual = [
+                (r.rainfall_since_previous, r.get_rainfall_since(hours=1), r.get_rainfall_since(hours=24))
+                for r in readings
+            ]
+        
+        self.assertEqual(actual, expected)
+        
+    def test_with_rainfall_on_a_page(self):
+        """Test that readings older than the page are used for the first rows"""
+        readings = OutdoorWeatherReading.objects.order_by('-time')[1:4].with_rainfall()
+        for reading in readings:
+            fresh = OutdoorWeatherReading.objects.get(pk=reading.pk)
+            self.assertEqual(reading.rainfall_since_previous, fresh.rainfall_since_previous)
+            self.assertEqual(reading.get_rainfall_since(hours=24), fresh.get_rainfall_since(hours=24))
+        
+    def test_rainfall_total(self):
+        """Test that the rainfall total counts increments across a counter reset"""
+        readings = OutdoorWeatherReading.objects.filter(sensor_id=182)
+        # 19 increments of 0.3mm before the reset, 0.5mm at the reset, 9 increments after it
+        self.assertAlmostEqual(readings.rainfall_total(), 0.3 * 19 + 0.5 + 0.3 * 9)
+        
+        self.assertIsNone(OutdoorWeatherReading.objects.none().rainfall_total())
+
+class WeatherSummaryTests(TestCase):
+    def setUp(self):
+        self.first_day = datetime(2025, 4, 21).date()
+        start = datetime(2025, 4, 21, 0, 0, 0)
+        
+        # Readings every 30 minutes over three days, with a rain counter reset on the second day
+        counter = 50.0
+        for i in range(144):
+            if i == 70:
+                counter = 0.2  # Counter reset
+            elif i % 4 == 0:
+                counter += 0.4
+            OutdoorWeatherReading.objects.create(
+                time=start + timedelta(minutes=30 * i),
+                model="Fineoffset-WH24",
+                sensor_id=182,
+                temperature_C=10.0 + (i % 24) * 0.5,
+                humidity=40 + i % 20,
+                wind_dir_deg=(i * 37) % 360,
+                wind_max_m_s=(i % 11) * 0.7,
+                uvi=i % 8,
+                rain_mm=counter,
+            )
+        
+    def expected_daily(self, day):
+        """Daily summary values computed from the readings in Python"""
+        day_start = datetime.combine(day, datetime.min.time())
+        readings = OutdoorWeatherReading.objects.filter(time__gte=day_start, time__lt=day_start + timedelta(days=1))
+        temps = [r.temperature_C for r in readings]
+        directions = Counter(r.wind_direction_cardinal for r in readings)
+        return {
+            'min_temp_c': min(temps),
+            'max_temp_c': max(temps),
+            'max_uvi': max(r.uvi for r in readings),
+            'max_wind_speed_mph': max(r.wind_max_m_s for r in readings) * 2.237,
+            'total_rainfall_mm': readings.rainfall_total(),
+            'predominant_wind_direction_count': directions.most_common(1)[0][1],
+            'direction_counts': directions,
+        }
+        
+    def test_daily_summaries_in_one_query(self):
+        """Test that every day in the range is summarized by a single query"""
+        last_day = self.first_day + timedelta(days=2)
+        with self.assertNumQueries(1):
+            summaries = build_daily_summaries(self.first_day, last_day)
+        
+        self.assertEqual([s.date for s in summaries], [self.first_day + timedelta(days=n) for n in range(3)])
+        for summary in summaries:
+            expected = self.expected_daily(summary.date)
+            self.assertEqual(summary.min_temp_c, expected['min_temp_c'])
+            self.assertEqual(summary.max_temp_c, expected['max_temp_c'])
+            self.assertEqual(summary.max_uvi, expected['max_uvi'])
+            self.assertAlmostEqual(summary.max_wind_speed_mph, expected['max_wind_speed_mph'])
+            self.assertAlmostEqual(summary.total_rainfall_mm, expected['total_rainfall_mm'])
+            # Ties may be broken differently, but the direction must be one of the most common
+            self.assertEqual(
+                expected['direction_counts'][summary.predominant_wind_direction],
+                expected['predominant_wind_direction_count']
+            )
+        
+    def test_upsert_and_monthly_rollup(self):
+        """Test that summaries are upserted and rolled up into months"""
+        last_day = self.first_day + timedelta(days=2)
+        save_summaries(DailyWeatherSummary, build_daily_summaries(self.first_day, last_day))
+        DailyWeatherSummary.objects.filter(date=self.first_day).update(max_temp_c=-99)
+        
+        # Existing rows are kept unless updating
+        save_summaries(DailyWeatherSummary, build_daily_summaries(self.first_day, last_day), update_existing=False)
+        self.assertEqual(DailyWeatherSummary.objects.get(date=self.first_day).max_temp_c, -99)
+        
+        summaries = build_daily_summaries(self.first_day, last_day)
+        with self.assertNumQueries(1):
+            save_summaries(DailyWeatherSummary, summaries)
+        self.assertEqual(DailyWeatherSummary.objects.count(), 3)
+        self.assertEqual(DailyWeatherSummary.objects.get(date=self.first_day).max_temp_c, 21.5)
+        
+        with self.assertNumQueries(1):
+            months = build_monthly_summaries(self.first_day, last_day)
+        self.assertEqual(len(months), 1)
+        daily = DailyWeatherSummary.objects.all()
+        self.assertEqual(months[0].year_month, '2025-04')
+        self.assertEqual(months[0].rainy_days, 3)
+        self.assertAlmostEqual(months[0].total_rainfall_mm, sum(d.total_rainfall_mm for d in daily))
+        self.assertEqual(months[0].max_temp_c, max(d.max_temp_c for d in daily))
+        
+    def test_command(self):
+        """Test that the command creates daily and monthly summaries"""
+        with patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2025, 4, 23, 12, 0))):
+            call_command('generate_weather_summaries', days=4, stdout=StringIO())
+        
+        self.assertEqual(DailyWeatherSummary.objects.count(), 3)
+        self.assertTrue(MonthlyWeatherSummary.objects.filter(year_month='2025-04').exists())
+        
+    def test_month_chunks(self):
+        """Test that a range is split at month boundaries"""
+        chunks = month_chunks(datetime(2024, 1, 15).date(), datetime(2024, 3, 2).date())
+        self.assertEqual(chunks, [
+            (datetime(2024, 1, 15).date(), datetime(2024, 1, 31).date()),
+            (datetime(2024, 2, 1).date(), datetime(2024, 2, 29).date()),
+            (datetime(2024, 3, 1).date(), datetime(2024, 3, 2).date()),
+        ])
+        
+    def test_backfill_resumes_from_checkpoint(self):
+        """Test that a backfill skips chunks recorded in its checkpoint"""
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, 'checkpoint.json')
+            with open(checkpoint, 'w') as f:
+                json.dump({'start': '2025-03-25', 'end': '2025-04-30', 'completed': ['2025-04-01']}, f)
+            
+            out = StringIO()
+            call_command(
+                'generate_weather_summaries', backfill=True, workers=1, checkpoint=checkpoint,
+                start=datetime(2025, 3, 25).date(), end=datetime(2025, 4, 30).date(), stdout=out
+            )
+            
+            # April was already done, so only the March chunk ran
+            self.assertFalse(DailyWeatherSummary.objects.exists())
+            self.assertIn('days/sec', out.getvalue())
+            self.assertFalse(os.path.exists(checkpoint))
+            
+            call_command(
+                'generate_weather_summaries', backfill=True, workers=1, checkpoint=checkpoint,
+                start=datetime(2025, 3, 25).date(), end=datetime(2025, 4, 30).date(), stdout=StringIO()
+            )
+            self.assertEqual(DailyWeatherSummary.objects.count(), 3)
+
+class HourlyRollupTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        snapshot.invalidate()
+        
+    def packets(self, start):
+        """Packets every 10 minutes over three hours, with a rain counter reset"""
+        packets = []
+        counter = 20.0
+        for i in range(18):
+            counter = 0.3 if i == 10 else counter + 0.2 * (i % 3)
+            packets.append({
+                "time": (start + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+                "model": "Fineoffset-WH24",
+                "id": 182,
+                "temperature_C": 10.0 + i * 0.3,
+                "humidity": 50 + i,
+                "wind_dir_deg": (i * 53) % 360,
+                "wind_max_m_s": (i % 5) * 1.1,
+                "uvi": i % 4,
+                "rain_mm": counter,
+            })
+        return packets
+        
+    def assert_matches_rebuild(self, start):
+        """Check that the incrementally maintained rows match a rebuild from raw readings"""
+        rebuilt = build_hourly_summaries(start, start + timedelta(hours=3))
+        stored = list(HourlyWeatherSummary.objects.order_by('hour'))
+        self.assertEqual([s.hour for s in stored], [s.hour for s in rebuilt])
+        for actual, expected in zip(stored, rebuilt):
+            for field in ('reading_count', 'min_temp_c', 'max_temp_c', 'min_humidity', 'max_humidity',
+                          'max_wind_speed_m_s', 'wind_sectors', 'rain_counter_mm', 'max_uvi', 'temp_samples'):
+                self.assertEqual(getattr(actual, field), getattr(expected, field), field)
+            for field in ('avg_temp_c', 'avg_humidity', 'rainfall_mm'):
+                self.assertAlmostEqual(getattr(actual, field), getattr(expected, field), msg=field)
+        
+    def test_single_packets_update_hourly_rows(self):
+        """Test that each received packet is folded into its hour"""
+        start = datetime(2025, 4, 21, 10, 0, 0)
+        for packet in self.packets(start):
+            self.client.post(reverse('weather:receive_weather_data'), data=json.dumps(packet), content_type='application/json')
+        
+        self.assertEqual(HourlyWeatherSummary.objects.count(), 3)
+        self.assert_matches_rebuild(start)
+        
+    def test_batch_updates_hourly_rows(self):
+        """Test that a batch is folded into its hours"""
+        start = datetime(2025, 4, 21, 10, 0, 0)
+        packets = self.packets(start)
+        self.client.post(reverse('weather:receive_weather_batch'), data=json.dumps(packets[:7]), content_type='application/json')
+        self.client.post(reverse('weather:receive_weather_batch'), data=json.dumps(packets[7:]), content_type='application/json')
+        
+        self.assert_matches_rebuild(start)
+        
+    def post_rain(self, minute, counter, sensor_id=182):
+        self.client.post(reverse('weather:receive_weather_data'), data=json.dumps({
+            "time": f"2025-04-21 10:{minute:02d}:00", "model": "Fineoffset-WH24", "id": sensor_id,
+            "temperature_C": 10.0, "rain_mm": counter,
+        }), content_type='application/json')
+        
+    def test_late_and_replayed_readings(self):
+        """Test that late or replayed readings rebuild their hour instead of counting rain twice"""
+        start = datetime(2025, 4, 21, 10, 0, 0)
+        self.post_rain(0, 10.0)
+        self.post_rain(20, 14.0)
+        self.post_rain(10, 12.0)
+        self.post_rain(20, 14.0)
+        
+        summary = HourlyWeatherSummary.objects.get()
+        self.assertAlmostEqual(summary.rainfall_mm, 4.0)
+        self.assertEqual(summary.reading_count, 3)
+        self.assertEqual(summary.rain_counter_mm, 14.0)
+        self.assert_matches_rebuild(start)
+        
+    def test_failed_rollup_keeps_the_reading(self):
+        """Test that a failing hourly update in the ingest transaction does not lose the reading"""
+        def broken(readings):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT * FROM missing_table")
+        
+        with patch('weather.ingest.update_hourly_summaries', side_effect=broken), self.assertLogs('weather.ingest', level='ERROR'):
+            self.post_rain(0, 10.0)
+        
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 1)
+        self.assertFalse(HourlyWeatherSummary.objects.exists())
+        
+    def test_other_sensors_rain_is_ignored(self):
+        """Test that only the rain gauge's counter is followed"""
+        start = datetime(2025, 4, 21, 10, 0, 0)
+        with override_settings(WEATHER_RAIN_GAUGE={'model': 'Fineoffset-WH24', 'sensor_id': 182}):
+            self.post_rain(0, 10.0)
+            self.post_rain(5, 500.0, sensor_id=99)
+            self.post_rain(10, 11.0)
+            self.post_rain(15, 502.0, sensor_id=99)
+            
+            summary = HourlyWeatherSummary.objects.get()
+            self.assertAlmostEqual(summary.rainfall_mm, 1.0)
+            self.assertEqual(summary.rain_counter_mm, 11.0)
+            self.assert_matches_rebuild(start)
+        
+    def test_rebuild_command(self):
+        """Test that the rebuild command replaces the hourly rows"""
+        start = datetime(2025, 4, 21, 10, 0, 0)
+        for packet in self.packets(start):
+            self.client.post(reverse('weather:receive_weather_data'), data=json.dumps(packet), content_type='application/json')
+        HourlyWeatherSummary.objects.update(max_temp_c=-99)
+        
+        call_command('rebuild_hourly_summaries', start=start.date(), end=start.date(), stdout=StringIO())
+        
+        self.assertFalse(HourlyWeatherSummary.objects.filter(max_temp_c=-99).exists())
+        self.assert_matches_rebuild(start)
+        
+    def test_daily_endpoint_includes_today(self):
+        """Test that today's partial summary is served from the hourly rows"""
+        today = timezone.now().date()
+        start = datetime.combine(today, datetime.min.time())
+        packets = self.packets(start)
+        self.client.post(reverse('weather:receive_weather_batch'), data=json.dumps(packets), content_type='application/json')
+        
+        response = self.client.get(reverse('weather:get_daily_weather'), {'days': 3})
+        summaries = response.json()['summaries']
+        
+        self.assertEqual(summaries[-1]['date'], today.isoformat())
+        self.assertEqual(summaries[-1]['temperature']['min_c'], 10.0)
+        self.assertAlmostEqual(summaries[-1]['temperature']['max_c'], 10.0 + 17 * 0.3)
+        self.assertAlmostEqual(
+            summaries[-1]['rainfall']['total_mm'],
+            OutdoorWeatherReading.objects.filter(time__gte=start).rainfall_total()
+        )
+        
+        response = self.client.get(reverse('weather:get_hourly_weather'), {'hours': 6})
+        self.assertEqual(response.json()['status'], 'success')
+
+class WeatherSnapshotTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        snapshot.invalidate()
+        
+    def post_packet(self, data):
+        return self.client.post(
+            reverse('weather:receive_weather_data'),
+            data=json.dumps(data),
+            content_type='application/json'
+        )
+        
+    def test_current_weather_served_from_snapshot(self):
+        """Test that ingested readings are served by /current/ without any queries"""
+        self.post_packet({
+            "time": "2025-04-21 13:34:47", "model": "Fineoffset-WH24", "id": 182,
+            "temperature_C": 5.5, "humidity": 63, "wind_dir_deg": 38, "rain_mm": 1461.3,
+        })
+        self.post_packet({
+            "time": "2025-04-21 13:35:12", "model": "Fineoffset-WN32P", "id": 105,
+            "temperature_C": 21.8, "humidity": 42,
+        })
+        self.post_packet({
+            "time": "2025-04-21 13:36:00", "model": "Fineoffset-WH31B", "id": 232,
+            "channel": 3, "temperature_C": 12.0, "humidity": 50,
+        })
+        
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('weather:get_current_weather'))
+        
+        data = response.json()
+        self.assertEqual(data['outdoor']['humidity'], 63)
+        self.assertEqual(data['outdoor']['rain']['recent']['last_hour_inches'], 0)
+        self.assertEqual([s['sensor_id'] for s in data['indoor_sensors']], [232, 105])
+        self.assertEqual(data['indoor_sensors'][0]['location'], "Garden Shed")
+        
+    def test_snapshot_rebuilt_from_database(self):
+        """Test that a cold snapshot is loaded from the latest rows in the database"""
+        time = datetime(2025, 4, 21, 13, 0, 0)
+        for minutes in (0, 10):
+            OutdoorWeatherReading.objects.create(
+                time=time + timedelta(minutes=minutes), model="Fineoffset-WH24",
+                sensor_id=182, rain_mm=10.0 + minutes,
+            )
+            IndoorSensor.objects.create(
+                time=time + timedelta(minutes=minutes), model="Fineoffset-WH31B",
+                sensor_id=238, channel=1, temperature_C=20.0 + minutes,
+            )
+        
+        outdoor = snapshot.outdoor()
+        self.assertEqual(outdoor.time, time + timedelta(minutes=10))
+        self.assertEqual(outdoor.rainfall_since_previous, round(10 / 25.4, 2))
+        
+        sensors = snapshot.indoor_sensors()
+        self.assertEqual(len(sensors), 1)
+        self.assertEqual(sensors[0].temperature_C, 30.0)
+        
+    def test_invalidation_from_other_workers(self):
+        """Test that invalidations from other processes drop the snapshot, but our own do not"""
+        snapshot.rebuild()
+        
+        snapshot.handle_message({"type": "snapshot.invalidate", "origin": snapshot.origin})
+        with self.assertNumQueries(0):
+            snapshot.outdoor()
+        
+        snapshot.handle_message({"type": "snapshot.invalidate", "origin": "another-worker"})
+        with self.assertNumQueries(2):
+            snapshot.outdoor()
+
+    @override_settings(WEATHER_SNAPSHOT_MAX_AGE=0)
+    def test_max_age_with_per_process_layer(self):
+        """Test that a per-process channel layer does not switch off reloading by age"""
+        with self.assertLogs('weather.snapshot', level='INFO'):
+            async_to_sync(listen)(InMemoryChannelLayer())
+        self.assertFalse(snapshot.listening)
+        
+        snapshot.rebuild()
+        with self.assertNumQueries(2):
+            snapshot.outdoor()
+        
+    def test_cross_process_layers(self):
+        """Test that only channel layers shared between processes count as delivering invalidations"""
+        self.assertFalse(is_cross_process(InMemoryChannelLayer()))
+        self.assertTrue(is_cross_process(RedisChannelLayer()))
+
+class WeatherBatchTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('weather:receive_weather_batch')
+        snapshot.invalidate()
+        
+        self.packets = [
+            {"time": "2025-04-21 13:34:47", "model": "Fineoffset-WH24", "id": 182, "temperature_C": 5.5, "rain_mm": 10.0},
+            {"time": "2025-04-21 13:35:03", "model": "Fineoffset-WH24", "id": 182, "temperature_C": 5.6, "rain_mm": 10.3},
+            {"time": "2025-04-21 13:35:12", "model": "Fineoffset-WN32P", "id": 105, "temperature_C": 21.8, "humidity": 42},
+            {"model": "Fineoffset-WH24", "id": 182},
+            {"time": "2025-04-21 13:36:00", "model": "Acurite-Tower", "id": 7},
+        ]
+        
+    def listen_for_updates(self):
+        """Subscribe a test channel to the weather_data group"""
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)("weather_data", channel_name)
+        return channel_layer, channel_name
+        
+    def assert_batch_result(self, data):
+        self.assertEqual(data['status'], 'partial')
+        self.assertEqual(data['received'], 5)
+        self.assertEqual(data['stored'], 3)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(
+            [result['status'] for result in data['results']],
+            ['success', 'success', 'success', 'error', 'ignored']
+        )
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 2)
+        self.assertEqual(IndoorSensor.objects.count(), 1)
+        
+    def test_json_array_batch(self):
+        """Test that a JSON array is stored in bulk with one WebSocket update"""
+        channel_layer, channel_name = self.listen_for_updates()
+        
+        response = self.client.post(self.url, data=json.dumps(self.packets), content_type='application/json')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assert_batch_result(response.json())
+        
+        # Exactly one update, carrying the newest outdoor and indoor readings
+        message = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(message['data']['outdoor']['rain']['counter']['total_mm'], 10.3)
+        self.assertEqual(message['data']['indoor']['sensor_id'], 105)
+        queue = channel_layer.channels.get(channel_name)
+        self.assertTrue(queue is None or queue.qsize() == 0)
+        
+    def test_ndjson_batch(self):
+        """Test that NDJSON bodies are accepted, including lines that are not valid JSON"""
+        body = "\n".join(json.dumps(packet) for packet in self.packets) + "\n{not json\n"
+        
+        response = self.client.post(self.url, data=body, content_type='application/x-ndjson')
+        
+        data = response.json()
+        self.assertEqual(data['received'], 6)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual(data['results'][5]['status'], 'error')
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 2)
+
+    def test_database_unavailable(self):
+        """Test that a batch that could not be stored at all is an error the sender retries"""
+        with patch('weather.views.store_readings', side_effect=OperationalError('connection refused')), \
+                self.assertLogs('weather.views', level='ERROR'), self.assertLogs('django.request', level='ERROR'):
+            response = self.client.post(self.url, data=json.dumps(self.packets), content_type='application/json')
+        
+        self.assertEqual(response.status_code, 503)
+        data = response.json()
+        self.assertEqual(data['status'], 'error')
+        self.assertEqual(data['stored'], 0)
+        self.assertEqual(data['failed'], 4)
+        
+    def test_bad_row_stored_individually(self):
+        """Test that a row failing the bulk INSERT only fails its own packet"""
+        def store(readings):
+            if len(readings) > 1 or isinstance(readings[0], IndoorSensor):
+                raise DataError('value out of range')
+            return store_readings(readings)
+        
+        with patch('weather.views.store_readings', side_effect=store), self.assertLogs('weather.views', level='ERROR'):
+            response = self.client.post(self.url, data=json.dumps(self.packets), content_type='application/json')
+        
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['status'], 'partial')
+        self.assertEqual(data['stored'], 2)
+        self.assertEqual(
+            [result['status'] for result in data['results']],
+            ['success', 'success', 'error', 'error', 'ignored']
+        )
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 2)
+        
+    def test_nothing_valid(self):
+        """Test that a batch of malformed packets is rejected"""
+        with self.assertLogs('django.request', level='WARNING'):
+            response = self.client.post(self.url, data=json.dumps(self.packets[3:4]), content_type='application/json')
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'error')
+
+class WriteBehindBufferTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('weather:receive_weather_data')
+        snapshot.invalidate()
+        
+        # Flushes are run by hand in the test thread so they see the test transaction
+        self.buffer = WriteBehindBuffer(flush_interval_ms=50, batch_size=2, max_queue=3)
+        patcher = patch.object(self.buffer, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+    def packet(self, second, **extra):
+        data = {"time": f"2025-04-21 13:34:{second:02d}", "model": "Fineoffset-WH24", "id": 182, "rain_mm": 10.0}
+        data.update(extra)
+        return json.dumps(data)
+        
+    @override_settings(WEATHER_WRITE_BEHIND=True)
+    def test_packets_acknowledged_before_write(self):
+        """Test that packets are queued, acknowledged and written in bulk by a flush"""
+        with patch('weather.views.write_buffer', self.buffer):
+            for second in range(3):
+                response = self.client.post(self.url, data=self.packet(second), content_type='application/json')
+                self.assertEqual(response.json(), {'status': 'success'})
+        
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 0)
+        self.assertEqual(self.buffer.depth, 3)
+        
+        # Each flush writes at most one batch
+        self.assertTrue(self.buffer.flush())
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 2)
+        self.assertEqual(self.buffer.depth, 1)
+        
+        stats = self.buffer.stats()
+        self.assertEqual(stats['flushed_rows'], 2)
+        self.assertEqual(stats['flush_count'], 1)
+        
+    @override_settings(WEATHER_WRITE_BEHIND=True)
+    def test_full_queue_writes_synchronously(self):
+        """Test that packets beyond the queue bound are written immediately"""
+        with patch('weather.views.write_buffer', self.buffer):
+            for second in range(4):
+                self.client.post(self.url, data=self.packet(second), content_type='application/json')
+        
+        self.assertEqual(self.buffer.depth, 3)
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 1)
+        
+    def test_stop_drains_queue(self):
+        """Test that stopping the buffer writes everything still queued"""
+        for second in range(3):
+            self.assertTrue(self.buffer.enqueue(parse_packet(json.loads(self.packet(second)))))
+        
+        self.buffer.stop()
+        
+        self.assertEqual(self.buffer.depth, 0)
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 3)
+        self.assertFalse(self.buffer.enqueue(parse_packet(json.loads(self.packet(4)))))
+        
+    def test_bad_row_is_isolated(self):
+        """Test that a row the database rejects does not block the rest of the batch"""
+        good = parse_packet(json.loads(self.packet(0)))
+        bad = parse_packet(json.loads(self.packet(1)))
+        bad.sensor_id = None
+        self.buffer.enqueue(good)
+        self.buffer.enqueue(bad)
+        
+        self.assertTrue(self.buffer.flush())
+        
+        self.assertEqual(OutdoorWeatherReading.objects.count(), 1)
+        self.assertEqual(self.buffer.stats()['dropped_rows'], 1)
+        self.assertEqual(self.buffer.stats()['flushed_rows'], 1)
+
+class QueryPlanTests(QueryPlanTestCase):
+    """Hot weather queries must be served from an index"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.start = datetime(2025, 4, 1, 0, 0, 0)
+        OutdoorWeatherReading.objects.bulk_create([
+            OutdoorWeatherReading(
+                time=cls.start + timedelta(minutes=5 * i),
+                model="Fineoffset-WH24",
+                sensor_id=182,
+                temperature_C=10.0,
+                rain_mm=i * 0.1,
+            )
+            for i in range(cls.SEED_ROWS)
+        ], batch_size=5000)
+        IndoorSensor.objects.bulk_create([
+            IndoorSensor(
+                time=cls.start + timedelta(minutes=5 * i),
+                model="Fineoffset-WH31B",
+                sensor_id=230 + i % 4,
+                channel=i % 4,
+                temperature_C=21.0,
+            )
+            for i in range(cls.SEED_ROWS)
+        ], batch_size=5000)
+        cls.analyze(OutdoorWeatherReading, IndoorSensor)
+        
+    def test_latest_outdoor_reading(self):
+        self.assertNoSeqScan(OutdoorWeatherReading.objects.order_by('-time')[:1])
+        
+    def test_rain_counter_history(self):
+        self.assertNoSeqScan(OutdoorWeatherReading.objects.filter(
+            sensor_id=182,
+            model="Fineoffset-WH24",
+            time__gte=self.start,
+            time__lte=self.start + timedelta(hours=25),
+        ).order_by('time'))
+        
+    def test_time_range(self):
+        self.assertNoSeqScan(OutdoorWeatherReading.objects.filter(
+            time__gte=self.start + timedelta(days=2),
+            time__lt=self.start + timedelta(days=3),
+        ))
+        
+    def test_latest_indoor_reading_per_sensor(self):
+        self.assertNoSeqScan(IndoorSensor.objects.order_by('sensor_id', 'channel', '-time').distinct('sensor_id', 'channel'))
+        self.assertNoSeqScan(IndoorSensor.objects.order_by('-time')[:1])
+        
+    def test_cleanup_range(self):
+        self.assertNoSeqScan(IndoorSensor.objects.filter(time__lt=self.start + timedelta(days=1)))
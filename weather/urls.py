@@ -5,8 +5,11 @@ app_name = 'weather'
 
 urlpatterns = [
     path('api/weather/receive/', views.receive_weather_data, name='receive_weather_data'),
+    path('api/weather/receive/batch/', views.receive_weather_batch, name='receive_weather_batch'),
+    path('api/weather/ingest/status/', views.get_ingest_status, name='get_ingest_status'),
     path('api/weather/current/', views.get_current_weather, name='get_current_weather'),
     path('api/weather/recent/', views.get_recent_readings, name='get_recent_readings'),
+    path('api/weather/hourly/', views.get_hourly_weather, name='get_hourly_weather'),
     path('api/weather/daily/', views.get_daily_weather, name='get_daily_weather'),
     path('api/weather/monthly/', views.get_monthly_weather, name='get_monthly_weather'),
     path('weather/dashboard/', views.weather_dashboard, name='dashboard'),
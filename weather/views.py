@@ -1,22 +1,24 @@
 import logging
 from django.shortcuts import render
 from django.http import JsonResponse
-from .models import OutdoorWeatherReading, IndoorSensor, DailyWeatherSummary, MonthlyWeatherSummary
+from .models import OutdoorWeatherReading, IndoorSensor, DailyWeatherSummary, HourlyWeatherSummary, MonthlyWeatherSummary, WIND_DIRECTIONS
+from .hourly import daily_summaries_from_hourly
+from .snapshot import snapshot
+from .ingest import PacketError, parse_packet, store_readings, broadcast_update
+from .buffer import write_buffer, is_enabled as write_buffer_enabled
 from django.views.decorators.csrf import csrf_exempt
+from django.db import DatabaseError, InterfaceError, OperationalError
 import json
-from datetime import datetime, timedelta, date
+from datetime import timedelta
 from django.utils import timezone
-import pytz
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 
 # Get a logger for this module
 logger = logging.getLogger(__name__)
 
 def weather_dashboard(request):
     """View to display the latest weather data"""
-    outdoor_reading = OutdoorWeatherReading.objects.order_by('-time').first()
-    indoor_readings = IndoorSensor.objects.order_by('-time')[:5]
+    outdoor_reading = snapshot.outdoor()
+    indoor_readings = snapshot.indoor_sensors()[:5]
     
     context = {
         'outdoor_reading': outdoor_reading,
@@ -33,239 +35,28 @@ def receive_weather_data(request):
             data = json.loads(request.body)
             logger.debug(f"Received data: {data}")
             
-            # Extract common fields
-            time_str = data.get('time')
-            if not time_str:
-                logger.error("Missing 'time' field in weather data")
-                return JsonResponse({'status': 'error', 'message': "Missing 'time' field"}, status=400)
-            
             try:
-                # Parse naive datetime and make it timezone-aware (Mountain Time)
-                naive_time = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-                
-                # Use Mountain Time timezone
-                mountain_tz = pytz.timezone('America/Denver')
-                aware_time = mountain_tz.localize(naive_time)
-                
-                # Convert to the project's timezone if different (as defined in settings.py)
-                time = timezone.localtime(aware_time)
-            except Exception as e:
-                logger.error(f"Error parsing datetime: {e}")
-                return JsonResponse({'status': 'error', 'message': f"Invalid datetime format: {str(e)}"}, status=400)
+                reading = parse_packet(data)
+            except PacketError as e:
+                logger.error(f"Invalid weather packet: {e}")
+                return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
             
-            model = data.get('model')
-            sensor_id = data.get('id')
-            battery_ok = bool(data.get('battery_ok', 1))
-            temperature_c = data.get('temperature_C')
-            temperature_f = data.get('temperature_F')  # Get source temperature_F
-            humidity = data.get('humidity')
-            location = data.get('location')  # Get source location
+            # In write-behind mode the reading is written by a background flush
+            if reading is not None and write_buffer_enabled() and write_buffer.enqueue(reading):
+                return JsonResponse({'status': 'success'})
             
-            # Process based on model type
-            if 'WH24' in model or 'WH65' in model:
-                # Create outdoor weather reading
-                reading = OutdoorWeatherReading(
-                    time=time,
-                    model=model,
-                    sensor_id=sensor_id,
-                    battery_ok=battery_ok,
-                    temperature_C=temperature_c,
-                    temperature_F=temperature_f,  # Store provided temperature_F
-                    humidity=humidity,
-                    location=location,  # Store provided location
-                    wind_dir_deg=data.get('wind_dir_deg'),
-                    wind_avg_m_s=data.get('wind_avg_m_s'),
-                    wind_max_m_s=data.get('wind_max_m_s'),
-                    rain_mm=data.get('rain_mm'),
-                    uv=data.get('uv'),
-                    uvi=data.get('uvi'),
-                    light_lux=data.get('light_lux'),
-                    mic=data.get('mic')
-                )
-                reading.save()
-                
-                # Send update to WebSocket
-                channel_layer = get_channel_layer()
-                
-                # Check if we have an indoor sensor reading
-                indoor_reading = IndoorSensor.objects.order_by('-time').first()
-                
-                # Prepare WebSocket data
-                ws_data = {
-                    "timestamp": reading.time.isoformat(),
-                    "outdoor": {
-                        "model": reading.model,
-                        "sensor_id": reading.sensor_id,
-                        "location": reading.location,  # Include source location
-                        "temperature": {
-                            "celsius": reading.temperature_C,
-                            "fahrenheit": reading.temperature_F or reading.calculated_temperature_F  # Use provided F if available
-                        },
-                        "humidity": reading.humidity,
-                        "wind": {
-                            "direction_degrees": reading.wind_dir_deg,
-                            "direction_cardinal": reading.wind_direction_cardinal,
-                            "speed": {
-                                "avg_m_s": reading.wind_avg_m_s,
-                                "avg_mph": reading.wind_avg_mph,
-                                "max_m_s": reading.wind_max_m_s,
-                                "max_mph": reading.wind_max_mph
-                            }
-                        },
-                        "rain": {
-                            "counter": {
-                                "total_mm": reading.rain_mm,
-                                "total_inches": reading.rain_inches,
-                                "description": "Cumulative rainfall counter since station installation or last reset"
-                            },
-                            "recent": {
-                                "since_previous_reading_inches": reading.rainfall_since_previous,
-                                "last_hour_inches": reading.get_rainfall_since(hours=1),
-                                "last_24h_inches": reading.get_rainfall_since(hours=24),
-                                "description": "Rainfall measured over recent time periods"
-                            }
-                        }
-                    }
-                }
+            if isinstance(reading, OutdoorWeatherReading):
+                store_readings([reading])
                 
-                # Add UV and light data if available
-                if reading.uv is not None:
-                    ws_data['outdoor']['uv'] = reading.uv
-                
-                if reading.uvi is not None:
-                    ws_data['outdoor']['uvi'] = reading.uvi
-                    
-                if reading.light_lux is not None:
-                    ws_data['outdoor']['light_lux'] = reading.light_lux
-                
-                # Add indoor data if available
-                if indoor_reading:
-                    ws_data['indoor'] = {
-                        "model": indoor_reading.model,
-                        "sensor_id": indoor_reading.sensor_id,
-                        "location": indoor_reading.location,  # Include source location
-                        "temperature": {
-                            "celsius": indoor_reading.temperature_C,
-                            "fahrenheit": indoor_reading.temperature_F or indoor_reading.calculated_temperature_F  # Use provided F if available
-                        },
-                        "humidity": indoor_reading.humidity,
-                        "timestamp": indoor_reading.time.isoformat()
-                    }
-                
-                async_to_sync(channel_layer.group_send)(
-                    "weather_data",
-                    {
-                        "type": "weather_update",
-                        "data": ws_data
-                    }
-                )
-                
-            elif 'WN32P' in model or 'WH32B' in model or 'WH31B' in model or 'AmbientWeather-WH31B' in model:
-                # Create indoor sensor reading
-                reading = IndoorSensor(
-                    time=time,
-                    model=model,
-                    sensor_id=sensor_id,
-                    battery_ok=battery_ok,
-                    temperature_C=temperature_c,
-                    temperature_F=temperature_f,  # Store provided temperature_F
-                    humidity=humidity,
-                    location=location,  # Store provided location
-                    channel=data.get('channel'),
-                    pressure_hPa=data.get('pressure_hPa'),
-                    mic=data.get('mic')
-                )
-                
-                # Set location for specific indoor sensors if no location was provided
-                if not location and ('WH31B' in model or 'AmbientWeather-WH31B' in model):
-                    # Map sensor_id and channel to location
-                    if sensor_id == 238 and data.get('channel') == 1:
-                        reading.location = "First location"
-                    elif sensor_id == 232 and data.get('channel') == 3:
-                        reading.location = "Garden Shed"
+                # Send update to WebSocket with the latest indoor reading, if any
+                broadcast_update(reading, snapshot.latest_indoor())
                 
+            elif isinstance(reading, IndoorSensor):
                 reading.save()
-                
-                # Get the latest outdoor reading
-                outdoor_reading = OutdoorWeatherReading.objects.order_by('-time').first()
+                snapshot.update_indoor(reading)
                 
                 # Only send WebSocket update if we have both indoor and outdoor readings
-                if outdoor_reading:
-                    channel_layer = get_channel_layer()
-                    
-                    # Prepare WebSocket data
-                    ws_data = {
-                        "timestamp": outdoor_reading.time.isoformat(),
-                        "outdoor": {
-                            "model": outdoor_reading.model,
-                            "sensor_id": outdoor_reading.sensor_id,
-                            "location": outdoor_reading.location,  # Include source location
-                            "temperature": {
-                                "celsius": outdoor_reading.temperature_C,
-                                "fahrenheit": outdoor_reading.temperature_F or outdoor_reading.calculated_temperature_F  # Use provided F if available
-                            },
-                            "humidity": outdoor_reading.humidity,
-                            "wind": {
-                                "direction_degrees": outdoor_reading.wind_dir_deg,
-                                "direction_cardinal": outdoor_reading.wind_direction_cardinal,
-                                "speed": {
-                                    "avg_m_s": outdoor_reading.wind_avg_m_s,
-                                    "avg_mph": outdoor_reading.wind_avg_mph,
-                                    "max_m_s": outdoor_reading.wind_max_m_s,
-                                    "max_mph": outdoor_reading.wind_max_mph
-                                }
-                            },
-                            "rain": {
-                                "counter": {
-                                    "total_mm": outdoor_reading.rain_mm,
-                                    "total_inches": outdoor_reading.rain_inches,
-                                    "description": "Cumulative rainfall counter since station installation or last reset"
-                                },
-                                "recent": {
-                                    "since_previous_reading_inches": outdoor_reading.rainfall_since_previous,
-                                    "last_hour_inches": outdoor_reading.get_rainfall_since(hours=1),
-                                    "last_24h_inches": outdoor_reading.get_rainfall_since(hours=24),
-                                    "description": "Rainfall measured over recent time periods"
-                                }
-                            }
-                        },
-                        "indoor": {
-                            "model": reading.model,
-                            "sensor_id": reading.sensor_id,
-                            "location": reading.location,  # Include source location
-                            "temperature": {
-                                "celsius": reading.temperature_C,
-                                "fahrenheit": reading.temperature_F or reading.calculated_temperature_F  # Use provided F if available
-                            },
-                            "humidity": reading.humidity,
-                            "timestamp": reading.time.isoformat()
-                        }
-                    }
-                    
-                    # Add UV and light data if available
-                    if outdoor_reading.uv is not None:
-                        ws_data['outdoor']['uv'] = outdoor_reading.uv
-                    
-                    if outdoor_reading.uvi is not None:
-                        ws_data['outdoor']['uvi'] = outdoor_reading.uvi
-                        
-                    if outdoor_reading.light_lux is not None:
-                        ws_data['outdoor']['light_lux'] = outdoor_reading.light_lux
-                    
-                    # Add pressure data to the indoor reading in the websocket data
-                    if reading.pressure_hPa is not None:
-                        ws_data['indoor']['pressure'] = {
-                            'hPa': reading.pressure_hPa,
-                            'inHg': reading.pressure_inHg
-                        }
-                    
-                    async_to_sync(channel_layer.group_send)(
-                        "weather_data",
-                        {
-                            "type": "weather_update",
-                            "data": ws_data
-                        }
-                    )
+                broadcast_update(snapshot.outdoor(), reading)
                     
             return JsonResponse({'status': 'success'})
             
@@ -278,11 +69,118 @@ def receive_weather_data(request):
             
     return JsonResponse({'status': 'error', 'message': 'Only POST requests are allowed'}, status=405)
 
+@csrf_exempt
+def receive_weather_batch(request):
+    """
+    API endpoint to receive many rtl_433 packets in one request.
+    
+    Accepts a JSON array of packets, or NDJSON (one packet per line). Valid
+    packets are inserted with one bulk INSERT per table and a single WebSocket
+    update is sent for the batch. The response reports the status of each
+    packet so the sender can retry only the failures. If no packet could be
+    stored the response is an error (503 while the database is unavailable)
+    so the sender retries the whole batch.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Only POST requests are allowed'}, status=405)
+    
+    try:
+        body = request.body.decode('utf-8')
+    except UnicodeDecodeError as e:
+        return JsonResponse({'status': 'error', 'message': f"Invalid encoding: {str(e)}"}, status=400)
+    
+    # Split the body into raw packets
+    if body.lstrip().startswith('['):
+        try:
+            packets = json.loads(body)
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON: {e}")
+            return JsonResponse({'status': 'error', 'message': f"Invalid JSON: {str(e)}"}, status=400)
+    else:
+        packets = [line for line in body.splitlines() if line.strip()]
+    
+    logger.info(f"Weather batch of {len(packets)} packets received from rtl_433")
+    
+    results = []
+    readings = []
+    stored_indexes = []
+    for index, packet in enumerate(packets):
+        try:
+            if isinstance(packet, str):
+                packet = json.loads(packet)
+            reading = parse_packet(packet)
+        except (json.JSONDecodeError, PacketError) as e:
+            results.append({'index': index, 'status': 'error', 'message': str(e)})
+            continue
+        
+        if reading is None:
+            results.append({'index': index, 'status': 'ignored', 'message': 'Unsupported sensor model'})
+            continue
+        
+        results.append({'index': index, 'status': 'success'})
+        readings.append(reading)
+        stored_indexes.append(index)
+    
+    error_status = 400
+    if readings:
+        latest_outdoor = latest_indoor = None
+        try:
+            latest_outdoor, latest_indoor = store_readings(readings)
+        except (OperationalError, InterfaceError) as e:
+            # Connection problems: nothing was stored, the sender should retry later
+            logger.error(f"Error storing weather batch: {e}")
+            error_status = 503
+            for index in stored_indexes:
+                results[index] = {'index': index, 'status': 'error', 'message': str(e)}
+        except DatabaseError as e:
+            # A bad row fails the whole INSERT, so store the packets one by one to isolate it
+            logger.error(f"Error storing weather batch, storing packets individually: {e}")
+            error_status = 500
+            for index, reading in zip(stored_indexes, readings):
+                try:
+                    outdoor, indoor = store_readings([reading])
+                except DatabaseError as e:
+                    logger.error(f"Error storing weather reading from {reading.model} at {reading.time}: {e}")
+                    results[index] = {'index': index, 'status': 'error', 'message': str(e)}
+                    continue
+                latest_outdoor = outdoor or latest_outdoor
+                latest_indoor = indoor or latest_indoor
+        except Exception as e:
+            logger.error(f"Error storing weather batch: {e}")
+            error_status = 500
+            for index in stored_indexes:
+                results[index] = {'index': index, 'status': 'error', 'message': str(e)}
+        
+        if latest_outdoor or latest_indoor:
+            # One coalesced WebSocket update for the whole batch
+            try:
+                broadcast_update(latest_outdoor or snapshot.outdoor(), latest_indoor or snapshot.latest_indoor())
+            except Exception as e:
+                logger.error(f"Error sending weather batch update: {e}")
+    
+    failed = sum(1 for result in results if result['status'] == 'error')
+    stored = sum(1 for result in results if result['status'] == 'success')
+    if failed and not stored:
+        status = 'error'
+    else:
+        status = 'success' if not failed else 'partial'
+    return JsonResponse({
+        'status': status,
+        'received': len(results),
+        'stored': stored,
+        'failed': failed,
+        'results': results,
+    }, status=error_status if status == 'error' else 200)
+
+def get_ingest_status(request):
+    """API endpoint to report the state of the write-behind ingest queue"""
+    return JsonResponse({'status': 'success', 'write_behind': write_buffer.stats()})
+
 def get_current_weather(request):
     """API endpoint to get the current weather data"""
     try:
         # Get the latest outdoor reading
-        outdoor_reading = OutdoorWeatherReading.objects.order_by('-time').first()
+        outdoor_reading = snapshot.outdoor()
         if not outdoor_reading:
             return JsonResponse({'status': 'error', 'message': 'No outdoor weather data available'}, status=404)
         
@@ -338,40 +236,29 @@ def get_current_weather(request):
         # Get all indoor sensors (latest reading from each unique sensor/channel combination)
         indoor_sensors_data = []
         
-        # Track sensor_id/channel combinations we've seen
-        seen_sensors = set()
-        
-        # Get all indoor sensors ordered by time (newest first)
-        for sensor in IndoorSensor.objects.order_by('-time'):
-            # Create a unique key for this sensor based on sensor_id and channel
-            sensor_key = f"{sensor.sensor_id}_{sensor.channel}"
+        for sensor in snapshot.indoor_sensors():
+            # Create sensor data dictionary
+            sensor_data = {
+                'model': sensor.model,
+                'sensor_id': sensor.sensor_id,
+                'channel': sensor.channel,
+                'location': sensor.location,
+                'temperature': {
+                    'celsius': sensor.temperature_C,
+                    'fahrenheit': sensor.temperature_F or sensor.calculated_temperature_F
+                },
+                'humidity': sensor.humidity,
+                'timestamp': sensor.time.isoformat()
+            }
             
-            # Only include the first (most recent) reading from each unique sensor
-            if sensor_key not in seen_sensors:
-                seen_sensors.add(sensor_key)
-                
-                # Create sensor data dictionary
-                sensor_data = {
-                    'model': sensor.model,
-                    'sensor_id': sensor.sensor_id,
-                    'channel': sensor.channel,
-                    'location': sensor.location,
-                    'temperature': {
-                        'celsius': sensor.temperature_C,
-                        'fahrenheit': sensor.temperature_F or sensor.calculated_temperature_F
-                    },
-                    'humidity': sensor.humidity,
-                    'timestamp': sensor.time.isoformat()
+            # Add pressure data if available
+            if sensor.pressure_hPa is not None:
+                sensor_data['pressure'] = {
+                    'hPa': sensor.pressure_hPa,
+                    'inHg': sensor.pressure_inHg
                 }
-                
-                # Add pressure data if available
-                if hasattr(sensor, 'pressure_hPa') and sensor.pressure_hPa is not None:
-                    sensor_data['pressure'] = {
-                        'hPa': sensor.pressure_hPa,
-                        'inHg': sensor.pressure_inHg
-                    }
-                
-                indoor_sensors_data.append(sensor_data)
+            
+            indoor_sensors_data.append(sensor_data)
         
         # Add all indoor sensors to the response
         data['indoor_sensors'] = indoor_sensors_data
@@ -393,9 +280,18 @@ def get_daily_weather(request):
         start_date = end_date - timedelta(days=days-1)
         
         # Get daily summaries in the date range
-        daily_summaries = DailyWeatherSummary.objects.filter(
-            date__range=[start_date, end_date]
-        ).order_by('date')
+        summaries = {
+            summary.date: summary
+            for summary in DailyWeatherSummary.objects.filter(date__range=[start_date, end_date])
+        }
+        
+        # Today, and any day the nightly job has not summarized yet, comes from the hourly rollups
+        pending = [
+            start_date + timedelta(days=n) for n in range(days)
+            if start_date + timedelta(days=n) not in summaries or start_date + timedelta(days=n) == end_date
+        ]
+        summaries.update(daily_summaries_from_hourly(pending))
+        daily_summaries = [summaries[day] for day in sorted(summaries)]
         
         # Format the response data
         results = []
@@ -431,6 +327,58 @@ def get_daily_weather(request):
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
+def get_hourly_weather(request):
+    """API endpoint to get hourly weather summaries"""
+    try:
+        # Get query parameters
+        hours = int(request.GET.get('hours', 72))  # Default to 72 hours
+        hours = min(hours, 24 * 31)  # Limit to reasonable amount
+        
+        # Include the current, partial hour
+        end_hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        start_hour = end_hour - timedelta(hours=hours-1)
+        
+        hourly_summaries = HourlyWeatherSummary.objects.filter(
+            hour__gte=start_hour,
+            hour__lte=end_hour
+        ).order_by('hour')
+        
+        # Format the response data
+        results = []
+        for summary in hourly_summaries:
+            results.append({
+                'hour': summary.hour.isoformat(),
+                'readings': summary.reading_count,
+                'temperature': {
+                    'min_c': summary.min_temp_c,
+                    'max_c': summary.max_temp_c,
+                    'avg_c': summary.avg_temp_c,
+                    'min_f': summary.min_temp_f,
+                    'max_f': summary.max_temp_f,
+                    'avg_f': summary.avg_temp_f
+                },
+                'humidity': {
+                    'min': summary.min_humidity,
+                    'max': summary.max_humidity,
+                    'avg': summary.avg_humidity
+                },
+                'rainfall': {
+                    'total_mm': summary.rainfall_mm,
+                    'total_inches': summary.rainfall_inches
+                },
+                'wind': {
+                    'max_speed_mph': summary.max_wind_speed_mph,
+                    'predominant_direction': summary.predominant_wind_direction,
+                    'sectors': dict(zip(WIND_DIRECTIONS, summary.wind_sectors))
+                },
+                'max_uvi': summary.max_uvi
+            })
+        
+        return JsonResponse({'status': 'success', 'hours': len(results), 'summaries': results})
+        
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
 def get_monthly_weather(request):
     """API endpoint to get monthly weather summaries"""
     try:
@@ -504,8 +452,8 @@ def get_recent_readings(request):
             start_time = query.order_by('time').first().time
             end_time = query.order_by('-time').first().time
             
-            # Now get the sliced readings
-            readings = query[:count]
+            # Now get the sliced readings, with rainfall computed for the whole page at once
+            readings = query[:count].with_rainfall()
             
             # Format the response data
             results = []
@@ -1,4 +1,5 @@
 # wyandata/asgi.py
+import asyncio
 import os
 import django
 from django.core.asgi import get_asgi_application
@@ -25,12 +26,43 @@ class CloseConnectionsMiddleware:
             # Always close connections at the end
             await database_sync_to_async(close_old_connections)()
 
+# Background services that run for the lifetime of each worker process
+class LifespanApp:
+    def __init__(self):
+        self.tasks = []
+
+    async def startup(self):
+        import weather.snapshot
+        self.tasks.append(asyncio.create_task(weather.snapshot.listen()))
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        # Write any weather readings still waiting in the write-behind queue
+        from weather.buffer import write_buffer
+        await database_sync_to_async(write_buffer.stop)()
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
 # Import your app's routing modules after django setup
 import solar.routing
 import system.routing
 import weather.routing
 
 application = ProtocolTypeRouter({
+    "lifespan": LifespanApp(),
     "http": get_asgi_application(),
     "websocket": CloseConnectionsMiddleware(
         AuthMiddlewareStack(
@@ -0,0 +1,262 @@
+"""
+Native Postgres range partitioning for the raw time-series tables.
+
+Tables listed in settings.TIME_SERIES_PARTITIONS can be converted into tables
+partitioned by range on their time column, with one partition per hour, day
+or week and a DEFAULT partition catching rows outside the created ranges.
+Retention then drops whole partitions instead of deleting rows, which avoids
+table bloat and long-running DELETEs that hold locks against ingest.
+
+Everything here is a no-op for tables that have not been converted, so the
+cleanup paths can call it unconditionally.
+
+Partition bounds are absolute instants, written with their UTC offset. Day
+and week partitions start at local midnight, hourly partitions on whole UTC
+hours (and are named after them), since local hours are skipped or repeated
+when daylight saving time begins or ends.
+"""
+
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+
+Partition = namedtuple('Partition', ['name', 'start', 'end'])  # start/end are None for the DEFAULT partition
+
+_BOUNDS = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+def partitioned_models():
+    """(model, spec) for every table configured for partitioning"""
+    return [
+        (apps.get_model(label), spec)
+        for label, spec in getattr(settings, 'TIME_SERIES_PARTITIONS', {}).items()
+    ]
+
+def get_spec(model):
+    """Partitioning settings for a model, or None if it is not configured"""
+    return getattr(settings, 'TIME_SERIES_PARTITIONS', {}).get(model._meta.label)
+
+def _q(name):
+    return connection.ops.quote_name(name)
+
+def _aware(moment):
+    """Aware datetime for a naive local or aware one"""
+    if timezone.is_naive(moment):
+        return timezone.make_aware(moment)
+    return moment
+
+def _literal(moment):
+    """SQL literal for a partition bound with its UTC offset (DDL cannot take parameters)"""
+    return f"'{_aware(moment).isoformat(sep=' ')}'"
+
+def period_start(moment, interval):
+    """Start of the partition period containing a datetime, as an aware datetime"""
+    moment = _aware(moment)
+    if interval == 'hour':
+        return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    day = timezone.localtime(moment).date()
+    if interval == 'week':
+        day -= timedelta(days=day.weekday())  # Weeks start on Monday
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+def partition_name(table, start, interval):
+    return f"{table}_p{start:%Y%m%d%H}" if interval == 'hour' else f"{table}_p{start:%Y%m%d}"
+
+def is_partitioned(model):
+    """Whether the model's table has been converted to a partitioned table"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [model._meta.db_table]
+        )
+        return cursor.fetchone() is not None
+
+def partitions(model):
+    """Partitions of the model's table, ordered by start (DEFAULT last)"""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, [model._meta.db_table])
+        rows = cursor.fetchall()
+
+    result = []
+    for name, bound in rows:
+        match = _BOUNDS.search(bound)
+        if match:
+            start, end = (_aware(datetime.fromisoformat(value)) for value in match.groups())
+            result.append(Partition(name, start, end))
+        else:
+            result.append(Partition(name, None, None))
+    return sorted(result, key=lambda p: (p.start is None, p.start or datetime.min.replace(tzinfo=dt_timezone.utc)))
+
+def _create_partition(model, spec, start, end):
+    """
+    Create and attach the partition for [start, end). Rows for that range that
+    already landed in the DEFAULT partition are moved into it first.
+    """
+    table = model._meta.db_table
+    name = partition_name(table, start, spec['interval'])
+    column = _q(spec['column'])
+    default = next((p.name for p in partitions(model) if p.start is None), None)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {_q(name)} (LIKE {_q(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        if default:
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM {_q(default)}
+                    WHERE {column} >= {_literal(start)} AND {column} < {_literal(end)}
+                    RETURNING *
+                )
+                INSERT INTO {_q(name)} SELECT * FROM moved
+            """)
+        cursor.execute(
+            f"ALTER TABLE {_q(table)} ATTACH PARTITION {_q(name)} "
+            f"FOR VALUES FROM ({_literal(start)}) TO ({_literal(end)})"
+        )
+    return name
+
+def ensure_partitions(model, spec=None, ahead=None, since=None):
+    """
+    Create any missing partitions from the period containing ``since``
+    (default: now) through ``ahead`` periods into the future.
+
+    Returns the names of the partitions created.
+    """
+    spec = spec or get_spec(model)
+    if spec is None or not is_partitioned(model):
+        return []
+    if ahead is None:
+        ahead = getattr(settings, 'TIME_SERIES_PARTITIONS_AHEAD', 3)
+
+    step = INTERVALS[spec['interval']]
+    existing = [p for p in partitions(model) if p.start is not None]
+    now = period_start(timezone.now(), spec['interval'])
+    start = period_start(since, spec['interval']) if since is not None else now
+    last = now + step * ahead
+
+    created = []
+    while start <= last:
+        end = period_start(start + step, spec['interval'])
+        # Skip periods already covered, even by partitions of a different interval
+        if not any(p.start < end and start < p.end for p in existing):
+            created.append(_create_partition(model, spec, start, end))
+        start = end
+    if created:
+        logger.info(f"Created {len(created)} partitions of {model._meta.db_table}")
+    return created
+
+def drop_partitions_before(model, cutoff):
+    """
+    Drop every partition whose rows are all older than ``cutoff``.
+
+    Returns the number of partitions dropped and an estimate of the rows they
+    held, from the planner statistics (counting them would scan the data the
+    drop is meant to discard cheaply). Rows older than the cutoff in the
+    partition straddling it (or in the DEFAULT partition) are left for the
+    caller to delete.
+    """
+    if not is_partitioned(model):
+        return 0, 0
+
+    cutoff = _aware(cutoff)
+    dropped = rows = 0
+    for partition in partitions(model):
+        if partition.end is None or partition.end > cutoff:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            # reltuples is -1 for a partition that was never vacuumed or analyzed
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", [partition.name])
+            rows += max(int(cursor.fetchone()[0]), 0)
+            cursor.execute(f"DROP TABLE {_q(partition.name)}")
+        dropped += 1
+        logger.info(f"Dropped partition {partition.name}")
+    return dropped, rows
+
+def convert_to_partitioned(model, spec=None, ahead=None):
+    """
+    Convert the model's ordinary table into a partitioned table, keeping its data.
+
+    The table is locked for the whole conversion, so ingest into it blocks
+    until the rows have been copied. The primary key becomes (pk, time
+    column), since Postgres requires unique constraints on a partitioned
+    table to include the partition key; indexes, unique constraints and
+    foreign keys are recreated on the new table.
+    """
+    spec = spec or get_spec(model)
+    if spec is None:
+        raise ValueError(f"{model._meta.label} is not configured in TIME_SERIES_PARTITIONS")
+    if is_partitioned(model):
+        return False
+
+    table = model._meta.db_table
+    legacy = f"{table}_unpartitioned"
+    column = _q(spec['column'])
+    pk_column = model._meta.pk.column
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Deferred foreign key checks would keep the old table from being dropped
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(f"LOCK TABLE {_q(table)} IN ACCESS EXCLUSIVE MODE")
+
+        # Indexes, unique constraints and foreign keys are recreated by name once the old table is gone
+        cursor.execute("""
+            SELECT pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            WHERE i.indrelid = to_regclass(%s) AND NOT i.indisprimary
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+        """, [table])
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype IN ('u', 'f')
+            ORDER BY contype DESC
+        """, [table])
+        constraints = cursor.fetchall()
+        cursor.execute(f"SELECT min({column}) FROM {_q(table)}")
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute(f"ALTER TABLE {_q(table)} RENAME TO {_q(legacy)}")
+        cursor.execute(
+            f"CREATE TABLE {_q(table)} (LIKE {_q(legacy)} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({column})"
+        )
+        cursor.execute(f"CREATE TABLE {_q(table + '_default')} PARTITION OF {_q(table)} DEFAULT")
+        ensure_partitions(model, spec, ahead=ahead, since=oldest)
+
+        cursor.execute(f"INSERT INTO {_q(table)} SELECT * FROM {_q(legacy)}")
+
+        # Continue the id sequence where the old table left off
+        cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, pk_column])
+        sequence = cursor.fetchone()[0]
+        if sequence:
+            cursor.execute(
+                f"SELECT setval(%s, COALESCE((SELECT max({_q(pk_column)}) FROM {_q(table)}), 0) + 1, false)",
+                [sequence]
+            )
+
+        cursor.execute(f"DROP TABLE {_q(legacy)}")
+        cursor.execute(f"ALTER TABLE {_q(table)} ADD PRIMARY KEY ({_q(pk_column)}, {column})")
+        for definition in index_definitions:
+            cursor.execute(definition)
+        # Unique constraints have to include the partition column, as the primary key does
+        for name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {_q(table)} ADD CONSTRAINT {_q(name)} {definition}")
+
+    logger.info(f"Converted {table} to a partitioned table")
+    return True
@@ -0,0 +1,173 @@
+"""
+Retention of raw time-series data.
+
+Each table's retention is declared in settings.RETENTION_POLICIES, keyed by
+model label:
+
+    'solar.SolarControllerData': {
+        'column': 'timestamp',            # Time column the cutoff applies to
+        'keep': timedelta(days=7),        # How much history to keep
+        'prepare': 'solar.tasks.prepare_cleanup',  # Optional, called with the cutoff first
+    }
+
+RetentionEngine applies the policies. Partitioned tables first lose every
+partition that is entirely past the cutoff. The remaining old rows are
+deleted in primary key range chunks of RETENTION_CHUNK_SIZE rows, each
+committed on its own so that no lock is held for long. A run stops when
+RETENTION_TIME_BUDGET seconds have passed (the next run picks up where it
+left off), and pauses while inserts into the table take longer than
+RETENTION_MAX_INGEST_LATENCY_MS.
+"""
+
+import logging
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .partitioning import drop_partitions_before
+
+logger = logging.getLogger(__name__)
+
+class RetentionResult:
+    """What a retention run did for one table"""
+
+    def __init__(self, label, cutoff):
+        self.label = label
+        self.cutoff = cutoff
+        self.partitions_dropped = 0
+        self.rows_removed = 0
+        self.chunks = 0
+        self.seconds = 0.0
+        self.paused_seconds = 0.0
+        self.complete = True
+
+    @property
+    def rows_per_second(self):
+        return self.rows_removed / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'model': self.label,
+            'cutoff': self.cutoff.isoformat(),
+            'partitions_dropped': self.partitions_dropped,
+            'rows_removed': self.rows_removed,
+            'chunks': self.chunks,
+            'seconds': round(self.seconds, 2),
+            'paused_seconds': round(self.paused_seconds, 2),
+            'rows_per_second': round(self.rows_per_second, 1),
+            'complete': self.complete,
+        }
+
+def get_policies():
+    """(model, policy) for every configured retention policy"""
+    return [
+        (apps.get_model(label), policy)
+        for label, policy in getattr(settings, 'RETENTION_POLICIES', {}).items()
+    ]
+
+def get_policy(model):
+    return getattr(settings, 'RETENTION_POLICIES', {}).get(model._meta.label)
+
+def insert_latency_ms(model):
+    """
+    Age in milliseconds of the oldest INSERT into the model's table that is
+    still running, or 0. Inserts stuck behind a delete show up here first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE(MAX(EXTRACT(EPOCH FROM clock_timestamp() - query_start)), 0) * 1000
+            FROM pg_stat_activity
+            WHERE state = 'active' AND pid <> pg_backend_pid() AND query ILIKE %s
+        """, [f'INSERT INTO {connection.ops.quote_name(model._meta.db_table)}%'])
+        return float(cursor.fetchone()[0])
+
+class RetentionEngine:
+    """Applies retention policies with chunked deletes under a time budget"""
+
+    def __init__(self, chunk_size=None, time_budget=None, max_ingest_latency_ms=None,
+                 pause_seconds=1.0, ingest_latency=insert_latency_ms):
+        self.chunk_size = chunk_size or getattr(settings, 'RETENTION_CHUNK_SIZE', 5000)
+        self.time_budget = time_budget if time_budget is not None else getattr(settings, 'RETENTION_TIME_BUDGET', 300)
+        self.max_ingest_latency_ms = (
+            max_ingest_latency_ms if max_ingest_latency_ms is not None
+            else getattr(settings, 'RETENTION_MAX_INGEST_LATENCY_MS', 500)
+        )
+        self.pause_seconds = pause_seconds
+        self.ingest_latency = ingest_latency
+        self._deadline = None
+
+    def run(self, models=None, dry_run=False):
+        """Apply every configured policy, or only those for the given models"""
+        self._deadline = time.monotonic() + self.time_budget
+        results = []
+        for model, policy in get_policies():
+            if models is not None and model not in models:
+                continue
+            results.append(self._apply(model, policy, dry_run))
+        return results
+
+    def apply(self, model, keep=None, dry_run=False):
+        """Apply the model's policy, optionally keeping a different amount of history"""
+        policy = dict(get_policy(model) or {})
+        if keep is not None:
+            policy['keep'] = keep
+        if 'keep' not in policy or 'column' not in policy:
+            raise ValueError(f"No retention policy for {model._meta.label}")
+        self._deadline = time.monotonic() + self.time_budget
+        return self._apply(model, policy, dry_run)
+
+    def _out_of_time(self):
+        return time.monotonic() >= self._deadline
+
+    def _wait_for_ingest(self, model, result):
+        """Hold off while inserts into the table are slow. Returns False if we ran out of time."""
+        while self.max_ingest_latency_ms and self.ingest_latency(model) > self.max_ingest_latency_ms:
+            if self._out_of_time():
+                return False
+            logger.info(f"Ingest into {model._meta.db_table} is slow, pausing retention")
+            time.sleep(self.pause_seconds)
+            result.paused_seconds += self.pause_seconds
+        return True
+
+    def _apply(self, model, policy, dry_run):
+        column = policy['column']
+        cutoff = timezone.now() - policy['keep']
+        result = RetentionResult(model._meta.label, cutoff)
+        old_rows = model._base_manager.filter(**{f'{column}__lt': cutoff})
+
+        if dry_run:
+            result.rows_removed = old_rows.count()
+            return result
+
+        started = time.monotonic()
+        if policy.get('prepare'):
+            import_string(policy['prepare'])(cutoff)
+
+        result.partitions_dropped, result.rows_removed = drop_partitions_before(model, cutoff)
+
+        while True:
+            if self._out_of_time() or not self._wait_for_ingest(model, result):
+                result.complete = False
+                break
+
+            # The primary key range of the next chunk of old rows
+            keys = list(old_rows.order_by('pk').values_list('pk', flat=True)[:self.chunk_size])
+            if not keys:
+                break
+
+            with transaction.atomic():
+                deleted, _ = old_rows.filter(pk__gte=keys[0], pk__lte=keys[-1]).delete()
+            result.rows_removed += deleted
+            result.chunks += 1
+
+        result.seconds = time.monotonic() - started
+        logger.info(
+            f"Retention for {result.label}: removed {result.rows_removed} rows "
+            f"({result.partitions_dropped} partitions) in {result.seconds:.1f}s, "
+            f"{result.rows_per_second:.0f} rows/sec{'' if result.complete else ', incomplete'}"
+        )
+        return result
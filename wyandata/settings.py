@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+from datetime import timedelta
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -64,6 +65,53 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Seconds before a worker's in-process weather snapshot is reloaded from the database
+# when it is not receiving invalidations from other workers over the channel layer
+WEATHER_SNAPSHOT_MAX_AGE = 300
+
+# Outdoor sensor whose rain counter the hourly and daily rainfall follow, as field
+# filters; add 'sensor_id' if a neighbour's station of the same model is received
+WEATHER_RAIN_GAUGE = {'model': 'Fineoffset-WH24'}
+
+# Write-behind mode for weather ingest: acknowledge packets immediately and write
+# them in bulk from a background thread every FLUSH_MS or once BATCH_SIZE are queued
+WEATHER_WRITE_BEHIND = False
+WEATHER_WRITE_BEHIND_FLUSH_MS = 500
+WEATHER_WRITE_BEHIND_BATCH_SIZE = 200
+WEATHER_WRITE_BEHIND_MAX_QUEUE = 10000  # Packets beyond this are written synchronously
+
+# Native Postgres range partitioning of the raw time-series tables, one partition per
+# INTERVAL ('hour', 'day' or 'week'). Tables are converted with
+# `manage_partitions --convert`; until then they stay ordinary tables.
+TIME_SERIES_PARTITIONS = {
+    'weather.OutdoorWeatherReading': {'column': 'time', 'interval': 'day'},
+    'weather.IndoorSensor': {'column': 'time', 'interval': 'day'},
+    'solar.SolarControllerData': {'column': 'timestamp', 'interval': 'day'},
+    'system.MetricValue': {'column': 'timestamp', 'interval': 'hour'},
+}
+TIME_SERIES_PARTITIONS_AHEAD = 3  # Future partitions to keep created, per table
+
+# Retention of raw time-series data, applied by `apply_retention` (see wyandata/retention.py).
+# Old rows are removed in separately committed chunks of CHUNK_SIZE rows until TIME_BUDGET
+# seconds have passed, pausing while inserts into the table take longer than MAX_INGEST_LATENCY_MS.
+RETENTION_POLICIES = {
+    'weather.OutdoorWeatherReading': {'column': 'time', 'keep': timedelta(days=7)},
+    'weather.IndoorSensor': {'column': 'time', 'keep': timedelta(days=7)},
+    # Solar aggregates must exist before raw data is removed
+    'solar.SolarControllerData': {'column': 'timestamp', 'keep': timedelta(days=7), 'prepare': 'solar.tasks.prepare_cleanup'},
+    'system.MetricValue': {'column': 'timestamp', 'keep': timedelta(hours=6)},
+}
+RETENTION_CHUNK_SIZE = 5000
+RETENTION_TIME_BUDGET = 300
+RETENTION_MAX_INGEST_LATENCY_MS = 500
+
+# Longest gap in seconds between solar readings that energy is integrated across;
+# longer gaps are treated as the collector being down
+SOLAR_MAX_SAMPLE_GAP = 900
+
+# Seconds the solar stats endpoint caches its result per window (0 disables the cache)
+SOLAR_STATS_CACHE_SECONDS = 60
+
 # REST Framework settings - adjusted for intranet use
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -208,18 +256,15 @@ CRONJOBS = [
     # Run solar data aggregation at 1:00 AM every day
     ('0 1 * * *', 'solar.tasks.run_daily_aggregation'),
     
-    # Run solar data cleanup at 2:00 AM every day (keep 7 days of data)
-    # This runs AFTER aggregation to ensure data is preserved
-    ('0 2 * * *', 'solar.tasks.cleanup_old_solar_data', [7]),
-    
-    # Run system metrics cleanup every 2 hours (keep only 6 hours of metrics data)
-    ('0 */2 * * *', 'system.tasks.cleanup_old_system_metrics', [6]),
+    # Apply RETENTION_POLICIES to the raw weather, solar and system data every hour
+    # (solar aggregates are brought up to date before solar data is removed)
+    ('45 * * * *', 'django.core.management.call_command', ['apply_retention']),
     
     # Generate weather summaries at 12:05 AM every day
     ('5 0 * * *', 'django.core.management.call_command', ['generate_weather_summaries']),
     
-    # Clean up old weather data at 3:15 AM every day (keep 7 days of raw data)
-    ('15 3 * * *', 'django.core.management.call_command', ['cleanup_weather_data']),
+    # Create upcoming partitions of the raw time-series tables every hour
+    ('30 * * * *', 'django.core.management.call_command', ['manage_partitions']),
 ]
 
 # Logging configuration
@@ -0,0 +1,50 @@
+"""
+Shared test helpers.
+"""
+
+import json
+from django.db import connection
+from django.test import TestCase
+
+# Plan nodes that read a table through one of its indexes
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+
+class QueryPlanTestCase(TestCase):
+    """
+    Checks that hot queries are answered from an index.
+
+    Queries are explained with the default planner settings, so a test fails
+    whenever the planner would choose a sequential scan. Seed the tables with
+    about SEED_ROWS rows spread like live data, so that the queries are as
+    selective as in production, and call analyze() afterwards.
+    """
+
+    SEED_ROWS = 20000
+
+    @classmethod
+    def analyze(cls, *models):
+        """Refresh planner statistics after seeding"""
+        with connection.cursor() as cursor:
+            for model in models:
+                cursor.execute(f'ANALYZE "{model._meta.db_table}"')
+
+    def plan(self, queryset):
+        """EXPLAIN output for a queryset as a list of plan nodes"""
+        plan = queryset.explain(format='json')
+        nodes = []
+        pending = [json.loads(plan)[0]['Plan']]
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(node.get('Plans', []))
+        return nodes
+
+    def assertNoSeqScan(self, queryset, model=None):
+        """Fail unless the planner reads the model's table for the queryset through an index"""
+        table = (model or queryset.model)._meta.db_table
+        scans = [node['Node Type'] for node in self.plan(queryset) if node.get('Relation Name') == table]
+        self.assertTrue(scans, f'{table} is not scanned for: {queryset.query}')
+        self.assertTrue(
+            all(scan in INDEX_SCANS for scan in scans),
+            f'{", ".join(scans)} on {table} for: {queryset.query}'
+        )